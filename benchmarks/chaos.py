@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+"""
+Failover chaos harness which measures how long producers and consumers are down.
+
+Each scenario runs an ``EnsuredRedisTask`` producer and a ``SentinelTransport``
+consumer against in-process fake sentinels monitoring two fake redis servers
+(master and its replica) from :mod:`benchmarks.servers`. Like celery worker,
+the consumer polls the broker via kombu event loop. While messages are
+being published and consumed, scripted failover promotes the replica to master
+and sentinels announce ``+switch-master``. For each scenario the harness reports:
+
+* ``lost`` - messages which ``apply_async`` confirmed but were not consumed
+  within 20 seconds after publishing stopped. Note that master pops the message
+  before replying to ``BRPOP`` hence a message popped right before the master
+  crashed or became unreachable is lost since its reply never arrives
+* ``unconfirmed`` - messages consumed even though ``apply_async`` failed
+* ``duplicated`` - messages consumed more than once
+* ``stall`` - longest gap in seconds between two consumed messages
+* ``recovery`` - seconds between failover start and the first consumed message
+  which was published after sentinels announced the new master
+* ``block`` - longest ``apply_async`` call in seconds
+
+Usage::
+
+    python -m benchmarks.chaos
+    python -m benchmarks.chaos --scenario crash --scenario crash_failover_detection
+    python -m benchmarks.chaos --duration 5 --rate 500 --save chaos.json
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import argparse
+import importlib
+import json
+import logging
+import platform
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from celery import Celery
+from kombu import Connection, Exchange, Queue
+
+from celery_redis_sentinel import register
+from celery_redis_sentinel.task import EnsuredRedisTask
+from celery_redis_sentinel.transport import SentinelTransport
+
+try:
+    from kombu.asynchronous import Hub
+except ImportError:
+    # kombu < 4.2 where the module cannot be imported
+    # via import statement in Python 3.7+
+    Hub = importlib.import_module('kombu.async').Hub
+
+from .servers import FakeCluster, FakeRedisServer
+
+
+SCENARIOS = OrderedDict()
+
+timer = time.time if sys.version_info < (3, 3) else time.perf_counter
+
+
+def scenario(name, consumer_options=None, **transport_options):
+    """
+    Register failover scenario
+
+    Decorated function receives :class:`FakeCluster <benchmarks.servers.FakeCluster>`
+    and replica :class:`FakeRedisServer <benchmarks.servers.FakeRedisServer>`
+    and should promote the replica to master. Given transport options are
+    used by both producer and consumer. ``consumer_options`` are additionally
+    used by the consumer only.
+    """
+    def wrapper(f):
+        SCENARIOS[name] = (f, transport_options, consumer_options or {})
+        return f
+
+    return wrapper
+
+
+def switch_master(cluster, replica):
+    replica.replicate_from(cluster.master)
+    cluster.master.demote()
+    for sentinel in cluster.sentinel_servers:
+        sentinel.switch_master(cluster.service_name, replica.address)
+
+
+def crash_master(cluster, replica, election_delay=1.0, partition=False):
+    if partition:
+        cluster.master.partition()
+    else:
+        cluster.master.stop()
+    # replica has all the data the master had when it became unreachable
+    # however sentinels need some time to agree on the failover
+    replica.replicate_from(cluster.master)
+    time.sleep(election_delay)
+    for sentinel in cluster.sentinel_servers:
+        sentinel.switch_master(cluster.service_name, replica.address)
+
+
+@scenario('switch')
+def switch(cluster, replica):
+    """
+    Manual failover (``SENTINEL FAILOVER``) where old master stays up as replica
+    """
+    switch_master(cluster, replica)
+
+
+@scenario('switch_failover_detection', failover_detection=True)
+def switch_failover_detection(cluster, replica):
+    """
+    Same as ``switch`` with ``failover_detection`` transport option
+    """
+    switch_master(cluster, replica)
+
+
+@scenario('crash')
+def crash(cluster, replica):
+    """
+    Master crashes and sentinels promote replica after 1 second
+    """
+    crash_master(cluster, replica)
+
+
+@scenario('crash_failover_detection', failover_detection=True)
+def crash_failover_detection(cluster, replica):
+    """
+    Same as ``crash`` with ``failover_detection`` transport option
+    """
+    crash_master(cluster, replica)
+
+
+# consumer commands other than BRPOP (such as restoring unacknowledged
+# messages) fail only after socket timeout hence it is large enough
+# for partition to be detected by master health checks first
+PARTITION_CONSUMER_OPTIONS = {'socket_timeout': 5}
+
+
+@scenario('partition', consumer_options=PARTITION_CONSUMER_OPTIONS)
+def partition(cluster, replica):
+    """
+    Master becomes unreachable without closing connections
+    and sentinels promote replica after 1 second.
+    Consumer waits for ``BRPOP`` reply until some other command
+    (e.g. acknowledging a message) times out after 5 seconds.
+    Idle consumer waits forever since the event loop only logs errors
+    of periodic restoring of unacknowledged messages.
+    """
+    crash_master(cluster, replica, partition=True)
+
+
+@scenario('partition_health_check', consumer_options=PARTITION_CONSUMER_OPTIONS,
+          master_health_check_interval=10, master_health_check_timeout=0.5)
+def partition_health_check(cluster, replica):
+    """
+    Same as ``partition`` with ``master_health_check_interval`` transport option
+    hence overdue ``BRPOP`` reply is detected within ``brpop_timeout``
+    and ``master_health_check_timeout``
+    """
+    crash_master(cluster, replica, partition=True)
+
+
+class Stats(object):
+    """
+    Thread-safe record of published and consumed messages
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.published = {}
+        self.publish_errors = Counter()
+        self.consumed = []
+        self.consumer_errors = Counter()
+
+    def on_published(self, seq, start, latency):
+        with self.lock:
+            self.published[seq] = (start, latency)
+
+    def on_publish_error(self, error):
+        with self.lock:
+            self.publish_errors[type(error).__name__] += 1
+
+    def on_consumed(self, seq):
+        with self.lock:
+            self.consumed.append((seq, timer()))
+
+    def on_consumer_error(self, error):
+        with self.lock:
+            self.consumer_errors[type(error).__name__] += 1
+
+    def consumed_all(self):
+        with self.lock:
+            return set(self.published) <= set(seq for seq, _ in self.consumed)
+
+    def summary(self, failover_started, failover_finished):
+        """
+        Summarize the scenario
+
+        Parameters
+        ----------
+        failover_started : float
+            :func:`timer` value when failover started
+        failover_finished : float
+            :func:`timer` value when sentinels announced the new master
+        """
+        with self.lock:
+            published = dict(self.published)
+            consumed = list(self.consumed)
+            publish_errors = dict(self.publish_errors)
+            consumer_errors = dict(self.consumer_errors)
+
+        consumed_seqs = Counter(seq for seq, _ in consumed)
+        times = [t for _, t in consumed]
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        recovered = [
+            t for seq, t in consumed
+            if seq in published and published[seq][0] >= failover_finished
+        ]
+
+        return OrderedDict([
+            ('published', len(published)),
+            ('consumed', len(consumed_seqs)),
+            ('lost', len(set(published) - set(consumed_seqs))),
+            ('unconfirmed', len(set(consumed_seqs) - set(published))),
+            ('duplicated', sum(i - 1 for i in consumed_seqs.values())),
+            ('stall', max(gaps) if gaps else None),
+            ('recovery', min(recovered) - failover_started if recovered else None),
+            ('block', max(i[1] for i in published.values()) if published else None),
+            ('publish_errors', publish_errors),
+            ('consumer_errors', consumer_errors),
+        ])
+
+
+def noop(seq):
+    pass
+
+
+def produce(task, stats, stop, rate):
+    seq = 0
+    while not stop.is_set():
+        start = timer()
+        try:
+            task.apply_async((seq,))
+        except Exception as e:
+            stats.on_publish_error(e)
+        else:
+            stats.on_published(seq, start, timer() - start)
+        seq += 1
+        time.sleep(max(1.0 / rate - (timer() - start), 0))
+
+
+def consume(transport_options, stats, stop):
+    # same queue celery routes tasks to by default
+    queue = Queue('celery', Exchange('celery', 'direct'), routing_key='celery')
+
+    def on_message(body, message):
+        # task message protocol 1 (celery 3) or 2 (celery 4+)
+        args = body['args'] if isinstance(body, dict) else body[0]
+        stats.on_consumed(args[0])
+        message.ack()
+
+    # similar to celery worker, consumer polls the broker via event loop
+    # (where unacknowledged messages are restored every 10 seconds
+    # as opposed to almost every Connection.drain_events call)
+    # and reconnects on any error
+    while not stop.is_set():
+        connection = Connection(transport=SentinelTransport, transport_options=transport_options)
+        hub = Hub()
+        # wake up the loop regularly to notice that consumer should stop
+        hub.call_repeatedly(0.1, noop, None)
+        try:
+            with connection.Consumer(queue, callbacks=[on_message], accept=['json', 'pickle']):
+                connection.register_with_event_loop(hub)
+                while not stop.is_set():
+                    hub.run_once()
+        except Exception as e:
+            stats.on_consumer_error(e)
+            time.sleep(0.1)
+        finally:
+            try:
+                hub.close()
+            except Exception:
+                pass
+            try:
+                connection.release()
+            except Exception:
+                pass
+
+
+def run_scenario(name, duration=3.0, rate=200, failover_after=1.0, drain_timeout=20.0):
+    """
+    Run single failover scenario
+
+    Parameters
+    ----------
+    name : str
+        Name of the scenario from :data:`SCENARIOS`
+    duration : float, optional
+        Number of seconds messages are published for
+    rate : float, optional
+        Number of messages published per second
+    failover_after : float, optional
+        Number of seconds after which failover starts
+    drain_timeout : float, optional
+        Maximum number of seconds to wait for consumer to consume
+        all published messages after publishing stops
+
+    Returns
+    -------
+    dict
+        Scenario summary. See :meth:`Stats.summary`.
+    """
+    failover, scenario_options, consumer_options = SCENARIOS[name]
+    cluster = FakeCluster().start()
+    replica = FakeRedisServer().start()
+
+    transport_options = dict(
+        sentinels=cluster.sentinels,
+        service_name=cluster.service_name,
+        socket_timeout=0.5,
+        retry_policy={'attempts': 10, 'base': 1.5, 'cap': 1},
+    )
+    transport_options.update(scenario_options)
+    consumer_transport_options = dict(transport_options, **consumer_options)
+    app = Celery('chaos', broker='redis-sentinel://localhost/0', set_as_current=False)
+    app.conf.BROKER_TRANSPORT_OPTIONS = transport_options
+    app.conf.broker_transport_options = transport_options
+    task = app.task(name='chaos.noop', base=EnsuredRedisTask)(noop)
+
+    stats = Stats()
+    stop_producer = threading.Event()
+    stop_consumer = threading.Event()
+    threads = [
+        threading.Thread(target=consume, args=(consumer_transport_options, stats, stop_consumer)),
+        threading.Thread(target=produce, args=(task, stats, stop_producer, rate)),
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        time.sleep(failover_after)
+        failover_started = timer()
+        failover(cluster, replica)
+        failover_finished = timer()
+        time.sleep(max(duration - (failover_finished - failover_started) - failover_after, 0))
+        stop_producer.set()
+        threads[1].join()
+
+        deadline = timer() + drain_timeout
+        while not stats.consumed_all() and timer() < deadline:
+            time.sleep(0.1)
+        stop_consumer.set()
+        threads[0].join(drain_timeout)
+    finally:
+        stop_producer.set()
+        stop_consumer.set()
+        cluster.stop()
+        replica.stop()
+
+    return stats.summary(failover_started, failover_finished)
+
+
+def format_seconds(value):
+    return '{:>7}'.format('-') if value is None else '{:>6.2f}s'.format(value)
+
+
+def format_result(name, result):
+    line = '{:<28} published {:>6}  lost {:>4}  unconfirmed {:>3}  duplicated {:>3}  ' \
+           'stall {}  recovery {}  block {}'.format(
+               name, result['published'], result['lost'], result['unconfirmed'],
+               result['duplicated'], format_seconds(result['stall']),
+               format_seconds(result['recovery']), format_seconds(result['block']),
+           )
+    errors = ', '.join(
+        '{} {}x{}'.format(side, error, count)
+        for side in ('publish', 'consumer')
+        for error, count in sorted(result['{}_errors'.format(side)].items())
+    )
+    if errors:
+        line += '\n{:<28} {}'.format('', errors)
+    return line
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        '--scenario', action='append', choices=list(SCENARIOS),
+        help='Scenario to run. Can be provided multiple times. By default all are run.',
+    )
+    parser.add_argument(
+        '--duration', type=float, default=3.0,
+        help='Number of seconds messages are published for in each scenario',
+    )
+    parser.add_argument(
+        '--rate', type=float, default=200,
+        help='Number of messages published per second',
+    )
+    parser.add_argument(
+        '--failover-after', type=float, default=1.0,
+        help='Number of seconds after which failover starts',
+    )
+    parser.add_argument('--save', help='Save results as JSON into this file')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show retry logs')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING if args.verbose else logging.CRITICAL)
+    register()
+
+    results = OrderedDict()
+    for name in args.scenario or SCENARIOS:
+        results[name] = run_scenario(
+            name, duration=args.duration, rate=args.rate,
+            failover_after=args.failover_after,
+        )
+        print(format_result(name, results[name]))
+
+    if args.save:
+        with open(args.save, 'w') as fid:
+            json.dump({
+                'python': platform.python_version(),
+                'results': results,
+            }, fid, indent=4)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks of celery-redis-sentinel hot paths.
+
+All benchmarks run against in-process fake redis and sentinel servers
+from :mod:`benchmarks.servers` hence no redis installation is required.
+Numbers are only meaningful relative to each other and to a baseline
+recorded on the same machine.
+
+Usage::
+
+    python -m benchmarks.run
+    python -m benchmarks.run --save baseline.json
+    python -m benchmarks.run --compare baseline.json --threshold 0.2
+    python -m benchmarks.run --filter discovery
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import argparse
+import json
+import platform
+import sys
+import time
+from collections import OrderedDict
+
+from kombu import Connection, Producer
+from redis import StrictRedis
+
+from celery_redis_sentinel.discovery import master_address_cache
+from celery_redis_sentinel.redis_sentinel import (
+    EnsuredRedisMixin,
+    PersistentSentinel,
+    ShortLivedSentinel,
+    ShortLivedStrictRedis,
+    get_redis_via_sentinel,
+)
+from celery_redis_sentinel.transport import SentinelTransport
+
+from .servers import FakeCluster
+
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    """
+    Register benchmark under the given name
+
+    Decorated function receives :class:`.FakeCluster` and
+    should return a tuple of ``(func, teardown)`` where ``func`` is
+    called repeatedly while being measured and ``teardown``
+    (which can be ``None``) is called once measurement is done.
+    """
+    def wrapper(f):
+        BENCHMARKS[name] = f
+        return f
+    return wrapper
+
+
+def ensured_redis_class():
+    return type(str('Redis'), (EnsuredRedisMixin, StrictRedis), {})
+
+
+@benchmark('discovery.sequential')
+def discovery_sequential(cluster):
+    sentinel = ShortLivedSentinel(cluster.sentinels, socket_timeout=1)
+    return lambda: sentinel.discover_master(cluster.service_name), None
+
+
+@benchmark('discovery.parallel')
+def discovery_parallel(cluster):
+    sentinel = ShortLivedSentinel(
+        cluster.sentinels, socket_timeout=1,
+        parallel_discovery=True, discovery_quorum=2,
+    )
+    return lambda: sentinel.discover_master(cluster.service_name), None
+
+
+@benchmark('discovery.persistent')
+def discovery_persistent(cluster):
+    sentinel = PersistentSentinel(cluster.sentinels, socket_timeout=1)
+    return lambda: sentinel.discover_master(cluster.service_name), None
+
+
+@benchmark('discovery.cached')
+def discovery_cached(cluster):
+    sentinel = ShortLivedSentinel(cluster.sentinels, socket_timeout=1, master_cache_ttl=60)
+    return lambda: sentinel.discover_master(cluster.service_name), master_address_cache.invalidate
+
+
+@benchmark('get_redis_via_sentinel.ping')
+def get_redis_via_sentinel_ping(cluster):
+    def func():
+        client = get_redis_via_sentinel(
+            db=0,
+            sentinels=cluster.sentinels,
+            service_name=cluster.service_name,
+            socket_timeout=1,
+        )
+        client.ping()
+        client.connection_pool.disconnect()
+
+    return func, None
+
+
+@benchmark('redis.get')
+def redis_get(cluster):
+    client = StrictRedis(*cluster.master.address)
+    client.set('foo', 'bar')
+    return lambda: client.get('foo'), client.connection_pool.disconnect
+
+
+@benchmark('ensured_redis.get')
+def ensured_redis_get(cluster):
+    client = get_redis_via_sentinel(
+        db=0,
+        sentinels=cluster.sentinels,
+        service_name=cluster.service_name,
+        socket_timeout=1,
+        redis_class=ensured_redis_class(),
+    )
+    client.set('foo', 'bar')
+    return lambda: client.get('foo'), client.connection_pool.disconnect
+
+
+@benchmark('short_lived_redis.ping')
+def short_lived_redis_ping(cluster):
+    client = ShortLivedStrictRedis(*cluster.master.address, socket_timeout=1)
+    return client.ping, None
+
+
+def sentinel_connection(cluster):
+    return Connection(
+        transport=SentinelTransport,
+        transport_options={
+            'sentinels': cluster.sentinels,
+            'service_name': cluster.service_name,
+            'socket_timeout': 1,
+        },
+    )
+
+
+@benchmark('transport.sentinel_pool')
+def transport_sentinel_pool(cluster):
+    connection = sentinel_connection(cluster)
+    channel = connection.channel()
+
+    def func():
+        channel.__dict__.pop('sentinel_pool', None)
+        channel.sentinel_pool.disconnect()
+
+    def teardown():
+        channel.close()
+        connection.release()
+
+    return func, teardown
+
+
+@benchmark('transport.publish_consume')
+def transport_publish_consume(cluster):
+    connection = sentinel_connection(cluster)
+    queue = connection.SimpleQueue('benchmark')
+
+    def func():
+        queue.put({'hello': 'world'})
+        queue.get(timeout=1).ack()
+
+    def teardown():
+        queue.close()
+        connection.release()
+
+    return func, teardown
+
+
+@benchmark('transport.publish_100')
+def transport_publish_100(cluster):
+    connection = sentinel_connection(cluster)
+    channel = connection.channel()
+    producer = Producer(channel, routing_key='benchmark')
+
+    def func():
+        for _ in range(100):
+            producer.publish({'hello': 'world'})
+        channel.client.delete('benchmark')
+
+    def teardown():
+        channel.close()
+        connection.release()
+
+    return func, teardown
+
+
+@benchmark('transport.publish_buffered_100')
+def transport_publish_buffered_100(cluster):
+    connection = sentinel_connection(cluster)
+    channel = connection.channel()
+    producer = Producer(channel, routing_key='benchmark')
+
+    def func():
+        with channel.buffered_puts():
+            for _ in range(100):
+                producer.publish({'hello': 'world'})
+        channel.client.delete('benchmark')
+
+    def teardown():
+        channel.close()
+        connection.release()
+
+    return func, teardown
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of already sorted values
+    """
+    index = max(int(round(p / 100.0 * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def measure(func, duration=1.0, min_iterations=10, warmup=5):
+    """
+    Call ``func`` repeatedly for at least ``duration`` seconds
+    and summarize its latency
+
+    Returns
+    -------
+    dict
+        ``ops_per_sec`` and ``p50``, ``p90``, ``p99`` latencies in milliseconds
+    """
+    for _ in range(warmup):
+        func()
+
+    timer = time.time if sys.version_info < (3, 3) else time.perf_counter
+    latencies = []
+    start = timer()
+    while len(latencies) < min_iterations or timer() - start < duration:
+        t = timer()
+        func()
+        latencies.append(timer() - t)
+    elapsed = timer() - start
+
+    latencies.sort()
+    return OrderedDict([
+        ('iterations', len(latencies)),
+        ('ops_per_sec', len(latencies) / elapsed),
+        ('p50', percentile(latencies, 50) * 1000),
+        ('p90', percentile(latencies, 90) * 1000),
+        ('p99', percentile(latencies, 99) * 1000),
+    ])
+
+
+def run(names, duration=1.0):
+    results = OrderedDict()
+    with FakeCluster() as cluster:
+        for name in names:
+            func, teardown = BENCHMARKS[name](cluster)
+            try:
+                results[name] = measure(func, duration=duration)
+            finally:
+                if teardown is not None:
+                    teardown()
+            print(format_result(name, results[name]))
+    return results
+
+
+def format_result(name, result, baseline=None):
+    line = '{:<30} {:>10.1f} ops/s  p50 {:>8.3f}ms  p90 {:>8.3f}ms  p99 {:>8.3f}ms'.format(
+        name, result['ops_per_sec'], result['p50'], result['p90'], result['p99'],
+    )
+    if baseline is not None:
+        line += '  {:>+7.1%}'.format(change(result, baseline))
+    return line
+
+
+def change(result, baseline):
+    """
+    Relative throughput change compared to baseline
+    """
+    return result['ops_per_sec'] / baseline['ops_per_sec'] - 1
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results with baseline results
+
+    Returns
+    -------
+    list
+        Names of benchmarks which throughput dropped by more than ``threshold``
+    """
+    regressions = []
+    print('\nCompared to baseline:')
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        print(format_result(name, result, baseline[name]))
+        if change(result, baseline[name]) < -threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        '--duration', type=float, default=1.0,
+        help='Number of seconds each benchmark is measured for',
+    )
+    parser.add_argument(
+        '--filter', default='',
+        help='Only run benchmarks which name contains this string',
+    )
+    parser.add_argument('--save', help='Save results as JSON into this file')
+    parser.add_argument('--compare', help='Compare results with baseline JSON file')
+    parser.add_argument(
+        '--threshold', type=float, default=0.2,
+        help='Maximum allowed relative throughput drop compared to baseline',
+    )
+    args = parser.parse_args(argv)
+
+    names = [i for i in BENCHMARKS if args.filter in i]
+    results = run(names, duration=args.duration)
+
+    if args.save:
+        with open(args.save, 'w') as fid:
+            json.dump({
+                'python': platform.python_version(),
+                'results': results,
+            }, fid, indent=4)
+
+    if args.compare:
+        with open(args.compare, 'r') as fid:
+            baseline = json.load(fid)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('\nRegressed by more than {:.0%}: {}'.format(args.threshold, ', '.join(regressions)))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
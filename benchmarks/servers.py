@@ -0,0 +1,808 @@
+# -*- coding: utf-8 -*-
+"""
+In-process stand-ins for redis and redis sentinel servers.
+
+The servers speak enough of the redis protocol for redis-py, kombu redis
+transport and celery redis results backend to work against them.
+They are only meant for benchmarking and failover simulation.
+Data is kept in memory in a single lock-protected structure
+so they are neither fast nor complete implementations of redis.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import fnmatch
+import hashlib
+import socket
+import threading
+import time
+from collections import deque
+
+import six
+from six.moves import socketserver
+
+
+class Status(str):
+    """
+    Redis simple string reply such as ``+OK``
+    """
+
+
+class Error(Exception):
+    """
+    Redis error reply
+    """
+
+
+OK = Status('OK')
+QUEUED = Status('QUEUED')
+PONG = Status('PONG')
+NIL_ARRAY = object()
+
+
+def encode(value):
+    """
+    Encode python value as RESP reply
+    """
+    if isinstance(value, Error):
+        return '-{}\r\n'.format(value).encode('utf-8')
+    if isinstance(value, Status):
+        return '+{}\r\n'.format(value).encode('utf-8')
+    if value is None:
+        return b'$-1\r\n'
+    if value is NIL_ARRAY:
+        return b'*-1\r\n'
+    if isinstance(value, bool):
+        return ':{}\r\n'.format(int(value)).encode('utf-8')
+    if isinstance(value, six.integer_types):
+        return ':{}\r\n'.format(value).encode('utf-8')
+    if isinstance(value, float):
+        value = repr(value)
+    if isinstance(value, six.text_type):
+        value = value.encode('utf-8')
+    if isinstance(value, six.binary_type):
+        return b'$' + str(len(value)).encode('utf-8') + b'\r\n' + value + b'\r\n'
+    if isinstance(value, (list, tuple)):
+        return b'*' + str(len(value)).encode('utf-8') + b'\r\n' + b''.join(encode(i) for i in value)
+    raise TypeError('Cannot encode {!r}'.format(value))
+
+
+def read_command(rfile):
+    """
+    Read single RESP command from the file-like object
+
+    Returns
+    -------
+    list
+        Command arguments as bytes or ``None`` when connection is closed
+    """
+    line = rfile.readline()
+    if not line:
+        return None
+    if not line.startswith(b'*'):
+        # inline command
+        return line.strip().split()
+    args = []
+    for _ in six.moves.range(int(line[1:])):
+        size = int(rfile.readline()[1:])
+        args.append(rfile.read(size + 2)[:-2])
+    return args
+
+
+class Database(object):
+    """
+    Keyspace of a single redis db with lazy expiration
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def get(self, key, default=None):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.time():
+            self.delete(key)
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.expires.pop(key, None)
+
+    def delete(self, key):
+        self.expires.pop(key, None)
+        return self.data.pop(key, None) is not None
+
+    def copy(self):
+        db = Database()
+        for key, value in self.data.items():
+            if isinstance(value, deque):
+                value = deque(value)
+            elif isinstance(value, (dict, set)):
+                value = value.copy()
+            db.data[key] = value
+        db.expires = dict(self.expires)
+        return db
+
+
+class ClientState(object):
+    """
+    Per-connection state
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.db = 0
+        self.transaction = None
+        self.transaction_aborted = False
+        self.channels = set()
+        self.patterns = set()
+
+    @property
+    def subscriptions(self):
+        return len(self.channels) + len(self.patterns)
+
+
+class BaseServer(object):
+    """
+    Base class for threaded RESP servers
+
+    Parameters
+    ----------
+    host : str, optional
+        Host to bind to. By default ``127.0.0.1``.
+    port : int, optional
+        Port to bind to. By default random free port is used.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.lock = threading.Condition()
+        self.clients = set()
+        self.server = None
+        self.thread = None
+        self.commands_processed = 0
+        self.partitioned = False
+        self.stopped = threading.Event()
+
+    @property
+    def address(self):
+        return self.host, self.port
+
+    def start(self):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                server.handle_connection(self)
+
+        class TCPServer(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self.server = TCPServer((self.host, self.port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def _close_server(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def stop(self):
+        """
+        Stop accepting connections and drop all connected clients
+        which simulates crashed server
+        """
+        self._close_server()
+        self.stopped.set()
+        for client in list(self.clients):
+            try:
+                client.handler.request.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+        with self.lock:
+            self.lock.notify_all()
+
+    def partition(self):
+        """
+        Stop accepting connections and stop replying to connected clients
+        without closing their connections which simulates network partition
+        where clients are not notified that the server is gone
+        """
+        self.partitioned = True
+        self._close_server()
+        with self.lock:
+            self.lock.notify_all()
+
+    def send(self, client, value):
+        data = encode(value)
+        with client.handler.write_lock:
+            client.handler.request.sendall(data)
+
+    def handle_connection(self, handler):
+        # like real redis, do not delay small replies such as pipeline responses
+        handler.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        handler.write_lock = threading.Lock()
+        client = ClientState(handler)
+        self.clients.add(client)
+        try:
+            while True:
+                try:
+                    args = read_command(handler.rfile)
+                except (OSError, socket.error, ValueError):
+                    break
+                if self.partitioned:
+                    self.stopped.wait()
+                    break
+                if args is None or self.server is None:
+                    break
+                self.commands_processed += 1
+                try:
+                    reply = self.execute(client, args)
+                except Error as e:
+                    reply = e
+                except Exception as e:
+                    reply = Error('ERR {}'.format(e))
+                if reply is None and client.subscriptions and args[0].upper() in (
+                        b'SUBSCRIBE', b'PSUBSCRIBE', b'UNSUBSCRIBE', b'PUNSUBSCRIBE'):
+                    continue
+                if self.partitioned:
+                    self.stopped.wait()
+                    break
+                try:
+                    self.send(client, reply)
+                except (OSError, socket.error):
+                    break
+        finally:
+            self.clients.discard(client)
+
+    def execute(self, client, args):
+        name = args[0].decode('utf-8').lower()
+        handler = getattr(self, 'cmd_{}'.format(name.replace('-', '_')), None)
+        if handler is None:
+            raise Error("ERR unknown command '{}'".format(name))
+        return handler(client, *args[1:])
+
+    def cmd_ping(self, client, *args):
+        if client.subscriptions:
+            return [b'pong', args[0] if args else b'']
+        return args[0] if args else PONG
+
+    def cmd_echo(self, client, value):
+        return value
+
+    def cmd_client(self, client, *args):
+        if args and args[0].lower() == b'getname':
+            return None
+        return OK
+
+    def cmd_quit(self, client):
+        return OK
+
+    # pub/sub
+
+    def publish(self, channel, message):
+        receivers = 0
+        for client in list(self.clients):
+            if channel in client.channels:
+                reply = [b'message', channel, message]
+            else:
+                pattern = next((p for p in client.patterns if fnmatch.fnmatchcase(
+                    channel.decode('utf-8'), p.decode('utf-8'))), None)
+                if pattern is None:
+                    continue
+                reply = [b'pmessage', pattern, channel, message]
+            try:
+                self.send(client, reply)
+                receivers += 1
+            except (OSError, socket.error):
+                pass
+        return receivers
+
+    def cmd_publish(self, client, channel, message):
+        return self.publish(channel, message)
+
+    def cmd_subscribe(self, client, *channels):
+        for channel in channels:
+            client.channels.add(channel)
+            self.send(client, [b'subscribe', channel, client.subscriptions])
+
+    def cmd_psubscribe(self, client, *patterns):
+        for pattern in patterns:
+            client.patterns.add(pattern)
+            self.send(client, [b'psubscribe', pattern, client.subscriptions])
+
+    def cmd_unsubscribe(self, client, *channels):
+        for channel in channels or list(client.channels):
+            client.channels.discard(channel)
+            self.send(client, [b'unsubscribe', channel, client.subscriptions])
+
+    def cmd_punsubscribe(self, client, *patterns):
+        for pattern in patterns or list(client.patterns):
+            client.patterns.discard(pattern)
+            self.send(client, [b'punsubscribe', pattern, client.subscriptions])
+
+
+class FakeRedisServer(BaseServer):
+    """
+    In-process redis stand-in
+
+    Supports strings, lists, sets, hashes, sorted sets, expiry,
+    ``MULTI``/``EXEC`` transactions, blocking ``BRPOP``, pub/sub
+    and just enough lua scripting for redis-py locks.
+    """
+
+    #: Commands rejected with ``READONLY`` error once the server is demoted
+    WRITE_COMMANDS = frozenset([
+        b'DEL', b'EXPIRE', b'PEXPIRE', b'FLUSHDB', b'FLUSHALL',
+        b'SET', b'SETEX', b'INCRBY', b'INCR',
+        b'LPUSH', b'RPUSH', b'RPOP', b'LPOP', b'BRPOP',
+        b'SADD', b'SREM', b'HSET', b'HDEL', b'ZADD', b'ZREM',
+        b'EVALSHA', b'EVAL',
+    ])
+
+    def __init__(self, *args, **kwargs):
+        super(FakeRedisServer, self).__init__(*args, **kwargs)
+        self.dbs = {}
+        self.scripts = {}
+        self.role = 'master'
+
+    def db(self, client):
+        try:
+            return self.dbs[client.db]
+        except KeyError:
+            return self.dbs.setdefault(client.db, Database())
+
+    def replicate_from(self, other):
+        """
+        Copy dataset of another server which simulates
+        replica being promoted to master
+        """
+        with other.lock:
+            dbs = dict((i, db.copy()) for i, db in other.dbs.items())
+        with self.lock:
+            self.dbs = dbs
+            self.role = 'master'
+            self.lock.notify_all()
+
+    def demote(self):
+        """
+        Demote master to replica which simulates old master
+        being reconfigured by sentinel after failover.
+
+        New writes fail with ``READONLY`` error however like redis < 6,
+        clients already blocked in ``BRPOP`` stay blocked.
+        """
+        with self.lock:
+            self.role = 'slave'
+
+    def execute(self, client, args):
+        name = args[0].upper()
+        if self.role != 'master' and name in self.WRITE_COMMANDS:
+            client.transaction_aborted = client.transaction is not None
+            raise Error("READONLY You can't write against a read only replica.")
+        if client.transaction is not None and name not in (b'EXEC', b'DISCARD', b'MULTI', b'WATCH'):
+            client.transaction.append(args)
+            return QUEUED
+        with self.lock:
+            return super(FakeRedisServer, self).execute(client, args)
+
+    # connection
+
+    def cmd_select(self, client, db):
+        client.db = int(db)
+        return OK
+
+    def cmd_info(self, client, *sections):
+        return (
+            '# Server\r\nredis_version:5.0.0\r\nredis_mode:standalone\r\n'
+            '# Replication\r\nrole:{}\r\n'.format(self.role)
+        )
+
+    # transactions
+
+    def cmd_multi(self, client):
+        client.transaction = []
+        client.transaction_aborted = False
+        return OK
+
+    def cmd_exec(self, client):
+        if client.transaction is None:
+            raise Error('ERR EXEC without MULTI')
+        commands, client.transaction = client.transaction, None
+        if client.transaction_aborted:
+            raise Error('EXECABORT Transaction discarded because of previous errors.')
+        results = []
+        for args in commands:
+            try:
+                results.append(super(FakeRedisServer, self).execute(client, args))
+            except Error as e:
+                results.append(e)
+        return results
+
+    def cmd_discard(self, client):
+        client.transaction = None
+        client.transaction_aborted = False
+        return OK
+
+    def cmd_watch(self, client, *keys):
+        return OK
+
+    def cmd_unwatch(self, client):
+        return OK
+
+    # keys
+
+    def cmd_del(self, client, *keys):
+        db = self.db(client)
+        return sum(db.delete(key) for key in keys)
+
+    def cmd_exists(self, client, *keys):
+        db = self.db(client)
+        return sum(db.get(key) is not None for key in keys)
+
+    def cmd_expire(self, client, key, seconds):
+        db = self.db(client)
+        if db.get(key) is None:
+            return 0
+        db.expires[key] = time.time() + int(seconds)
+        return 1
+
+    def cmd_pexpire(self, client, key, milliseconds):
+        return self.cmd_expire(client, key, int(milliseconds) / 1000.0)
+
+    def cmd_ttl(self, client, key):
+        db = self.db(client)
+        if db.get(key) is None:
+            return -2
+        expires = db.expires.get(key)
+        return -1 if expires is None else int(expires - time.time())
+
+    def cmd_flushdb(self, client):
+        self.dbs[client.db] = Database()
+        return OK
+
+    def cmd_flushall(self, client):
+        self.dbs = {}
+        return OK
+
+    def cmd_dbsize(self, client):
+        return len(self.db(client).data)
+
+    # strings
+
+    def cmd_get(self, client, key):
+        return self.db(client).get(key)
+
+    def cmd_mget(self, client, *keys):
+        db = self.db(client)
+        return [db.get(key) for key in keys]
+
+    def cmd_set(self, client, key, value, *options):
+        db = self.db(client)
+        options = [i.upper() for i in options]
+        expires = None
+        if b'NX' in options and db.get(key) is not None:
+            return None
+        if b'XX' in options and db.get(key) is None:
+            return None
+        for unit, factor in ((b'EX', 1.0), (b'PX', 0.001)):
+            if unit in options:
+                expires = time.time() + int(options[options.index(unit) + 1]) * factor
+        db.set(key, value)
+        if expires is not None:
+            db.expires[key] = expires
+        return OK
+
+    def cmd_setex(self, client, key, seconds, value):
+        return self.cmd_set(client, key, value, b'EX', seconds)
+
+    def cmd_incrby(self, client, key, amount):
+        db = self.db(client)
+        value = int(db.get(key) or 0) + int(amount)
+        db.data[key] = str(value).encode('utf-8')
+        return value
+
+    def cmd_incr(self, client, key):
+        return self.cmd_incrby(client, key, 1)
+
+    # lists
+
+    def _list(self, client, key, create=False):
+        db = self.db(client)
+        value = db.get(key)
+        if value is None and create:
+            value = deque()
+            db.set(key, value)
+        return value
+
+    def _cleanup(self, client, key):
+        db = self.db(client)
+        if not db.get(key):
+            db.delete(key)
+
+    def cmd_lpush(self, client, key, *values):
+        items = self._list(client, key, create=True)
+        items.extendleft(values)
+        self.lock.notify_all()
+        return len(items)
+
+    def cmd_rpush(self, client, key, *values):
+        items = self._list(client, key, create=True)
+        items.extend(values)
+        self.lock.notify_all()
+        return len(items)
+
+    def cmd_rpop(self, client, key):
+        items = self._list(client, key)
+        if not items:
+            return None
+        value = items.pop()
+        self._cleanup(client, key)
+        return value
+
+    def cmd_lpop(self, client, key):
+        items = self._list(client, key)
+        if not items:
+            return None
+        value = items.popleft()
+        self._cleanup(client, key)
+        return value
+
+    def cmd_llen(self, client, key):
+        return len(self._list(client, key) or ())
+
+    def cmd_lrange(self, client, key, start, stop):
+        items = list(self._list(client, key) or ())
+        start, stop = int(start), int(stop)
+        stop = len(items) if stop == -1 else stop + 1
+        return items[start:stop]
+
+    def cmd_brpop(self, client, *args):
+        keys, timeout = args[:-1], float(args[-1])
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            for key in keys:
+                items = self._list(client, key)
+                if items:
+                    value = items.pop()
+                    self._cleanup(client, key)
+                    return [key, value]
+            remaining = None if deadline is None else deadline - time.time()
+            if (remaining is not None and remaining <= 0) or self.server is None:
+                return NIL_ARRAY
+            self.lock.wait(remaining)
+
+    # sets
+
+    def cmd_sadd(self, client, key, *members):
+        db = self.db(client)
+        value = db.get(key)
+        if value is None:
+            value = set()
+            db.set(key, value)
+        before = len(value)
+        value.update(members)
+        return len(value) - before
+
+    def cmd_srem(self, client, key, *members):
+        value = self.db(client).get(key) or set()
+        before = len(value)
+        value.difference_update(members)
+        self._cleanup(client, key)
+        return before - len(value)
+
+    def cmd_smembers(self, client, key):
+        return sorted(self.db(client).get(key) or ())
+
+    # hashes
+
+    def cmd_hset(self, client, key, *pairs):
+        db = self.db(client)
+        value = db.get(key)
+        if value is None:
+            value = {}
+            db.set(key, value)
+        added = 0
+        for field, field_value in zip(pairs[::2], pairs[1::2]):
+            added += field not in value
+            value[field] = field_value
+        return added
+
+    def cmd_hget(self, client, key, field):
+        return (self.db(client).get(key) or {}).get(field)
+
+    def cmd_hdel(self, client, key, *fields):
+        value = self.db(client).get(key) or {}
+        deleted = sum(value.pop(field, None) is not None for field in fields)
+        self._cleanup(client, key)
+        return deleted
+
+    def cmd_hgetall(self, client, key):
+        value = self.db(client).get(key) or {}
+        return [i for pair in value.items() for i in pair]
+
+    # sorted sets
+
+    def cmd_zadd(self, client, key, *args):
+        db = self.db(client)
+        value = db.get(key)
+        if value is None:
+            value = {}
+            db.set(key, value)
+        args = [i for i in args if i.upper() not in (b'NX', b'XX', b'CH', b'GT', b'LT')]
+        added = 0
+        for score, member in zip(args[::2], args[1::2]):
+            added += member not in value
+            value[member] = float(score)
+        return added
+
+    def cmd_zrem(self, client, key, *members):
+        value = self.db(client).get(key) or {}
+        removed = sum(value.pop(member, None) is not None for member in members)
+        self._cleanup(client, key)
+        return removed
+
+    def cmd_zcard(self, client, key):
+        return len(self.db(client).get(key) or {})
+
+    def _score(self, value, default):
+        value = value.lstrip(b'(')
+        if value in (b'+inf', b'inf'):
+            return float('inf')
+        if value == b'-inf':
+            return float('-inf')
+        return float(value)
+
+    def cmd_zrevrangebyscore(self, client, key, maximum, minimum, *options):
+        value = self.db(client).get(key) or {}
+        maximum, minimum = self._score(maximum, 0), self._score(minimum, 0)
+        items = sorted(
+            ((member, score) for member, score in value.items() if minimum <= score <= maximum),
+            key=lambda i: i[1], reverse=True,
+        )
+        options = [i.upper() for i in options]
+        if b'LIMIT' in options:
+            i = options.index(b'LIMIT')
+            offset, count = int(options[i + 1]), int(options[i + 2])
+            items = items[offset:offset + count if count >= 0 else None]
+        if b'WITHSCORES' in options:
+            return [j for member, score in items for j in (member, repr(score))]
+        return [member for member, score in items]
+
+    # scripting
+
+    def cmd_script(self, client, subcommand, *args):
+        if subcommand.lower() == b'load':
+            sha = hashlib.sha1(args[0]).hexdigest()
+            self.scripts[sha.encode('utf-8')] = args[0]
+            return sha
+        if subcommand.lower() == b'exists':
+            return [int(sha in self.scripts) for sha in args]
+        return OK
+
+    def cmd_evalsha(self, client, sha, numkeys, *args):
+        if sha not in self.scripts:
+            raise Error('NOSCRIPT No matching script. Please use EVAL.')
+        return self.cmd_eval(client, self.scripts[sha], numkeys, *args)
+
+    def cmd_eval(self, client, script, numkeys, *args):
+        keys, argv = args[:int(numkeys)], args[int(numkeys):]
+        db = self.db(client)
+        # only redis-py lock scripts are supported
+        if b"redis.call('del'" in script or b'redis.call("del"' in script:
+            if db.get(keys[0]) == argv[0]:
+                db.delete(keys[0])
+                return 1
+            return 0
+        if b'pexpire' in script:
+            if db.get(keys[0]) != argv[0]:
+                return 0
+            return self.cmd_pexpire(client, keys[0], argv[-1])
+        raise Error('ERR unsupported script')
+
+
+class FakeSentinelServer(BaseServer):
+    """
+    In-process redis sentinel stand-in
+
+    Parameters
+    ----------
+    masters : dict
+        Mapping of service names to master ``(host, port)`` addresses
+    replicas : dict, optional
+        Mapping of service names to list of replica ``(host, port)`` addresses
+    """
+
+    def __init__(self, masters, replicas=None, *args, **kwargs):
+        super(FakeSentinelServer, self).__init__(*args, **kwargs)
+        self.masters = dict(masters)
+        self.replicas = dict(replicas or {})
+
+    def switch_master(self, service_name, address):
+        """
+        Switch master of the service and announce ``+switch-master``
+        """
+        old = self.masters[service_name]
+        self.masters[service_name] = tuple(address)
+        self.publish(b'+switch-master', '{} {} {} {} {}'.format(
+            service_name, old[0], old[1], address[0], address[1],
+        ).encode('utf-8'))
+
+    def _state(self, name, address, flags):
+        return [
+            'name', name,
+            'ip', address[0],
+            'port', str(address[1]),
+            'flags', flags,
+            'num-other-sentinels', '2',
+            'quorum', '2',
+            'master-link-status', 'ok',
+            'master-link-down-time', '0',
+        ]
+
+    def cmd_sentinel(self, client, subcommand, *args):
+        subcommand = subcommand.lower()
+        if subcommand == b'masters':
+            return [self._state(name, address, 'master') for name, address in self.masters.items()]
+        if subcommand == b'master':
+            name = args[0].decode('utf-8')
+            return self._state(name, self.masters[name], 'master')
+        if subcommand == b'get-master-addr-by-name':
+            address = self.masters.get(args[0].decode('utf-8'))
+            return None if address is None else [address[0], str(address[1])]
+        if subcommand in (b'slaves', b'replicas'):
+            name = args[0].decode('utf-8')
+            return [self._state(name, address, 'slave') for address in self.replicas.get(name, [])]
+        if subcommand == b'sentinels':
+            return []
+        raise Error('ERR unknown sentinel subcommand')
+
+
+class FakeCluster(object):
+    """
+    Redis master with any number of sentinels monitoring it
+
+    Can be used as a context manager which starts and stops all servers.
+
+    Parameters
+    ----------
+    service_name : str, optional
+        Name of the sentinel service. By default ``'master'``.
+    num_sentinels : int, optional
+        Number of sentinel servers. By default ``3``.
+    """
+
+    def __init__(self, service_name='master', num_sentinels=3):
+        self.service_name = service_name
+        self.master = FakeRedisServer()
+        self.sentinel_servers = [
+            FakeSentinelServer({}) for _ in six.moves.range(num_sentinels)
+        ]
+
+    @property
+    def sentinels(self):
+        """
+        Sentinel addresses in the format expected by transport options
+        """
+        return [i.address for i in self.sentinel_servers]
+
+    def start(self):
+        self.master.start()
+        for sentinel in self.sentinel_servers:
+            sentinel.masters[self.service_name] = self.master.address
+            sentinel.start()
+        return self
+
+    def stop(self):
+        for server in self.sentinel_servers + [self.master]:
+            server.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio counterparts of :mod:`celery_redis_sentinel.redis_sentinel` helpers.
+
+Instead of blocking with ``time.sleep`` between retries, helpers in this module
+wait with ``asyncio.sleep`` so that a coroutine waiting for sentinel failover
+to complete does not block any other coroutines running in the same event loop.
+
+.. note::
+    This module requires Python 3.5+ and ``redis`` with ``redis.asyncio``
+    support (``redis>=4.2``) hence it is not imported by default.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import asyncio
+import functools
+import inspect
+import logging
+
+from redis.asyncio import StrictRedis
+from redis.asyncio.sentinel import Sentinel, SentinelConnectionPool
+
+from .metrics import COMMAND_LATENCY, RETRIES, RETRIES_EXHAUSTED, get_metrics, timer
+from .retry import RetryPolicy
+from .utils import truncated_repr
+
+
+logger = logging.getLogger(__name__)
+
+
+async def ensure_redis_call(f, *args, **kwargs):
+    """
+    Same as :func:`celery_redis_sentinel.redis_sentinel.ensure_redis_call`
+    except it waits between retries without blocking the event loop.
+
+    ``f`` can either be a coroutine function or any callable returning an awaitable
+    in which case the awaitable is awaited. Regular callables are supported as well
+    however they are executed in a blocking fashion.
+
+    Parameters
+    ----------
+    f : callable
+        The callable to be executed
+    attempts : int, optional
+        Number of attempts to make with exponential ease-off.
+        By default ``attempts`` of the retry policy is used which is ``5`` by default.
+    redis_retry_policy : RetryPolicy, dict, optional
+        Retry policy or its parameters.
+        By default :data:`DEFAULT_RETRY_POLICY <celery_redis_sentinel.retry.DEFAULT_RETRY_POLICY>`.
+    args : tuple
+        Any arguments to be passed to ``f`` when calling it
+    kwargs : dict
+        Any keyword arguments to be passed to ``f`` when calling it
+    """
+    policy = RetryPolicy.from_options(kwargs.pop('redis_retry_policy', None))
+    attempts = kwargs.pop('attempts', policy.attempts)
+    start = timer()
+
+    for i in range(attempts + 1):
+        try:
+            result = f(*args, **kwargs)
+            if inspect.isawaitable(result):
+                result = await result
+            return result
+
+        except policy.exceptions as e:
+            elapsed = timer() - start
+            if i == attempts or (policy.deadline is not None and elapsed >= policy.deadline):
+                get_metrics().increment(RETRIES_EXHAUSTED)
+                logger.error(
+                    'Giving up executing %s with args=%s kwargs=%s after %s retries due to exception %s: %s',
+                    f, truncated_repr(args), truncated_repr(kwargs), i, type(e).__name__, e,
+                )
+                raise
+            else:
+                get_metrics().increment(RETRIES)
+                wait = policy.wait(i)
+                if policy.deadline is not None:
+                    wait = max(min(wait, policy.deadline - elapsed), 0)
+                logger.warning(
+                    'Will reattempt to execute %s with args=%s kwargs=%s after %.2f seconds due to exception %s: %s',
+                    f, truncated_repr(args), truncated_repr(kwargs), wait, type(e).__name__, e,
+                )
+                await asyncio.sleep(wait)
+
+
+async def apply_async(task, *args, **kwargs):
+    """
+    Schedule celery task with retry-logic without blocking the event loop.
+
+    Celery publishing is blocking so ``task.apply_async`` is executed in the
+    default executor of the running event loop and retried with
+    :func:`ensure_redis_call` when failover is in progress.
+
+    Examples
+    --------
+
+    ::
+
+        result = await apply_async(add, (1, 2))
+
+    Parameters
+    ----------
+    task : celery.Task
+        Celery task to be scheduled
+    attempts : int, optional
+        Number of attempts to make with exponential ease-off.
+        By default ``attempts`` of the retry policy is used which is ``5`` by default.
+    redis_retry_policy : RetryPolicy, dict, optional
+        Retry policy or its parameters.
+        By default :data:`DEFAULT_RETRY_POLICY <celery_redis_sentinel.retry.DEFAULT_RETRY_POLICY>`.
+    args : tuple
+        Any arguments to be passed to ``task.apply_async``
+    kwargs : dict
+        Any keyword arguments to be passed to ``task.apply_async``
+    """
+    policy = RetryPolicy.from_options(kwargs.pop('redis_retry_policy', None))
+    attempts = kwargs.pop('attempts', policy.attempts)
+    loop = asyncio.get_event_loop()
+    f = functools.partial(task.apply_async, *args, **kwargs)
+    return await ensure_redis_call(
+        loop.run_in_executor, None, f,
+        attempts=attempts, redis_retry_policy=policy,
+    )
+
+
+class EnsuredRedisMixin(object):
+    """
+    Mixin to be used for ``redis.asyncio.Redis`` or its subclasses which uses
+    :func:`.ensure_redis_call` that each command is executed with
+    retry logic according to ``retry_policy``
+    (see :class:`RetryPolicy <celery_redis_sentinel.retry.RetryPolicy>`).
+    """
+    retry_policy = None
+
+    async def execute_command(self, *args, **options):
+        """
+        Same as super implementation except its wrapped with :meth:`ensure_redis_call`
+        """
+        _super = super(EnsuredRedisMixin, self).execute_command
+        metrics = get_metrics()
+        if not metrics.enabled:
+            return await ensure_redis_call(_super, *args, redis_retry_policy=self.retry_policy, **options)
+
+        start = timer()
+        try:
+            return await ensure_redis_call(_super, *args, redis_retry_policy=self.retry_policy, **options)
+        finally:
+            metrics.observe(COMMAND_LATENCY, timer() - start, command=args[0])
+
+
+class ShortLivedStrictRedis(StrictRedis):
+    """
+    asyncio equivalent of :class:`celery_redis_sentinel.redis_sentinel.ShortLivedStrictRedis`
+    which disconnects from redis after sending any command to redis.
+    """
+
+    async def execute_command(self, *args, **options):
+        """
+        In addition to executing redis command, this method closes the redis connection
+        """
+        try:
+            return await super(ShortLivedStrictRedis, self).execute_command(*args, **options)
+        finally:
+            await self.connection_pool.disconnect()
+
+
+class ShortLivedSentinel(Sentinel):
+    """
+    asyncio equivalent of :class:`celery_redis_sentinel.redis_sentinel.ShortLivedSentinel`
+    which uses :py:class:`.ShortLivedStrictRedis` to query sentinel for information.
+    """
+
+    def __init__(self, sentinels, *args, **kwargs):
+        super(ShortLivedSentinel, self).__init__(sentinels, *args, **kwargs)
+        self.sentinels = [
+            ShortLivedStrictRedis(host=hostname, port=port, **self.sentinel_kwargs)
+            for hostname, port in sentinels
+        ]
+
+
+def get_redis_via_sentinel(db,
+                           sentinels,
+                           service_name,
+                           socket_timeout=0.1,
+                           redis_class=StrictRedis,
+                           sentinel_class=ShortLivedSentinel,
+                           connection_pool_class=SentinelConnectionPool,
+                           **kwargs):
+    """
+    asyncio equivalent of :func:`celery_redis_sentinel.redis_sentinel.get_redis_via_sentinel`
+
+    Examples
+    --------
+
+    ::
+
+        redis = get_redis_via_sentinel(
+            db=0,
+            sentinels=[('192.168.1.1', 26379)],
+            service_name='master',
+            redis_class=type(str('Redis'), (EnsuredRedisMixin, StrictRedis), {}),
+        )
+        await redis.get('foo')
+
+    Returns
+    -------
+    redis.asyncio.Redis
+        ``redis.asyncio.Redis`` instance with sentinel connection pool.
+        Connection is established lazily on first command.
+    """
+    sentinel = sentinel_class(
+        sentinels,
+        socket_timeout=socket_timeout,
+    )
+    return sentinel.master_for(
+        service_name,
+        socket_timeout=socket_timeout,
+        db=db,
+        redis_class=redis_class,
+        connection_pool_class=connection_pool_class,
+    )
@@ -1,11 +1,148 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
+import select
+import threading
+import time
+from collections import OrderedDict
 
+import six
+from celery import states
+from celery.backends import redis as redis_backend
 from celery.backends.redis import RedisBackend
-from kombu.utils import cached_property
-from redis import Redis
+from celery.concurrency.prefork import TaskPool as PreforkPool
+from celery.exceptions import TimeoutError as CeleryTimeoutError
+from celery.signals import worker_process_init, worker_ready
+from celery.utils.log import get_logger
+from redis import ConnectionError, Redis, TimeoutError
 
-from .redis_sentinel import EnsuredRedisMixin, get_redis_via_sentinel
+from .compression import compress, decompress
+from .discovery import get_switch_master_listener
+from .redis_sentinel import (
+    TRANSACTION_IDEMPOTENT,
+    BlockingSentinelConnectionPool,
+    EnsuredRedisMixin,
+    PersistentSentinel,
+    get_redis_via_sentinel,
+    get_shared_connection_pool,
+    prefill_connection_pool,
+)
+from .retry import RetryPolicy
+from .sharding import HashRing
+from .subscriber import get_result_subscriber
+from .timeouts import AdaptiveTimeout
+from .utils import fork_aware_cached_property
+
+
+logger = get_logger(__name__)
+
+# celery < 4 polls results instead of consuming them via pub/sub
+ResultConsumer = getattr(redis_backend, 'ResultConsumer', None)
+
+if ResultConsumer is not None:
+    class ShardedResultConsumer(ResultConsumer):
+        """
+        Result consumer (celery 4+) which subscribes to results of tasks
+        on the master of the shard where their results are stored
+        when results are sharded via ``service_names``.
+
+        Results of ``service_name`` are consumed as usual.
+        For each of the other shards a consumer of its shard backend
+        is created on first use which shares pending results
+        with this consumer so that results consumed from any shard
+        resolve results waited for via this consumer.
+        :meth:`drain_events` then waits for messages of all subscriptions.
+        """
+        home = None
+
+        def __init__(self, *args, **kwargs):
+            super(ShardedResultConsumer, self).__init__(*args, **kwargs)
+            self.shard_consumers = {}
+
+        def _consumer_for(self, task_id):
+            if self.home is not None:
+                # consumer of a shard
+                return self
+            backend = self.backend.shard_backend(self._get_key_for_task(task_id))
+            if backend is self.backend:
+                return self
+            consumer = self.shard_consumers.get(backend.service_name)
+            if consumer is None:
+                consumer = type(self)(
+                    backend, self.app, self.accept,
+                    self._pending_results, self._pending_messages,
+                )
+                consumer.home = self
+                self.shard_consumers[backend.service_name] = consumer
+            return consumer
+
+        def consume_from(self, task_id):
+            consumer = self._consumer_for(task_id)
+            if consumer is not self:
+                return consumer.consume_from(task_id)
+            return super(ShardedResultConsumer, self).consume_from(task_id)
+
+        def cancel_for(self, task_id):
+            consumer = self._consumer_for(task_id)
+            if consumer is not self:
+                return consumer.cancel_for(task_id)
+            return super(ShardedResultConsumer, self).cancel_for(task_id)
+
+        def on_state_change(self, meta, message):
+            if self.home is not None:
+                return self.home.on_state_change(meta, message)
+            return super(ShardedResultConsumer, self).on_state_change(meta, message)
+
+        def on_after_fork(self):
+            for consumer in self.shard_consumers.values():
+                consumer.on_after_fork()
+            super(ShardedResultConsumer, self).on_after_fork()
+
+        def stop(self):
+            for consumer in self.shard_consumers.values():
+                consumer.stop()
+            super(ShardedResultConsumer, self).stop()
+
+        def drain_events(self, timeout=None):
+            consumers = [
+                i for i in [self] + list(self.shard_consumers.values())
+                if i._pubsub is not None
+            ]
+            if len(consumers) < 2:
+                return self._drain_events(consumers[0] if consumers else self, timeout)
+            self._wait_readable(consumers, timeout)
+            for consumer in consumers:
+                self._drain_events(consumer, 0)
+
+        def _drain_events(self, consumer, timeout):
+            if consumer is self:
+                return super(ShardedResultConsumer, self).drain_events(timeout)
+            return consumer.drain_events(timeout)
+
+        def _wait_readable(self, consumers, timeout):
+            socks = []
+            for consumer in consumers:
+                connection = consumer._pubsub.connection
+                if connection is None or connection._sock is None:
+                    continue
+                try:
+                    if connection.can_read(timeout=0):
+                        # message is already buffered
+                        return
+                except self._connection_errors:
+                    # reconnected while draining events
+                    return
+                socks.append(connection._sock)
+            if not socks:
+                if timeout:
+                    time.sleep(timeout)
+                return
+            try:
+                select.select(socks, [], [], timeout)
+            except (OSError, ValueError, select.error):
+                # socket was closed hence reading it fails
+                pass
+else:
+    ShardedResultConsumer = None
 
 
 class RedisSentinelBackend(RedisBackend):
@@ -25,7 +162,77 @@ class RedisSentinelBackend(RedisBackend):
                 'service_name': 'master',
                 'socket_timeout': 0.1,
             }
+
+        Optionally ``master_cache_ttl`` can be provided which enables caching
+        of discovered master address in the process-wide master address cache
+        for the given number of seconds. With ``shared_master_cache``
+        the cache is shared by all worker pool processes.
+        See :func:`share_master_address_cache
+        <celery_redis_sentinel.discovery.share_master_address_cache>`.
+        ``parallel_discovery`` can be set to ``True`` in order to query all
+        sentinels at once while discovering master in which case
+        ``discovery_quorum`` sentinels (by default ``1``) need to agree
+        on the master address.
+        When ``rank_sentinels`` is ``True``, sentinels are queried from the
+        healthiest one and repeatedly failing sentinels are skipped for
+        ``sentinel_cooldown`` seconds (by default ``30``).
+        When ``persistent_sentinels`` is ``True``, connections to sentinels
+        are kept open (see :class:`PersistentSentinel
+        <celery_redis_sentinel.redis_sentinel.PersistentSentinel>`) and checked
+        after being idle for ``sentinel_health_check_interval`` seconds
+        (by default ``30``).
+        ``retry_policy`` configures how commands are retried during failover
+        (see :class:`RetryPolicy <celery_redis_sentinel.retry.RetryPolicy>`).
+        ``transaction_retry_policy`` controls whether ``MULTI``/``EXEC``
+        pipelines are retried during failover. By default (``'idempotent'``)
+        only transactions consisting of idempotent commands (e.g. storing
+        a result with ``SET`` and ``EXPIRE``) are retried since e.g.
+        chord counters must not be incremented twice. Use ``'raise'``
+        to never retry transactions.
+        See
+        :class:`EnsuredPipelineMixin <celery_redis_sentinel.redis_sentinel.EnsuredPipelineMixin>`
+        for details.
+        ``mget_chunk_size`` controls how many keys are fetched by a single
+        ``MGET`` while fetching multiple results (e.g. ``ResultSet.join_native()``).
+        By default ``1000`` is used. See :meth:`mget` for details.
+        When ``read_from_replicas`` is ``True``, results are read from one
+        of the sentinel replicas (see :attr:`replica_client`) which takes
+        the polling load off the master. ``max_link_down_time`` can
+        additionally be provided in order to skip replicas whose replication
+        link to master is down for more than given number of seconds.
+        Note that replicas whose link is up are used even when they are
+        behind the master hence a result might not be replicated yet
+        in which case the task still appears pending.
+        ``max_connections`` limits the number of connections in the connection
+        pool. When ``blocking_pool`` is ``True``, commands wait for up to
+        ``pool_timeout`` seconds (by default ``20``) for a free connection
+        instead of failing once all connections are in use.
+        When ``prefill_connections`` is provided, that many connections
+        are opened in the background when the worker boots (in each child
+        process of prefork pool and in the worker process itself for
+        solo, threads, eventlet and gevent pools) and again
+        right after sentinel announces a master switch.
+        See :meth:`prefill_pool` for details.
+        When ``compression`` is provided (e.g. ``'zlib'`` or ``'lzma'``),
+        results larger than ``compression_threshold`` bytes (by default ``1024``)
+        are compressed before being stored. See :meth:`encode` for details.
+        When ``result_notifications`` is ``True``, :meth:`wait_for` waits for
+        results to be published instead of polling redis every ``interval``.
+        When ``service_names`` is provided, results are sharded across
+        masters of those sentinel services. See :meth:`shard_backend` for details.
+        ``socket_timeout`` applies to redis commands and, unless
+        ``sentinel_socket_timeout`` is provided, to sentinel queries.
+        Connecting to the master is limited by ``socket_connect_timeout``.
+        When ``adaptive_timeout`` is provided, command timeouts follow
+        observed command latencies. See :class:`AdaptiveTimeout
+        <celery_redis_sentinel.timeouts.AdaptiveTimeout>` for details.
+        When ``shared_pool`` is ``True``, :attr:`client` uses the process-wide
+        connection pool which is also used by the broker with the same option.
+        See :func:`get_shared_connection_pool
+        <celery_redis_sentinel.redis_sentinel.get_shared_connection_pool>` for details.
     """
+    # celery 4+
+    ResultConsumer = ShardedResultConsumer
 
     def __init__(self, transport_options=None, *args, **kwargs):
         super(RedisSentinelBackend, self).__init__(*args, **kwargs)
@@ -35,11 +242,54 @@ class RedisSentinelBackend(RedisBackend):
         self.sentinels = self.transport_options['sentinels']
         self.service_name = self.transport_options['service_name']
         self.socket_timeout = self.transport_options.get('socket_timeout', 0.1)
+        self.sentinel_socket_timeout = self.transport_options.get('sentinel_socket_timeout', self.socket_timeout)
+        self.socket_connect_timeout = self.transport_options.get('socket_connect_timeout')
+        self.adaptive_timeout = AdaptiveTimeout.from_options(
+            self.transport_options.get('adaptive_timeout'), self.socket_timeout,
+        )
+        self.master_cache_ttl = self.transport_options.get('master_cache_ttl')
+        self.parallel_discovery = self.transport_options.get('parallel_discovery', False)
+        self.discovery_quorum = self.transport_options.get('discovery_quorum', 1)
+        self.rank_sentinels = self.transport_options.get('rank_sentinels', False)
+        self.sentinel_cooldown = self.transport_options.get('sentinel_cooldown', 30)
+        self.persistent_sentinels = self.transport_options.get('persistent_sentinels', False)
+        self.sentinel_health_check_interval = self.transport_options.get('sentinel_health_check_interval', 30)
+        self.redis_retry_policy = RetryPolicy.from_options(self.transport_options.get('retry_policy'))
+        self.transaction_retry_policy = self.transport_options.get(
+            'transaction_retry_policy', TRANSACTION_IDEMPOTENT,
+        )
+        self.mget_chunk_size = self.transport_options.get('mget_chunk_size', 1000)
+        self.read_from_replicas = self.transport_options.get('read_from_replicas', False)
+        self.max_link_down_time = self.transport_options.get('max_link_down_time')
+        self.max_connections = self.transport_options.get('max_connections', self.max_connections)
+        self.blocking_pool = self.transport_options.get('blocking_pool', False)
+        self.pool_timeout = self.transport_options.get('pool_timeout', 20)
+        self.prefill_connections = self.transport_options.get('prefill_connections', 0)
+        self.compression = self.transport_options.get('compression')
+        self.compression_threshold = self.transport_options.get('compression_threshold', 1024)
+        self.result_notifications = self.transport_options.get('result_notifications', False)
+        self.service_names = self.transport_options.get('service_names')
+        self.shared_pool = self.transport_options.get('shared_pool', False)
 
-    @cached_property
+        self.shard_ring = None
+        self.shard_backends = {}
+        if self.service_names:
+            self.shard_ring = HashRing(self.service_names)
+            self.shard_backends = dict(
+                (i, self._create_shard_backend(i))
+                for i in self.service_names if i != self.service_name
+            )
+
+        if self.prefill_connections:
+            worker_process_init.connect(self._on_worker_boot)
+            worker_ready.connect(self._on_worker_ready)
+
+    @fork_aware_cached_property
     def client(self):
         """
         Cached property for getting ``Redis`` client to be used to interact with redis.
+        The client is created again after ``fork`` so that processes
+        never share sockets.
 
         Returned client also subclasses from :class:`.EnsuredRedisMixin` which
         ensures that all redis commands are executed with retry logic in case
@@ -50,13 +300,336 @@ class RedisSentinelBackend(RedisBackend):
         Redis
             Redis client connected to Sentinel via Sentinel connection pool
         """
+        redis_class = type(str('Redis'), (EnsuredRedisMixin, Redis), {
+            'transaction_retry_policy': self.transaction_retry_policy,
+            'retry_policy': self.redis_retry_policy,
+        })
+        if self.shared_pool:
+            return redis_class(connection_pool=get_shared_connection_pool(**self._sentinel_params()))
+        return get_redis_via_sentinel(redis_class=redis_class, **self._sentinel_params())
+
+    @fork_aware_cached_property
+    def replica_client(self):
+        """
+        Cached property for getting ``Redis`` client connected to one of the
+        sentinel replicas which is used for reading results
+        when ``read_from_replicas`` is enabled.
+
+        Unlike :attr:`client`, commands are not retried. Instead when
+        replica is not reachable, reads fall back to :attr:`client`.
+        See :meth:`_read`.
+
+        Returns
+        -------
+        Redis
+            Redis client connected to Sentinel replica via Sentinel connection pool
+        """
+        return get_redis_via_sentinel(
+            redis_class=Redis,
+            replica=True,
+            max_link_down_time=self.max_link_down_time,
+            **self._sentinel_params()
+        )
+
+    def _sentinel_params(self):
         params = self.connparams
         params.update({
             'sentinels': self.sentinels,
             'service_name': self.service_name,
             'socket_timeout': self.socket_timeout,
+            'master_cache_ttl': self.master_cache_ttl,
+            'parallel_discovery': self.parallel_discovery,
+            'discovery_quorum': self.discovery_quorum,
+            'max_connections': self.max_connections,
+            'sentinel_socket_timeout': self.sentinel_socket_timeout,
+            'adaptive_timeout': self.adaptive_timeout,
         })
-        return get_redis_via_sentinel(
-            redis_class=type(str('Redis'), (EnsuredRedisMixin, Redis), {}),
-            **params
+        if self.socket_connect_timeout is not None:
+            params['socket_connect_timeout'] = self.socket_connect_timeout
+        if self.rank_sentinels:
+            params.update({
+                'rank_sentinels': self.rank_sentinels,
+                'sentinel_cooldown': self.sentinel_cooldown,
+            })
+        if self.persistent_sentinels:
+            params.update({
+                'sentinel_class': PersistentSentinel,
+                'sentinel_health_check_interval': self.sentinel_health_check_interval,
+            })
+        if self.blocking_pool:
+            params.update({
+                'connection_pool_class': BlockingSentinelConnectionPool,
+                'pool_timeout': self.pool_timeout,
+            })
+        return params
+
+    def _create_shard_backend(self, service_name):
+        transport_options = dict(self.transport_options, service_name=service_name)
+        transport_options.pop('service_names')
+        return type(self)(app=self.app, url=self.url, transport_options=transport_options)
+
+    def _shard_id(self, key):
+        for prefix in (self.task_keyprefix, self.group_keyprefix, self.chord_keyprefix):
+            if key.startswith(prefix):
+                return key[len(prefix):]
+        return key
+
+    def shard_backend(self, key):
+        """
+        Get backend of the shard (sentinel service) the key belongs to.
+
+        When ``service_names`` transport option is provided, keys are spread
+        across masters of those sentinel services by hashing the task
+        (or group) id with consistent hashing hence all reads and writes
+        of a single task go to the same master.
+        Keys of ``service_name`` are handled by this backend. For each of the
+        other services a backend is created with the same transport options
+        so that each shard has its own cached client, connection pool
+        prefilling and failover handling.
+
+        Celery versions which consume results via pub/sub (celery 4+)
+        subscribe to each result on the master of its shard.
+        See :class:`.ShardedResultConsumer` for details.
+
+        .. note::
+            Chord join lists are accessed by celery directly via :attr:`client`
+            hence they are always stored in ``service_name``.
+
+        Parameters
+        ----------
+        key : str, bytes
+            Key such as ``celery-task-meta-<task_id>``
+
+        Returns
+        -------
+        RedisSentinelBackend
+            This backend or backend of the shard
+        """
+        if self.shard_ring is None:
+            return self
+        service_name = self.shard_ring.get_node(self._shard_id(key))
+        return self.shard_backends.get(service_name, self)
+
+    def prefill_pool(self):
+        """
+        Open ``prefill_connections`` connections to master in a background thread
+        so that first commands do not pay master discovery and TCP connect cost.
+
+        This is called automatically when the worker boots and after sentinel
+        announces ``+switch-master`` when ``prefill_connections`` is provided.
+        Prefork pool is prefilled in each child process on ``worker_process_init``
+        since children do not use connections of the parent process.
+        Other pools (solo, threads, eventlet and gevent) execute tasks in the
+        worker process itself so it is prefilled on ``worker_ready``.
+
+        Returns
+        -------
+        threading.Thread
+            Started daemon thread
+        """
+        pool = self.client.connection_pool
+
+        def prefill():
+            try:
+                prefill_connection_pool(pool, self.prefill_connections)
+            except (ConnectionError, TimeoutError) as e:
+                logger.warning('Could not prefill connection pool: %r', e)
+
+        thread = threading.Thread(target=prefill, name='celery-redis-sentinel-prefill')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _on_worker_boot(self, **kwargs):
+        listener = get_switch_master_listener(
+            self.sentinels, self.service_name,
+            socket_timeout=self.sentinel_socket_timeout,
+        )
+        listener.add_callback(self._on_switch_master)
+        self.prefill_pool()
+
+    def _on_worker_ready(self, sender=None, **kwargs):
+        # prefork parent process does not execute tasks hence prefilling it
+        # would only hold idle connections. children prefill on worker_process_init
+        if isinstance(getattr(sender, 'pool', None), PreforkPool):
+            return
+        self._on_worker_boot(sender=sender, **kwargs)
+
+    def _on_switch_master(self, old_address, new_address):
+        # connections to the old master are useless so they are closed
+        # and new ones are opened to the new master right away
+        self.client.connection_pool.disconnect()
+        self.prefill_pool()
+
+    @property
+    def result_subscriber(self):
+        """
+        Process-wide :class:`ResultSubscriber <celery_redis_sentinel.subscriber.ResultSubscriber>`
+        shared by all backends connected to the same sentinel service and db
+
+        Returns
+        -------
+        ResultSubscriber
+        """
+        key = (
+            tuple(tuple(i) for i in self.sentinels),
+            self.service_name,
+            self.connparams.get('db'),
         )
+        return get_result_subscriber(
+            key,
+            lambda: get_redis_via_sentinel(redis_class=Redis, **self._sentinel_params()),
+            sentinels=self.sentinels,
+            service_name=self.service_name,
+            socket_timeout=self.sentinel_socket_timeout,
+        )
+
+    def wait_for(self, task_id, timeout=None, interval=0.5, no_ack=True, on_interval=None):
+        """
+        Same as super implementation except when ``result_notifications``
+        is enabled, results are not polled. Instead the caller blocks until
+        the result is published by the worker (which happens every time
+        the result is stored).
+
+        All callers within the process share a single subscription
+        (see :attr:`result_subscriber`) which is established again
+        on the new master after failover. Results are read directly
+        each time the subscription is (re)established so results stored
+        while the subscription was not active are not missed.
+        """
+        backend = self.shard_backend(self.get_key_for_task(task_id))
+        if backend is not self:
+            return backend.wait_for(
+                task_id, timeout=timeout, interval=interval,
+                no_ack=no_ack, on_interval=on_interval,
+            )
+
+        if not self.result_notifications:
+            return super(RedisSentinelBackend, self).wait_for(
+                task_id, timeout=timeout, interval=interval,
+                no_ack=no_ack, on_interval=on_interval,
+            )
+
+        def check(payload):
+            if payload is None:
+                meta = self.get_task_meta(task_id)
+            else:
+                meta = self.decode_result(payload)
+            if meta['status'] in states.READY_STATES:
+                return meta
+
+        meta = self.result_subscriber.wait(
+            self.get_key_for_task(task_id), check,
+            timeout=timeout, interval=interval, on_interval=on_interval,
+        )
+        if meta is None:
+            raise CeleryTimeoutError('The operation timed out.')
+        return meta
+
+    def encode(self, data):
+        """
+        Same as super implementation except when ``compression`` is enabled,
+        payloads of at least ``compression_threshold`` bytes are compressed.
+
+        Compressed payloads are prefixed with a header byte which identifies
+        the compressor so :meth:`decode` can read both compressed and
+        uncompressed payloads regardless of the current ``compression``.
+        See :mod:`celery_redis_sentinel.compression` for details.
+        """
+        payload = super(RedisSentinelBackend, self).encode(data)
+        if not self.compression:
+            return payload
+        return compress(payload, self.compression, self.compression_threshold)
+
+    def decode(self, payload):
+        """
+        Same as super implementation except compressed payloads
+        are decompressed first
+        """
+        return super(RedisSentinelBackend, self).decode(decompress(payload))
+
+    def _read(self, command, *args):
+        """
+        Execute read-only command on replica when ``read_from_replicas``
+        is enabled with fallback to master
+        """
+        if self.read_from_replicas:
+            try:
+                return getattr(self.replica_client, command)(*args)
+            except (ConnectionError, TimeoutError):
+                pass
+        return getattr(self.client, command)(*args)
+
+    def get(self, key):
+        backend = self.shard_backend(key)
+        if backend is not self:
+            return backend.get(key)
+        return self._read('get', key)
+
+    def _set(self, key, value):
+        backend = self.shard_backend(key)
+        if backend is not self:
+            return backend._set(key, value)
+        return super(RedisSentinelBackend, self)._set(key, value)
+
+    def delete(self, key):
+        backend = self.shard_backend(key)
+        if backend is not self:
+            return backend.delete(key)
+        return super(RedisSentinelBackend, self).delete(key)
+
+    def incr(self, key):
+        backend = self.shard_backend(key)
+        if backend is not self:
+            return backend.incr(key)
+        return super(RedisSentinelBackend, self).incr(key)
+
+    def expire(self, key, value):
+        backend = self.shard_backend(key)
+        if backend is not self:
+            return backend.expire(key, value)
+        return super(RedisSentinelBackend, self).expire(key, value)
+
+    def mget(self, keys):
+        """
+        Get values of multiple keys by using ``MGET`` in chunks of ``mget_chunk_size`` keys.
+
+        Since each ``MGET`` is retried by the :attr:`client` independently,
+        failover in the middle of the batch only retries the chunks
+        which were not fetched yet.
+        When results are sharded, keys of each shard are fetched
+        from their own shard.
+
+        Parameters
+        ----------
+        keys : list
+            Keys to get values of
+
+        Returns
+        -------
+        list
+            Values in the same order as ``keys``
+        """
+        keys = list(keys)
+        if self.shard_ring is None:
+            return self._mget(keys)
+
+        shards = OrderedDict()
+        for index, key in enumerate(keys):
+            shards.setdefault(self.shard_backend(key), []).append(index)
+
+        values = [None] * len(keys)
+        for backend, indexes in shards.items():
+            shard_values = backend._mget([keys[i] for i in indexes])
+            for index, value in zip(indexes, shard_values):
+                values[index] = value
+        return values
+
+    def _mget(self, keys):
+        if not self.mget_chunk_size:
+            return self._read('mget', keys)
+
+        values = []
+        for i in six.moves.range(0, len(keys), self.mget_chunk_size):
+            values.extend(self._read('mget', keys[i:i + self.mget_chunk_size]))
+        return values
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide breaker which coordinates retries of
+:func:`ensure_redis_call <celery_redis_sentinel.redis_sentinel.ensure_redis_call>`
+during sentinel failover.
+
+Without coordination, every thread (or greenlet) retries on its own schedule
+hence once new master is elected it is hit by all retries at once.
+Instead, first call which fails trips the breaker and becomes the recovery
+probe which retries with the usual exponential ease-off. All other calls
+to the same target (including new ones) wait for the probe instead of retrying
+on their own. As soon as the probe succeeds (or gives up), waiting calls
+are released with random jitter so that they are spread out over
+:attr:`RecoveryBreaker.jitter` seconds.
+
+Probes are tracked per target (see :func:`get_breaker_target`) hence while
+one master is down, calls to other masters (e.g. other shards) are not delayed.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import random
+import threading
+
+from six.moves import _thread
+
+from .metrics import timer
+
+
+def get_breaker_target(connection_pool):
+    """
+    Get target of :class:`.RecoveryBreaker` probes for the given connection pool
+
+    Sentinel connection pools of the same sentinels, service and db share
+    the target since they connect to the same master.
+    Any other connection pool is a target of its own.
+
+    Parameters
+    ----------
+    connection_pool : ConnectionPool, None
+        Connection pool of the redis client
+
+    Returns
+    -------
+    object, None
+        Hashable target or ``None`` when connection pool is not known
+    """
+    if connection_pool is None:
+        return None
+    service_name = getattr(connection_pool, 'service_name', None)
+    if service_name is None:
+        return connection_pool
+    manager = getattr(connection_pool, 'sentinel_manager', None)
+    sentinels = getattr(manager, 'sentinel_addresses', None)
+    if sentinels is not None:
+        sentinels = tuple(tuple(i) for i in sentinels)
+    return sentinels or manager, service_name, connection_pool.connection_kwargs.get('db')
+
+
+class RecoveryBreaker(object):
+    """
+    Breaker shared by all callers retrying redis calls within the process.
+
+    The breaker is open for a target while a recovery probe of that target
+    is in progress. Calls to other targets are not affected. Probe is owned
+    by the thread (or greenlet) which tripped the breaker so that nested
+    calls made by the probe itself never wait for the probe.
+    Calls without a known target share the ``None`` target.
+
+    Parameters
+    ----------
+    jitter : float, optional
+        Maximum number of seconds released callers wait before retrying.
+        By default ``1``.
+    """
+
+    def __init__(self, jitter=1.0):
+        self.jitter = jitter
+        self.probers = {}
+        self._cond = threading.Condition(threading.Lock())
+
+    @property
+    def open(self):
+        """
+        Whether recovery probe of any target is in progress
+        """
+        return bool(self.probers)
+
+    def is_open(self, target=None):
+        """
+        Whether recovery probe of the given target is in progress
+        """
+        return target in self.probers
+
+    def blocked(self, target=None):
+        """
+        Whether current caller should wait for recovery probe
+        of the target by another caller
+        """
+        prober = self.probers.get(target)
+        return prober is not None and prober[0] != _thread.get_ident()
+
+    def trip(self, target=None):
+        """
+        Open the breaker for the target unless it is already open
+
+        Parameters
+        ----------
+        target : object, optional
+            Target being probed as returned by :func:`get_breaker_target`
+
+        Returns
+        -------
+        object, None
+            Token which has to be passed to :meth:`release` once the probe
+            completes when the caller became the probe, ``None`` otherwise
+        """
+        with self._cond:
+            if target in self.probers:
+                return None
+            token = object()
+            self.probers[target] = (_thread.get_ident(), token)
+            return token
+
+    def release(self, token):
+        """
+        Close the breaker for the probed target and release all waiting callers
+
+        Parameters
+        ----------
+        token : object, None
+            Token returned by :meth:`trip`. Nothing is done for ``None``.
+        """
+        if token is None:
+            return
+        with self._cond:
+            for target, prober in list(self.probers.items()):
+                if prober[1] is token:
+                    del self.probers[target]
+                    self._cond.notify_all()
+
+    def wait(self, deadline, target=None):
+        """
+        Wait until recovery probe of the target by another caller completes
+
+        Parameters
+        ----------
+        deadline : float
+            :func:`timer <celery_redis_sentinel.metrics.timer>` value
+            after which the caller stops waiting
+        target : object, optional
+            Target the caller is about to call
+
+        Returns
+        -------
+        bool
+            Whether the caller had to wait
+        """
+        if not self.blocked(target):
+            return False
+        with self._cond:
+            while self.blocked(target):
+                remaining = deadline - timer()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+        return True
+
+    def backoff(self, deadline):
+        """
+        Get random number of seconds released caller should wait before retrying
+
+        Parameters
+        ----------
+        deadline : float
+            :func:`timer <celery_redis_sentinel.metrics.timer>` value
+            which the wait should not exceed
+        """
+        return max(min(random.uniform(0, self.jitter), deadline - timer()), 0)
+
+
+#: Process-wide :class:`.RecoveryBreaker` used by
+#: :func:`ensure_redis_call <celery_redis_sentinel.redis_sentinel.ensure_redis_call>`
+recovery_breaker = RecoveryBreaker()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Compression of values stored by :class:`RedisSentinelBackend
+<celery_redis_sentinel.backend.RedisSentinelBackend>`.
+
+Compressed values are prefixed with a single header byte which identifies
+the compressor. Serialized results (e.g. JSON, pickle or msgpack encoded
+result meta dicts) never start with any of the header bytes hence
+uncompressed values can still be read as is. That allows to enable,
+change or disable compression without losing access to existing results.
+
+``zlib`` is always available and ``lzma`` is available when the ``lzma``
+module can be imported (Python 3.3+). Additional compressors can be
+registered with :func:`register_compressor`.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import zlib
+
+import six
+
+
+try:
+    import lzma
+except ImportError:  # pragma: no cover
+    lzma = None
+
+
+_compressors = {}
+_decompressors = {}
+
+
+def register_compressor(name, header, compress, decompress):
+    """
+    Register compressor under the given name
+
+    Parameters
+    ----------
+    name : str
+        Name of the compressor which is used in ``compression``
+        results backend transport option
+    header : bytes
+        Single byte which prefixes values compressed by this compressor.
+        Should be a control character (e.g. ``b'\\x07'``) which cannot be
+        the first byte of any serialized result.
+    compress : callable
+        Function which compresses ``bytes``
+    decompress : callable
+        Function which decompresses ``bytes``
+    """
+    if len(header) != 1:
+        raise ValueError('Compression header must be a single byte')
+    for other, (other_header, _) in _compressors.items():
+        if other_header == header and other != name:
+            raise ValueError('Compression header {!r} is already used by {}'.format(header, other))
+    _compressors[name] = (header, compress)
+    _decompressors[header] = decompress
+
+
+register_compressor('zlib', b'\x01', zlib.compress, zlib.decompress)
+if lzma is not None:
+    register_compressor('lzma', b'\x02', lzma.compress, lzma.decompress)
+
+
+def compress(payload, name, threshold=0):
+    """
+    Compress payload with the given compressor
+
+    Payload is left uncompressed when it is shorter than ``threshold``
+    or when compression would not make it any smaller.
+
+    Parameters
+    ----------
+    payload : bytes, str
+        Serialized value. Text is encoded with ``utf-8`` before compressing.
+    name : str
+        Name of registered compressor
+    threshold : int, optional
+        Minimum payload size in bytes for it to be compressed
+
+    Returns
+    -------
+    bytes, str
+        Compressed payload prefixed with the compressor header byte
+        or the original payload
+    """
+    try:
+        header, compressor = _compressors[name]
+    except KeyError:
+        raise ValueError('Unknown compressor {!r}'.format(name))
+
+    data = payload.encode('utf-8') if isinstance(payload, six.text_type) else payload
+    if len(data) < threshold:
+        return payload
+    compressed = header + compressor(data)
+    if len(compressed) >= len(data):
+        return payload
+    return compressed
+
+
+def decompress(payload):
+    """
+    Decompress payload compressed by :func:`compress`
+
+    Payloads without a known header byte are returned as is.
+
+    Parameters
+    ----------
+    payload : bytes, str
+        Value as stored in redis
+
+    Returns
+    -------
+    bytes, str
+        Decompressed payload
+    """
+    if not isinstance(payload, six.binary_type) or not payload:
+        return payload
+    decompressor = _decompressors.get(payload[:1])
+    if decompressor is None:
+        return payload
+    return decompressor(payload[1:])
@@ -0,0 +1,630 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import logging
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import six
+from redis import ConnectionError, StrictRedis, TimeoutError
+
+from .metrics import MASTER_SWITCH, get_metrics
+
+
+logger = logging.getLogger(__name__)
+
+SWITCH_MASTER_CHANNEL = '+switch-master'
+
+
+def master_cache_key(sentinels, service_name):
+    """
+    Get hashable key which identifies the master of a sentinel service
+
+    Parameters
+    ----------
+    sentinels : list
+        List of tuples of all sentinel nodes within the sentinel cluster.
+    service_name : str
+        Name of the sentinel service_name.
+
+    Returns
+    -------
+    tuple
+        Key in format ``((sentinels, ...), service_name)``.
+    """
+    return tuple(tuple(i) for i in sentinels), service_name
+
+
+class SharedMemoryStore(object):
+    """
+    Storage of a single picklable object in a memory-mapped file
+    which is shared with all processes forked after the store is created.
+
+    The file is unlinked right away so only the mapping and the file descriptor
+    remain. Access from different processes is serialized with ``lockf``
+    locks which, unlike ``multiprocessing`` locks, are released by the OS
+    when a process holding them dies. Besides the data lock, the store provides
+    an independent :meth:`discovery_lock` which is meant to be held while
+    discovering master so that only a single process queries sentinels.
+
+    .. note::
+        This is only available on POSIX systems.
+
+    Parameters
+    ----------
+    size : int, optional
+        Size of the shared memory in bytes. By default ``64KiB``.
+    """
+    header = struct.Struct(str('!I'))
+
+    def __init__(self, size=64 * 1024):
+        import fcntl
+        self._fcntl = fcntl
+        self.size = size
+        self.fd, path = tempfile.mkstemp(prefix='celery-redis-sentinel-')
+        os.unlink(path)
+        os.ftruncate(self.fd, size)
+        self.mmap = mmap.mmap(self.fd, size)
+        self._reset_locks()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset_locks)
+
+    def _reset_locks(self):
+        # thread locks might have been held by other threads while forking
+        self._thread_locks = [threading.Lock(), threading.Lock()]
+
+    @contextmanager
+    def _locked(self, index):
+        # lockf locks are owned by the process so threads need their own lock
+        with self._thread_locks[index]:
+            self._fcntl.lockf(self.fd, self._fcntl.LOCK_EX, 1, index)
+            try:
+                yield
+            finally:
+                self._fcntl.lockf(self.fd, self._fcntl.LOCK_UN, 1, index)
+
+    def locked(self):
+        """
+        Context manager which holds data lock. Use it to make
+        :meth:`load` and :meth:`dump` atomic.
+        """
+        return self._locked(0)
+
+    def discovery_lock(self):
+        """
+        Context manager which holds the discovery lock
+        """
+        return self._locked(1)
+
+    def load(self, default=None):
+        """
+        Load stored object. Caller should hold :meth:`locked`.
+        """
+        length, = self.header.unpack_from(self.mmap, 0)
+        if not length:
+            return default
+        return pickle.loads(self.mmap[self.header.size:self.header.size + length])
+
+    def dump(self, obj):
+        """
+        Store object. Caller should hold :meth:`locked`.
+
+        Raises
+        ------
+        ValueError
+            When pickled object does not fit into the shared memory
+        """
+        data = pickle.dumps(obj, protocol=2)
+        if len(data) + self.header.size > self.size:
+            raise ValueError(
+                'Pickled object size {} exceeds shared memory size {}'
+                ''.format(len(data), self.size - self.header.size)
+            )
+        self.mmap[self.header.size:self.header.size + len(data)] = data
+        self.header.pack_into(self.mmap, 0, len(data))
+
+
+class MasterAddressCache(object):
+    """
+    Process-wide cache of master addresses discovered via sentinel.
+
+    Entries expire after the given TTL. In addition, once an entry is
+    stored, a :class:`.SwitchMasterListener` is started for the same
+    sentinel service which invalidates the entry as soon as sentinel
+    announces ``+switch-master`` for the service or as soon as the
+    listener loses its connection to sentinel (since in that case
+    a switch notification might be missed).
+
+    After :meth:`share` is called, entries are stored in
+    :class:`.SharedMemoryStore` hence they are shared by all processes
+    forked afterwards such as prefork worker children. Together with
+    :meth:`discovery_lock` that means a single discovery serves
+    the whole worker. Every process reading the cache has to :meth:`watch`
+    the service itself since listener threads are not shared.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._watched = {}
+        self._store = None
+        self._reset_locks()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset_locks)
+
+    def _reset_locks(self):
+        # locks might have been held by other threads (e.g. listener) while forking
+        self._lock = threading.Lock()
+        self._discovery_lock = threading.Lock()
+
+    @property
+    def shared(self):
+        """
+        Whether entries are shared with forked processes
+        """
+        return self._store is not None
+
+    def share(self, size=64 * 1024):
+        """
+        Move entries into shared memory so that they are shared with all
+        processes forked afterwards. Has to be called before forking.
+        Calling it again has no effect.
+
+        Parameters
+        ----------
+        size : int, optional
+            Size of the shared memory in bytes. By default ``64KiB``.
+        """
+        with self._lock:
+            if self._store is not None:
+                return
+            store = SharedMemoryStore(size)
+            with store.locked():
+                store.dump(self._entries)
+            self._store = store
+
+    @contextmanager
+    def _update(self):
+        with self._lock:
+            if self._store is None:
+                yield self._entries
+                return
+            with self._store.locked():
+                entries = self._store.load({})
+                yield entries
+                self._store.dump(entries)
+
+    def get(self, key):
+        """
+        Get cached master address
+
+        Returns
+        -------
+        tuple, None
+            Cached ``(host, port)`` or ``None`` when the entry is missing or expired
+        """
+        if self._store is None:
+            entry = self._entries.get(key)
+        else:
+            with self._store.locked():
+                entry = self._store.load({}).get(key)
+        if entry is None:
+            return None
+        address, expires = entry
+        if expires < time.time():
+            return None
+        return address
+
+    def set(self, key, address, ttl):
+        """
+        Cache master address for ``ttl`` seconds
+        """
+        with self._update() as entries:
+            entries[key] = (tuple(address), time.time() + ttl)
+
+    def invalidate(self, key=None):
+        """
+        Remove cached master address. When ``key`` is not given all entries are removed.
+        """
+        with self._update() as entries:
+            if key is None:
+                entries.clear()
+            else:
+                entries.pop(key, None)
+
+    @contextmanager
+    def discovery_lock(self):
+        """
+        Context manager which should be held while discovering master
+        in order to populate the cache so that concurrent cache misses
+        (from other threads or when shared, from other processes)
+        do not all query sentinels at the same time.
+        Cache should be checked again once the lock is acquired.
+        """
+        with self._discovery_lock:
+            if self._store is None:
+                yield
+            else:
+                with self._store.discovery_lock():
+                    yield
+
+    def watch(self, sentinels, service_name, **kwargs):
+        """
+        Make sure cached entry for the service is invalidated on ``+switch-master``
+
+        Parameters
+        ----------
+        sentinels : list
+            List of tuples of all sentinel nodes within the sentinel cluster.
+        service_name : str
+            Name of the sentinel service_name.
+        kwargs : dict
+            Any keyword arguments to be passed to :func:`.get_switch_master_listener`
+        """
+        key = master_cache_key(sentinels, service_name)
+        pid = os.getpid()
+        with self._lock:
+            # listener threads do not survive fork so forked process has to watch again
+            if self._watched.get(key) == pid:
+                return
+            self._watched[key] = pid
+        listener = get_switch_master_listener(sentinels, service_name, **kwargs)
+        listener.add_callback(lambda *args: self.invalidate(key), on_disconnect=True)
+
+
+master_address_cache = MasterAddressCache()
+
+
+def _transport_options(app):
+    for key in ('BROKER_TRANSPORT_OPTIONS', 'broker_transport_options',
+                'CELERY_RESULT_BACKEND_TRANSPORT_OPTIONS', 'result_backend_transport_options'):
+        yield app.conf.get(key) or {}
+
+
+def share_master_address_cache(sender=None, **kwargs):
+    """
+    Share :data:`master_address_cache` with processes forked afterwards
+    when broker or results backend transport options enable it
+    via ``shared_master_cache`` together with ``master_cache_ttl``::
+
+        BROKER_TRANSPORT_OPTIONS = {
+            ...
+            'master_cache_ttl': 60,
+            'shared_master_cache': True,
+        }
+
+    This is connected to celery ``worker_init`` signal by
+    :func:`register <celery_redis_sentinel.register.register>` which is sent
+    in the worker main process before pool processes are forked.
+    Sharing is skipped on platforms without ``fcntl``.
+
+    Parameters
+    ----------
+    sender : celery.apps.worker.Worker
+        Worker being initialized
+    """
+    app = getattr(sender, 'app', None)
+    if app is None or not any(
+        i.get('master_cache_ttl') and i.get('shared_master_cache')
+        for i in _transport_options(app)
+    ):
+        return
+    try:
+        master_address_cache.share()
+    except ImportError:
+        pass
+
+
+class SentinelHealth(object):
+    """
+    Process-wide health of sentinel nodes used to rank sentinels
+    during master discovery.
+
+    Latency and success rate of sentinel queries are tracked per sentinel
+    as exponentially weighted moving averages. Sentinels are ranked by
+    latency divided by success rate hence fast and reliable sentinels
+    are queried first. Sentinels which were never queried are ranked first
+    so that their health is learned.
+
+    Each sentinel also has a circuit breaker. After ``failure_threshold``
+    consecutive failures the circuit opens and the sentinel is skipped
+    for the given cooldown. Afterwards the sentinel is ranked first
+    regardless of its score so that the next discovery probes it
+    (half-open state). Successful probe closes the circuit while failed probe
+    keeps it open for another cooldown.
+
+    Parameters
+    ----------
+    alpha : float, optional
+        Weight of the latest query in moving averages. By default ``0.3``.
+    failure_threshold : int, optional
+        Number of consecutive failures after which the circuit opens.
+        By default ``2``.
+    """
+
+    def __init__(self, alpha=0.3, failure_threshold=2):
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self._stats = {}
+        self._reset_locks()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset_locks)
+
+    def _reset_locks(self):
+        self._lock = threading.Lock()
+
+    def record(self, address, latency, success):
+        """
+        Record result of a sentinel query
+
+        Parameters
+        ----------
+        address : tuple
+            Sentinel ``(host, port)``
+        latency : float
+            Number of seconds the query took (including failed queries)
+        success : bool
+            Whether sentinel replied
+        """
+        address = tuple(address)
+        with self._lock:
+            stats = self._stats.get(address)
+            if stats is None:
+                stats = self._stats[address] = {
+                    'latency': latency,
+                    'success': 1.0 if success else 0.0,
+                    'failures': 0,
+                    'opened': None,
+                }
+            else:
+                stats['latency'] += self.alpha * (latency - stats['latency'])
+                stats['success'] += self.alpha * (float(success) - stats['success'])
+            if success:
+                stats['failures'] = 0
+                stats['opened'] = None
+            else:
+                stats['failures'] += 1
+                if stats['failures'] >= self.failure_threshold:
+                    stats['opened'] = time.time()
+
+    def score(self, address):
+        """
+        Get expected cost of querying the sentinel. Lower is better.
+        """
+        stats = self._stats.get(tuple(address))
+        if stats is None:
+            return 0.0
+        return stats['latency'] / max(stats['success'], 0.01)
+
+    def rank(self, addresses, cooldown=30):
+        """
+        Rank sentinels from best to worst
+
+        Parameters
+        ----------
+        addresses : list
+            Sentinel ``(host, port)`` addresses
+        cooldown : float, optional
+            Number of seconds sentinels with open circuit are skipped for.
+            By default ``30``.
+
+        Returns
+        -------
+        tuple
+            ``(available, skipped)`` lists of addresses where ``available``
+            start with half-open sentinels followed by the rest sorted
+            by :meth:`score` and ``skipped`` are sentinels with
+            open circuit which should only be queried when all ``available``
+            sentinels fail
+        """
+        now = time.time()
+        half_open, available, skipped = [], [], []
+        with self._lock:
+            for address in addresses:
+                stats = self._stats.get(tuple(address))
+                if stats is None or stats['opened'] is None:
+                    available.append(address)
+                elif now - stats['opened'] >= cooldown:
+                    # half-open so only this discovery probes it for the next cooldown.
+                    # it goes first since its score still reflects the failures
+                    # and it would otherwise never be queried to recover
+                    stats['opened'] = now
+                    half_open.append(address)
+                else:
+                    skipped.append(address)
+        # sort is stable so configured order is kept for equally ranked sentinels
+        available.sort(key=self.score)
+        return half_open + available, skipped
+
+    def reset(self):
+        """
+        Forget health of all sentinels
+        """
+        with self._lock:
+            self._stats.clear()
+
+
+#: Process-wide :class:`.SentinelHealth` used by
+#: :class:`ShortLivedSentinel <celery_redis_sentinel.redis_sentinel.ShortLivedSentinel>`
+#: when ``rank_sentinels`` is enabled
+sentinel_health = SentinelHealth()
+
+
+class SwitchMasterListener(object):
+    """
+    Background listener of sentinel ``+switch-master`` notifications
+    for a single sentinel service.
+
+    The listener subscribes to the ``+switch-master`` channel of one of the
+    sentinels in a daemon thread. When the connection to that sentinel is lost,
+    the next sentinel is tried.
+
+    Registered callbacks are called with ``(old_address, new_address)``
+    when the service master is switched. Callbacks registered with
+    ``on_disconnect=True`` are additionally called with ``(None, None)``
+    whenever the listener loses its sentinel connection.
+
+    Parameters
+    ----------
+    sentinels : list
+        List of tuples of all sentinel nodes within the sentinel cluster.
+    service_name : str
+        Name of the sentinel service_name.
+    socket_timeout : float, optional
+        Timeout for establishing connection to sentinel.
+        By default ``0.1`` is used.
+    retry_interval : float, optional
+        Number of seconds to wait before trying next sentinel
+        after the connection to sentinel is lost.
+        By default ``1`` is used.
+    """
+
+    def __init__(self, sentinels, service_name, socket_timeout=0.1, retry_interval=1):
+        self.sentinels = [tuple(i) for i in sentinels]
+        self.service_name = service_name
+        self.socket_timeout = socket_timeout
+        self.retry_interval = retry_interval
+        self.callbacks = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add_callback(self, callback, on_disconnect=False):
+        """
+        Register callback to be called on ``+switch-master``
+        """
+        with self._lock:
+            self.callbacks.append((callback, on_disconnect))
+
+    def remove_callback(self, callback):
+        """
+        Unregister previously registered callback
+        """
+        with self._lock:
+            self.callbacks = [i for i in self.callbacks if i[0] != callback]
+
+    def start(self):
+        """
+        Start listening in a daemon thread unless already started
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self.run,
+                name='switch-master-listener-{}'.format(self.service_name),
+            )
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Signal the listener thread to stop
+        """
+        self._stopped.set()
+
+    def notify(self, old_address, new_address):
+        """
+        Call all registered callbacks
+        """
+        disconnected = old_address is None and new_address is None
+        for callback, on_disconnect in list(self.callbacks):
+            if disconnected and not on_disconnect:
+                continue
+            try:
+                callback(old_address, new_address)
+            except Exception:
+                logger.exception('Error in +switch-master callback %r', callback)
+
+    def handle_message(self, message):
+        """
+        Parse ``+switch-master`` message and notify callbacks if it is for our service.
+
+        Message data is in format ``<service_name> <old ip> <old port> <new ip> <new port>``.
+        """
+        data = message.get('data')
+        if isinstance(data, six.binary_type):
+            data = data.decode('utf-8')
+        try:
+            service_name, old_host, old_port, new_host, new_port = data.split()
+        except (AttributeError, ValueError):
+            return
+        if service_name != self.service_name:
+            return
+        get_metrics().mark(MASTER_SWITCH, service=service_name)
+        self.notify((old_host, int(old_port)), (new_host, int(new_port)))
+
+    def listen(self, host, port):
+        """
+        Listen for ``+switch-master`` on a single sentinel until connection is lost or stopped
+        """
+        sentinel = StrictRedis(
+            host, port,
+            socket_connect_timeout=self.socket_timeout,
+            socket_keepalive=True,
+        )
+        pubsub = sentinel.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(SWITCH_MASTER_CHANNEL)
+            while not self._stopped.is_set():
+                message = pubsub.get_message(timeout=1)
+                if message and message.get('type') == 'message':
+                    self.handle_message(message)
+        finally:
+            pubsub.close()
+
+    def run(self):
+        """
+        Listener thread main loop which keeps rotating between sentinels
+        """
+        while not self._stopped.is_set():
+            for host, port in self.sentinels:
+                if self._stopped.is_set():
+                    break
+                try:
+                    self.listen(host, port)
+                except (ConnectionError, TimeoutError) as e:
+                    logger.debug(
+                        'Lost +switch-master subscription to sentinel %s:%s: %s',
+                        host, port, e,
+                    )
+                    self.notify(None, None)
+                    self._stopped.wait(self.retry_interval)
+
+
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+
+def get_switch_master_listener(sentinels, service_name, **kwargs):
+    """
+    Get running process-wide :class:`.SwitchMasterListener` for the sentinel service
+
+    Listener is created and started on first use.
+
+    Parameters
+    ----------
+    sentinels : list
+        List of tuples of all sentinel nodes within the sentinel cluster.
+    service_name : str
+        Name of the sentinel service_name.
+    kwargs : dict
+        Any keyword arguments to be passed to :class:`.SwitchMasterListener`
+        when it is created.
+
+    Returns
+    -------
+    SwitchMasterListener
+    """
+    key = master_cache_key(sentinels, service_name)
+    with _listeners_lock:
+        listener = _listeners.get(key)
+        if listener is None:
+            listener = _listeners[key] = SwitchMasterListener(sentinels, service_name, **kwargs)
+    listener.start()
+    return listener
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Pluggable instrumentation of retries, master discovery and failover.
+
+By default all metrics are recorded by :class:`Metrics` which does nothing.
+To collect metrics, install different implementation with :func:`set_metrics`,
+for example the bundled :class:`PrometheusMetrics`::
+
+    from celery_redis_sentinel.metrics import PrometheusMetrics, set_metrics
+
+    metrics = PrometheusMetrics()
+    set_metrics(metrics)
+    metrics.serve(9100)
+
+Recorded metrics are:
+
+* :data:`RETRIES` - counter of retries made by ``ensure_redis_call``
+* :data:`RETRIES_EXHAUSTED` - counter of ``ensure_redis_call`` calls
+  which failed even after all attempts
+* :data:`DISCOVERY_LATENCY` - histogram of seconds spent querying sentinels
+  for master address (``service`` label)
+* :data:`COMMAND_LATENCY` - histogram of seconds redis commands executed via
+  ``EnsuredRedisMixin`` took including any retries (``command`` label)
+* :data:`MASTER_SWITCH` - gauge of seconds since the last master switch
+  was noticed (``service`` label)
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import threading
+import time
+from collections import defaultdict
+from timeit import default_timer
+
+import six
+
+
+RETRIES = 'celery_redis_sentinel_retries_total'
+RETRIES_EXHAUSTED = 'celery_redis_sentinel_retries_exhausted_total'
+DISCOVERY_LATENCY = 'celery_redis_sentinel_discovery_seconds'
+COMMAND_LATENCY = 'celery_redis_sentinel_command_seconds'
+MASTER_SWITCH = 'celery_redis_sentinel_seconds_since_master_switch'
+
+DESCRIPTIONS = {
+    RETRIES: 'Number of retries made while redis sentinel failover is in progress',
+    RETRIES_EXHAUSTED: 'Number of redis calls which failed after all retries',
+    DISCOVERY_LATENCY: 'Time spent discovering master address via sentinels',
+    COMMAND_LATENCY: 'Redis command latency including retries',
+    MASTER_SWITCH: 'Time since the last master switch was noticed',
+}
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+)
+
+timer = default_timer
+
+
+class Metrics(object):
+    """
+    No-op metrics which is used by default.
+
+    Subclasses should set ``enabled`` to ``True`` and implement
+    all recording methods. Instrumented code checks ``enabled``
+    before doing any measurements so disabled metrics
+    add only a single attribute lookup to hot paths.
+    """
+    enabled = False
+
+    def increment(self, name, value=1, **labels):
+        """
+        Increment counter
+        """
+
+    def observe(self, name, value, **labels):
+        """
+        Record observation in histogram
+        """
+
+    def mark(self, name, **labels):
+        """
+        Record that an event happened just now.
+        Exported as a gauge of seconds since the event.
+        """
+
+
+class PrometheusMetrics(Metrics):
+    """
+    Metrics which are kept in memory and exported in Prometheus text
+    exposition format by :meth:`render`.
+
+    Parameters
+    ----------
+    buckets : tuple, optional
+        Histogram bucket upper bounds in seconds.
+        By default :data:`DEFAULT_BUCKETS` are used.
+    """
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.marks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name, value=1, **labels):
+        with self._lock:
+            self.counters[self._key(name, labels)] += value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = histogram[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def mark(self, name, **labels):
+        with self._lock:
+            self.marks[self._key(name, labels)] = time.time()
+
+    @staticmethod
+    def _format_labels(labels, **extra):
+        labels = list(labels) + sorted(extra.items())
+        if not labels:
+            return ''
+        return '{{{}}}'.format(','.join(
+            '{}="{}"'.format(k, six.text_type(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for k, v in labels
+        ))
+
+    @staticmethod
+    def _format_value(value):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(float(value))
+
+    def _header(self, lines, name, kind):
+        lines.append('# HELP {} {}'.format(name, DESCRIPTIONS.get(name, name)))
+        lines.append('# TYPE {} {}'.format(name, kind))
+
+    def render(self):
+        """
+        Render all metrics in Prometheus text exposition format
+
+        Returns
+        -------
+        str
+            Metrics text
+        """
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self.histograms.items())
+            marks = sorted(self.marks.items())
+
+        lines = []
+        now = time.time()
+        seen = set()
+
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                self._header(lines, name, 'counter')
+            lines.append('{}{} {}'.format(name, self._format_labels(labels), self._format_value(value)))
+
+        for (name, labels), value in marks:
+            if name not in seen:
+                seen.add(name)
+                self._header(lines, name, 'gauge')
+            lines.append('{}{} {}'.format(name, self._format_labels(labels), self._format_value(now - value)))
+
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in seen:
+                seen.add(name)
+                self._header(lines, name, 'histogram')
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts + [count]):
+                lines.append('{}_bucket{} {}'.format(
+                    name, self._format_labels(labels, le=self._format_value(bound)), bucket_count,
+                ))
+            lines.append('{}_sum{} {}'.format(name, self._format_labels(labels), self._format_value(total)))
+            lines.append('{}_count{} {}'.format(name, self._format_labels(labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host=''):
+        """
+        Serve rendered metrics over HTTP in a daemon thread
+
+        Parameters
+        ----------
+        port : int
+            Port to listen on
+        host : str, optional
+            Address to bind to. By default all interfaces.
+
+        Returns
+        -------
+        BaseHTTPServer.HTTPServer
+            Running server which can be stopped with ``shutdown()``
+        """
+        metrics = self
+
+        class Handler(six.moves.BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(six.moves.socketserver.ThreadingMixIn, six.moves.BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        server = Server((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name='celery-redis-sentinel-metrics')
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    """
+    Get currently installed metrics
+
+    Returns
+    -------
+    Metrics
+        Installed metrics instance
+    """
+    return _metrics
+
+
+def set_metrics(metrics):
+    """
+    Install metrics instance which records all instrumented events
+
+    Parameters
+    ----------
+    metrics : Metrics
+        Metrics instance. Use ``Metrics()`` to disable metrics again.
+    """
+    global _metrics
+    _metrics = metrics
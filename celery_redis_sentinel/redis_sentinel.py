@@ -1,10 +1,67 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
+import logging
+import os
+import socket
+import threading
 import time
+from collections import Counter
 
 import six
-from redis import ConnectionError, StrictRedis, TimeoutError
-from redis.sentinel import Sentinel, SentinelConnectionPool
+from redis import BlockingConnectionPool, ConnectionError, StrictRedis, TimeoutError
+from redis.sentinel import (
+    MasterNotFoundError,
+    Sentinel,
+    SentinelConnectionPool,
+    SentinelManagedConnection,
+)
+
+from .breaker import get_breaker_target, recovery_breaker
+from .discovery import master_address_cache, master_cache_key, sentinel_health
+from .metrics import (
+    COMMAND_LATENCY,
+    DISCOVERY_LATENCY,
+    MASTER_SWITCH,
+    RETRIES,
+    RETRIES_EXHAUSTED,
+    get_metrics,
+    timer,
+)
+from .retry import RetryPolicy
+from .timeouts import AdaptiveTimeout, AdaptiveTimeoutConnectionMixin
+from .utils import truncated_repr
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Keyword arguments of :func:`get_redis_via_sentinel` which are passed to redis connections
+CONNECTION_OPTIONS = ('socket_connect_timeout', 'socket_keepalive', 'socket_keepalive_options')
+
+#: Retry whole ``MULTI``/``EXEC`` block when it fails due to connection errors
+TRANSACTION_RETRY = 'retry'
+#: Never retry ``MULTI``/``EXEC`` blocks since they might have been already applied
+TRANSACTION_RAISE = 'raise'
+#: Retry ``MULTI``/``EXEC`` blocks only when they consist either only of
+#: :data:`READ_ONLY_COMMANDS` or only of :data:`IDEMPOTENT_COMMANDS`
+TRANSACTION_IDEMPOTENT = 'idempotent'
+
+#: Commands which do not modify any data
+READ_ONLY_COMMANDS = frozenset((
+    'EXISTS', 'GET', 'HEXISTS', 'HGET', 'HGETALL', 'HKEYS', 'HLEN', 'HMGET',
+    'HVALS', 'LINDEX', 'LLEN', 'LRANGE', 'MGET', 'PTTL', 'SCARD', 'SISMEMBER',
+    'SMEMBERS', 'STRLEN', 'TTL', 'TYPE', 'ZCARD', 'ZRANGE', 'ZRANGEBYSCORE',
+    'ZREVRANGE', 'ZSCORE',
+))
+#: Writes which leave the same data when applied more than once.
+#: ``PUBLISH`` is included so that results stored by celery with
+#: ``SETEX`` and ``PUBLISH`` are retried. Subscribers might therefore
+#: receive the same result twice which celery handles gracefully.
+IDEMPOTENT_COMMANDS = frozenset((
+    'DEL', 'EXPIRE', 'EXPIREAT', 'HDEL', 'HMSET', 'HSET', 'MSET', 'PERSIST',
+    'PEXPIRE', 'PEXPIREAT', 'PSETEX', 'PUBLISH', 'SADD', 'SET', 'SETEX', 'SREM',
+    'UNLINK', 'ZREM',
+))
 
 
 def ensure_redis_call(f, *args, **kwargs):
@@ -13,17 +70,26 @@ def ensure_redis_call(f, *args, **kwargs):
     redis is timing out or is experiencing connection errors
     while redis sentinel failover is in progress.
 
-    The retries are attempted in exponential ease-off (1, 2, 4, ... sec).
+    By default the retries are attempted in exponential ease-off (1, 2, 4, ... sec).
+    That can be changed by providing ``redis_retry_policy``.
+    See :class:`RetryPolicy <celery_redis_sentinel.retry.RetryPolicy>` for details.
+
+    Retries of all calls to the same ``redis_target`` within the process
+    are coordinated via :data:`recovery_breaker <celery_redis_sentinel.breaker.recovery_breaker>`.
+    First failing call becomes the recovery probe and retries as described above
+    while other calls to the same target wait for the probe (up to the same total wait time)
+    instead of retrying on their own. Once the probe completes, they retry
+    after a random jitter so that new master is not hit by all of them at once.
 
     .. note::
         This helper is a blocking function. It waits between retries
         in a blocking fashion.
 
     .. note::
-        In between reties this function prints a helpful error message.
-        The reason why ``print`` is used rather then lets say a logger
-        is because celery has a configuration at what level ``stdout``
-        should be logged as - ``CELERY_REDIRECT_STDOUTS_LEVEL``
+        Retries are logged with ``celery_redis_sentinel.redis_sentinel``
+        logger. Arguments are only formatted when the message is emitted
+        and they are truncated so that large payloads
+        (e.g. ``apply_async`` or ``SET`` arguments) are not formatted in full.
 
     Parameters
     ----------
@@ -31,32 +97,172 @@ def ensure_redis_call(f, *args, **kwargs):
         The callable to be executed
     attempts : int, optional
         Number of attempts to make with exponential ease-off.
-        By default ``5`` is used which means the the wait time
-        before last retry will be 16 seconds. Also in that case
-        total wait time is 31 seconds.
+        By default ``attempts`` of the retry policy is used which is ``5``
+        by default which means the the wait time before last retry
+        will be 16 seconds. Also in that case total wait time is 31 seconds.
+    redis_retry_policy : RetryPolicy, dict, optional
+        Retry policy or its parameters.
+        By default :data:`DEFAULT_RETRY_POLICY <celery_redis_sentinel.retry.DEFAULT_RETRY_POLICY>`.
+        Named differently from celery ``apply_async`` ``retry_policy``
+        so that both can be provided.
+    redis_target : object, optional
+        Target of the call as returned by :func:`get_breaker_target
+        <celery_redis_sentinel.breaker.get_breaker_target>`. Calls only wait
+        for recovery probe of the same target. By default all calls without
+        ``redis_target`` share the same target.
     args : tuple
         Any arguments to be passed to ``f`` when calling it
     kwargs : dict
         Any keyword arguments to be passed to ``f`` when calling it
     """
-    attempts = kwargs.pop('attempts', 5)
+    policy = RetryPolicy.from_options(kwargs.pop('redis_retry_policy', None))
+    attempts = kwargs.pop('attempts', policy.attempts)
+    target = kwargs.pop('redis_target', None)
+    start = timer()
+    deadline = start + policy.max_wait(attempts)
+    token = None
+    i = 0
 
-    for i in six.moves.range(attempts + 1):
-        try:
-            return f(*args, **kwargs)
+    try:
+        while True:
+            if recovery_breaker.wait(deadline, target):
+                time.sleep(recovery_breaker.backoff(deadline))
+            try:
+                return f(*args, **kwargs)
 
-        except (ConnectionError, TimeoutError) as e:
-            if i == attempts:
-                raise
-            else:
-                wait = 2 ** i
-                msg = (
-                    'Will reattempt to execute {} with args={} kwargs={} '
-                    'after {} seconds due to exception {}: {}'
-                    ''.format(f, args, kwargs, wait, type(e).__name__, e)
+            except policy.exceptions as e:
+                now = timer()
+                expired = policy.deadline is not None and now - start >= policy.deadline
+                # calls which waited for recovery probe are limited by the total wait time
+                waited_out = token is None and now >= deadline
+                if i == attempts or expired or waited_out:
+                    get_metrics().increment(RETRIES_EXHAUSTED)
+                    logger.error(
+                        'Giving up executing %s with args=%s kwargs=%s after %s retries due to exception %s: %s',
+                        f, truncated_repr(args), truncated_repr(kwargs), i, type(e).__name__, e,
+                    )
+                    raise
+                get_metrics().increment(RETRIES)
+                if token is None:
+                    token = recovery_breaker.trip(target)
+                i += 1
+                if recovery_breaker.blocked(target):
+                    # another call is probing so wait for it instead
+                    continue
+                wait = policy.wait(i - 1)
+                if policy.deadline is not None:
+                    wait = max(min(wait, start + policy.deadline - now), 0)
+                logger.warning(
+                    'Will reattempt to execute %s with args=%s kwargs=%s after %.2f seconds due to exception %s: %s',
+                    f, truncated_repr(args), truncated_repr(kwargs), wait, type(e).__name__, e,
                 )
-                print(msg)
                 time.sleep(wait)
+    finally:
+        recovery_breaker.release(token)
+
+
+class EnsuredPipelineMixin(object):
+    """
+    Mixin to be used for redis ``Pipeline`` or its subclasses which uses
+    :func:`.ensure_redis_call` so that the whole pipeline is retried
+    when it fails due to sentinel failover.
+
+    Each attempt re-sends the whole command stack over a fresh connection
+    from the sentinel connection pool. Since ``SentinelManagedConnection``
+    asks the pool for the master address while connecting, the retried
+    pipeline is sent to the newly elected master.
+
+    Retrying is skipped for pipelines which ``WATCH`` keys since the watched
+    values are not valid anymore after reconnecting.
+    ``MULTI``/``EXEC`` blocks are retried according to
+    ``transaction_retry_policy``:
+
+    * :data:`TRANSACTION_IDEMPOTENT` - (default) retry transactions
+      which only read data (:data:`READ_ONLY_COMMANDS`) or which only
+      apply idempotent writes (:data:`IDEMPOTENT_COMMANDS`, e.g. ``SETEX``
+      with ``PUBLISH`` when celery stores a result). Reads are not mixed
+      with writes since retried reads could see writes of the failed attempt.
+      Other transactions (e.g. celery chord counters which ``RPUSH``
+      and compare ``LLEN`` with the chord size) are never retried
+      which makes sure they are applied at most once.
+      When the connection fails before ``EXEC`` reply is received,
+      the transaction might have been applied by the old master.
+    * :data:`TRANSACTION_RAISE` - never retry transactions.
+    * :data:`TRANSACTION_RETRY` - retry the whole transaction. Only use it
+      for transactions which can be safely applied more than once.
+
+    .. warning::
+        Non-transactional pipelines (``transaction=False``) are always
+        retried as a whole regardless of ``transaction_retry_policy``.
+        Commands such as ``LPUSH`` or ``INCR`` within them might therefore
+        be applied twice when the connection fails after the old master
+        executed them.
+    """
+    transaction_retry_policy = TRANSACTION_IDEMPOTENT
+    retry_policy = None
+
+    def _is_idempotent(self):
+        commands = set(args[0].upper() for args, options in self.command_stack)
+        return commands <= READ_ONLY_COMMANDS or commands <= IDEMPOTENT_COMMANDS
+
+    def _should_retry_transaction(self):
+        if self.transaction_retry_policy == TRANSACTION_IDEMPOTENT:
+            return self._is_idempotent()
+        return self.transaction_retry_policy == TRANSACTION_RETRY
+
+    def execute(self, raise_on_error=True):
+        """
+        Same as super implementation except its wrapped with :meth:`ensure_redis_call`
+        """
+        _super = super(EnsuredPipelineMixin, self).execute
+        explicit_transaction = getattr(self, 'explicit_transaction', False)
+        is_transaction = self.transaction or explicit_transaction
+
+        if self.watching or (is_transaction and not self._should_retry_transaction()):
+            return _super(raise_on_error)
+
+        # super implementation always resets the pipeline
+        # so the command stack needs to be restored before each attempt
+        stack = list(self.command_stack)
+
+        def _execute():
+            self.command_stack = list(stack)
+            self.explicit_transaction = explicit_transaction
+            return _super(raise_on_error)
+
+        return ensure_redis_call(
+            _execute,
+            redis_retry_policy=self.retry_policy,
+            redis_target=get_breaker_target(getattr(self, 'connection_pool', None)),
+        )
+
+
+_ensured_pipeline_classes = {}
+
+
+def get_ensured_pipeline_class(pipeline_class):
+    """
+    Get subclass of the given pipeline class which uses :class:`.EnsuredPipelineMixin`
+
+    Parameters
+    ----------
+    pipeline_class : type
+        Redis pipeline class such as ``redis.client.Pipeline``
+
+    Returns
+    -------
+    type
+        Cached subclass of ``pipeline_class``
+    """
+    try:
+        return _ensured_pipeline_classes[pipeline_class]
+    except KeyError:
+        cls = _ensured_pipeline_classes[pipeline_class] = type(
+            str('Ensured{}'.format(pipeline_class.__name__)),
+            (EnsuredPipelineMixin, pipeline_class),
+            {},
+        )
+        return cls
 
 
 class EnsuredRedisMixin(object):
@@ -64,13 +270,48 @@ class EnsuredRedisMixin(object):
     Mixin to be used for ``Redis`` or its subclasses which uses
     :func:`.ensure_redis_call` that each command is executed with
     retry logic.
+
+    Pipelines returned by :meth:`pipeline` are retried as a whole.
+    See :class:`.EnsuredPipelineMixin` for details.
+
+    Commands are retried according to ``retry_policy``
+    (see :class:`RetryPolicy <celery_redis_sentinel.retry.RetryPolicy>`).
+    By default :data:`DEFAULT_RETRY_POLICY <celery_redis_sentinel.retry.DEFAULT_RETRY_POLICY>`
+    is used.
     """
+    transaction_retry_policy = TRANSACTION_IDEMPOTENT
+    retry_policy = None
 
     def execute_command(self, *args, **options):
         """
         Same as super implementation except its wrapped with :meth:`ensure_redis_call`
         """
-        return ensure_redis_call(super(EnsuredRedisMixin, self).execute_command, *args, **options)
+        _super = super(EnsuredRedisMixin, self).execute_command
+        target = get_breaker_target(getattr(self, 'connection_pool', None))
+        metrics = get_metrics()
+        if not metrics.enabled:
+            return ensure_redis_call(
+                _super, *args, redis_retry_policy=self.retry_policy, redis_target=target, **options
+            )
+
+        start = timer()
+        try:
+            return ensure_redis_call(
+                _super, *args, redis_retry_policy=self.retry_policy, redis_target=target, **options
+            )
+        finally:
+            metrics.observe(COMMAND_LATENCY, timer() - start, command=args[0])
+
+    def pipeline(self, *args, **kwargs):
+        """
+        Same as super implementation except returned pipeline
+        subclasses from :class:`.EnsuredPipelineMixin`
+        """
+        pipe = super(EnsuredRedisMixin, self).pipeline(*args, **kwargs)
+        pipe.__class__ = get_ensured_pipeline_class(type(pipe))
+        pipe.transaction_retry_policy = self.transaction_retry_policy
+        pipe.retry_policy = self.retry_policy
+        return pipe
 
 
 class CelerySentinelConnectionPool(SentinelConnectionPool):
@@ -120,6 +361,132 @@ class CelerySentinelConnectionPool(SentinelConnectionPool):
         return super(CelerySentinelConnectionPool, self).get_master_address()
 
 
+class BlockingSentinelConnectionPool(SentinelConnectionPool, BlockingConnectionPool):
+    """
+    Redis Sentinel connection pool which never opens more than ``max_connections``
+    connections (by default ``50``). Instead of raising ``ConnectionError``
+    when all connections are in use, it blocks for up to ``timeout``
+    seconds (by default ``20``) waiting for any connection to be released.
+    """
+
+    def disconnect(self, inuse_connections=True):
+        """
+        Same as super implementation except when ``inuse_connections`` is ``False``
+        only idle connections are disconnected which is what newer versions
+        of ``SentinelConnectionPool`` expect when master address changes.
+        """
+        if inuse_connections:
+            return super(BlockingSentinelConnectionPool, self).disconnect()
+        for connection in list(self.pool.queue):
+            if connection is not None:
+                connection.disconnect()
+
+
+class PinnedConnectionPool(object):
+    """
+    View of a connection pool shared via :func:`.get_shared_connection_pool`
+    which pins the master the same way :class:`.CelerySentinelConnectionPool` does.
+
+    Shared pool itself follows the master during failover since it is also
+    used by the results backend. The view however only hands out connections
+    to the master discovered when the view was created. Once the shared pool
+    connects to a different master, getting a connection raises
+    ``ConnectionError`` so that celery notices the failover and reconnects
+    with a new channel which creates a new view.
+
+    Other attributes are proxied to the shared pool.
+
+    Parameters
+    ----------
+    pool : SentinelConnectionPool
+        Shared connection pool
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.master_address = pool.get_master_address()
+        self.connections = set()
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    def get_master_address(self):
+        """
+        Get master address discovered when the view was created
+        """
+        return self.master_address
+
+    def get_connection(self, *args, **kwargs):
+        """
+        Get connection of the shared pool connected to the pinned master
+
+        Raises
+        ------
+        ConnectionError
+            When the shared pool switched to a different master
+        """
+        connection = self.pool.get_connection(*args, **kwargs)
+        try:
+            connection.connect()
+        except Exception:
+            self.pool.release(connection)
+            raise
+        host, port = self.master_address
+        if (connection.host, int(connection.port)) != (host, int(port)):
+            self.pool.release(connection)
+            raise ConnectionError('Sentinel switched master from {}:{}'.format(host, port))
+        self.connections.add(connection)
+        return connection
+
+    def release(self, connection):
+        """
+        Release connection handed out by the view back to the shared pool.
+        Connections which were already released are ignored.
+        """
+        if connection not in self.connections:
+            return
+        self.connections.discard(connection)
+        self.pool.release(connection)
+
+    def disconnect(self, inuse_connections=True):
+        """
+        Disconnect connections the view handed out and which were not released
+        and release them back to the shared pool.
+        Connections of the shared pool used by others are left intact.
+        """
+        for connection in list(self.connections):
+            connection.disconnect()
+            self.release(connection)
+
+
+def prefill_connection_pool(connection_pool, count):
+    """
+    Open connections in the connection pool ahead of time so that subsequent
+    commands do not have to pay for master discovery and TCP connect.
+
+    Parameters
+    ----------
+    connection_pool : redis.ConnectionPool
+        Connection pool to prefill
+    count : int
+        Number of connections to open. When the pool has ``max_connections``,
+        at most that many connections are opened.
+    """
+    max_connections = getattr(connection_pool, 'max_connections', None)
+    if max_connections:
+        count = min(count, max_connections)
+
+    connections = []
+    try:
+        for _ in six.moves.range(count):
+            connection = connection_pool.get_connection('PING')
+            connections.append(connection)
+            connection.connect()
+    finally:
+        for connection in connections:
+            connection_pool.release(connection)
+
+
 class ShortLivedStrictRedis(StrictRedis):
     """
     Custom ``StrictRedis`` which disconnects from redis after sending any command to redis.
@@ -146,6 +513,107 @@ class ShortLivedStrictRedis(StrictRedis):
             self.connection_pool.disconnect()
 
 
+def keepalive_options(idle=60, interval=10, count=3):
+    """
+    Get TCP keepalive socket options supported by the platform
+
+    Parameters
+    ----------
+    idle : int, optional
+        Number of idle seconds before keepalive probes are sent
+    interval : int, optional
+        Number of seconds between keepalive probes
+    count : int, optional
+        Number of failed probes after which connection is dropped
+
+    Returns
+    -------
+    dict
+        Mapping of socket options to values for ``socket_keepalive_options``
+    """
+    options = {}
+    for name, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', count)):
+        if hasattr(socket, name):
+            options[getattr(socket, name)] = value
+    return options
+
+
+class PersistentStrictRedis(StrictRedis):
+    """
+    Custom ``StrictRedis`` which keeps connections to redis open
+    between commands. Unlike :class:`.ShortLivedStrictRedis`, commands
+    do not pay for TCP handshake however connections might be silently
+    dropped by firewalls while idle. To detect that:
+
+    1. TCP keepalive is enabled on the connections (see :func:`keepalive_options`)
+    2. ``PING`` is sent before the command when the client was not used
+       for ``health_check_interval`` seconds. When ``PING`` fails,
+       the stale connection is dropped and the command is sent over
+       a new connection.
+
+    Parameters
+    ----------
+    health_check_interval : float, optional
+        Number of idle seconds after which connection is checked
+        before using it. By default ``30``.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.health_check_interval = kwargs.pop('health_check_interval', 30)
+        kwargs.setdefault('socket_keepalive', True)
+        kwargs.setdefault('socket_keepalive_options', keepalive_options())
+        super(PersistentStrictRedis, self).__init__(*args, **kwargs)
+        self.last_used = time.time()
+
+    def execute_command(self, *args, **options):
+        """
+        In addition to executing redis command, this method checks
+        the connection health when the client was idle
+        """
+        if time.time() - self.last_used > self.health_check_interval:
+            try:
+                super(PersistentStrictRedis, self).execute_command('PING')
+            except (ConnectionError, TimeoutError):
+                # redis-py disconnects failed connection so command reconnects
+                pass
+        try:
+            return super(PersistentStrictRedis, self).execute_command(*args, **options)
+        finally:
+            self.last_used = time.time()
+
+
+_persistent_clients = {}
+_persistent_clients_lock = threading.Lock()
+
+
+def get_persistent_client(hostname, port, **kwargs):
+    """
+    Get process-wide :class:`.PersistentStrictRedis` for the given address
+
+    Clients are not shared with forked processes.
+
+    Parameters
+    ----------
+    hostname : str
+        Redis hostname
+    port : int
+        Redis port
+    kwargs : dict
+        Any keyword arguments to be passed to :class:`.PersistentStrictRedis`
+        when it is created. Clients with different arguments are not shared.
+
+    Returns
+    -------
+    PersistentStrictRedis
+    """
+    key = os.getpid(), hostname, port, tuple(sorted(kwargs.items()))
+    with _persistent_clients_lock:
+        client = _persistent_clients.get(key)
+        if client is None:
+            client = _persistent_clients[key] = PersistentStrictRedis(hostname, port, **kwargs)
+    return client
+
+
 class ShortLivedSentinel(Sentinel):
     """
     Custom ``Sentinel`` implementation which uses :py:class:`.ShortLivedStrictRedis`
@@ -153,15 +621,298 @@ class ShortLivedSentinel(Sentinel):
 
     That assures that sentinel connection is being opened when sentinel is being
     queried. After the query is successful, sentinel connection is closed.
+
+    In addition, when ``master_cache_ttl`` is provided, discovered master addresses
+    are stored in process-wide :data:`master_address_cache
+    <celery_redis_sentinel.discovery.master_address_cache>` so that multiple
+    clients for the same sentinel service do not need to query sentinel
+    every time the master address is needed. Cached address is invalidated
+    after ``master_cache_ttl`` seconds or as soon as sentinel announces
+    ``+switch-master`` for the service. Only a single thread discovers
+    master on cache miss and once the cache is shared
+    (see :meth:`MasterAddressCache.share <celery_redis_sentinel.discovery.MasterAddressCache.share>`),
+    only a single process does so as well.
+
+    When ``parallel_discovery`` is enabled, all sentinels are queried
+    at once (see :meth:`discover_master_parallel`) instead of one by one.
+    That way dead sentinels at the beginning of the sentinels list do not
+    add a full ``socket_timeout`` each to the discovery time.
+    ``discovery_quorum`` controls how many sentinels have to agree
+    on the master address before it is returned. By default ``1`` is used.
+
+    When ``rank_sentinels`` is enabled, latency and success of every sentinel
+    query is tracked in process-wide :data:`sentinel_health
+    <celery_redis_sentinel.discovery.sentinel_health>` and sentinels are
+    queried from the fastest and most reliable one. Sentinels which
+    repeatedly failed are skipped for ``sentinel_cooldown`` seconds
+    (by default ``30``) unless all other sentinels fail as well.
+    See :class:`SentinelHealth <celery_redis_sentinel.discovery.SentinelHealth>`
+    for details.
+
+    Discovery latency and master switches noticed while discovering
+    are recorded in :mod:`metrics <celery_redis_sentinel.metrics>`.
     """
 
     def __init__(self, sentinels, *args, **kwargs):
+        self.master_cache_ttl = kwargs.pop('master_cache_ttl', None)
+        self.parallel_discovery = kwargs.pop('parallel_discovery', False)
+        self.discovery_quorum = kwargs.pop('discovery_quorum', 1)
+        self.max_link_down_time = kwargs.pop('max_link_down_time', None)
+        self.rank_sentinels = kwargs.pop('rank_sentinels', False)
+        self.sentinel_cooldown = kwargs.pop('sentinel_cooldown', 30)
         super(ShortLivedSentinel, self).__init__(sentinels, *args, **kwargs)
+        self.sentinel_addresses = [tuple(i) for i in sentinels]
+        self.discovered_masters = {}
         self.sentinels = [
-            ShortLivedStrictRedis(hostname, port, **self.sentinel_kwargs)
+            self.sentinel_client(hostname, port)
             for hostname, port in sentinels
         ]
 
+    def sentinel_client(self, hostname, port):
+        """
+        Get client for querying sentinel at the given address
+
+        Returns
+        -------
+        ShortLivedStrictRedis
+            Client which disconnects after each command
+        """
+        return ShortLivedStrictRedis(hostname, port, **self.sentinel_kwargs)
+
+    def discover_master(self, service_name):
+        """
+        Same as super implementation except master address is first looked up
+        in :data:`master_address_cache <celery_redis_sentinel.discovery.master_address_cache>`
+        when ``master_cache_ttl`` is provided and that sentinels are queried
+        in parallel when ``parallel_discovery`` is enabled.
+        """
+        if not self.master_cache_ttl:
+            return self._discover_master(service_name)
+
+        key = master_cache_key(self.sentinel_addresses, service_name)
+        address = master_address_cache.get(key)
+        if address is None:
+            with master_address_cache.discovery_lock():
+                # another thread or process might have discovered master while waiting
+                address = master_address_cache.get(key)
+                if address is None:
+                    address = self._discover_master(service_name)
+                    master_address_cache.set(key, address, self.master_cache_ttl)
+        # when the cache is shared, other processes might have populated it
+        # hence every process which reads it has to watch for master switch
+        master_address_cache.watch(
+            self.sentinel_addresses, service_name,
+            socket_timeout=self.sentinel_kwargs.get('socket_timeout'),
+        )
+        return address
+
+    def _discover_master(self, service_name):
+        metrics = get_metrics()
+        start = timer()
+        try:
+            if self.parallel_discovery:
+                address = self.discover_master_parallel(service_name)
+            elif self.rank_sentinels:
+                address = self.discover_master_ranked(service_name)
+            else:
+                address = super(ShortLivedSentinel, self).discover_master(service_name)
+        finally:
+            if metrics.enabled:
+                metrics.observe(DISCOVERY_LATENCY, timer() - start, service=service_name)
+
+        previous = self.discovered_masters.get(service_name)
+        if previous is not None and previous != address:
+            metrics.mark(MASTER_SWITCH, service=service_name)
+        self.discovered_masters[service_name] = address
+        return address
+
+    def query_master(self, sentinel, service_name):
+        """
+        Query single sentinel for the master address of the given service
+
+        Parameters
+        ----------
+        sentinel : StrictRedis
+            Client connected to sentinel node
+        service_name : str
+            Name of the sentinel service_name.
+
+        Returns
+        -------
+        tuple, None
+            Master address as ``(host, port)`` or ``None`` when sentinel
+            does not know about a healthy master for the service
+        """
+        state = sentinel.sentinel_masters().get(service_name)
+        if state and self.check_master_state(state, service_name):
+            return state['ip'], state['port']
+        return None
+
+    def query_master_tracked(self, address, sentinel, service_name):
+        """
+        Same as :meth:`query_master` except query latency and success
+        are recorded in :data:`sentinel_health
+        <celery_redis_sentinel.discovery.sentinel_health>`
+        when ``rank_sentinels`` is enabled
+        """
+        if not self.rank_sentinels:
+            return self.query_master(sentinel, service_name)
+        start = timer()
+        try:
+            master = self.query_master(sentinel, service_name)
+        except (ConnectionError, TimeoutError):
+            sentinel_health.record(address, timer() - start, False)
+            raise
+        sentinel_health.record(address, timer() - start, True)
+        return master
+
+    def ranked_sentinels(self):
+        """
+        Get ``(address, client)`` pairs of sentinels which should be queried
+        ordered from the best ranked. Sentinels with open circuit
+        are at the end.
+        """
+        available, skipped = sentinel_health.rank(self.sentinel_addresses, self.sentinel_cooldown)
+        clients = dict(zip(self.sentinel_addresses, self.sentinels))
+        return [(address, clients[address]) for address in available + skipped]
+
+    def discover_master_ranked(self, service_name):
+        """
+        Discover master address by querying sentinels one by one
+        in the order of :meth:`ranked_sentinels`.
+
+        Raises
+        ------
+        MasterNotFoundError
+            When none of the sentinels knows about a healthy master
+        """
+        for address, sentinel in self.ranked_sentinels():
+            try:
+                master = self.query_master_tracked(address, sentinel, service_name)
+            except (ConnectionError, TimeoutError):
+                continue
+            if master is not None:
+                return master
+
+        raise MasterNotFoundError('No master found for {!r}'.format(service_name))
+
+    def discover_master_parallel(self, service_name):
+        """
+        Discover master address by querying all sentinels at once.
+
+        Each sentinel is queried in its own thread and master address is returned
+        as soon as ``discovery_quorum`` sentinels report the same address.
+        Therefore worst-case discovery time is roughly a single ``socket_timeout``
+        regardless how many sentinels are not reachable.
+
+        Raises
+        ------
+        MasterNotFoundError
+            When all sentinels replied (or failed) without reaching the quorum
+        """
+        results = six.moves.queue.Queue()
+        # short-lived clients disconnect their whole pool after each command
+        # and queries of previous discovery might still be in flight
+        # hence every discovery uses its own clients
+        addresses = self.sentinel_addresses
+        if self.rank_sentinels:
+            # sentinels with open circuit are only queried when needed for the quorum
+            available, skipped = sentinel_health.rank(addresses, self.sentinel_cooldown)
+            addresses = available + skipped[:max(self.discovery_quorum - len(available), 0)]
+        sentinels = [
+            (address, self.sentinel_client(address[0], address[1]))
+            for address in addresses
+        ]
+
+        def query(sentinel_address, sentinel):
+            address = None
+            try:
+                address = self.query_master_tracked(sentinel_address, sentinel, service_name)
+            except (ConnectionError, TimeoutError):
+                pass
+            except Exception:
+                # nothing can handle the error in the thread hence it is only logged
+                logger.exception(
+                    'Failed to query sentinel %s:%s for master %s',
+                    sentinel_address[0], sentinel_address[1], service_name,
+                )
+            finally:
+                # always vote so that discovery never waits for a dead thread
+                results.put(address)
+
+        for sentinel in sentinels:
+            thread = threading.Thread(target=query, args=sentinel)
+            thread.daemon = True
+            thread.start()
+
+        quorum = min(self.discovery_quorum, len(sentinels))
+        votes = Counter()
+        for _ in sentinels:
+            address = results.get()
+            if address is None:
+                continue
+            votes[address] += 1
+            if votes[address] >= quorum:
+                return address
+
+        raise MasterNotFoundError('No master found for {!r}'.format(service_name))
+
+    def filter_slaves(self, slaves):
+        """
+        Same as super implementation except when ``max_link_down_time`` is provided,
+        replicas are additionally filtered by their replication link state
+        as reported by sentinel (``master-link-status`` and ``master-link-down-time``).
+
+        .. note::
+            Link down time is not replication lag. Replicas with healthy link
+            which are behind the master are not filtered since sentinel does
+            not report master replication offset to compare with.
+        """
+        if self.max_link_down_time is None:
+            return super(ShortLivedSentinel, self).filter_slaves(slaves)
+
+        max_down_time = self.max_link_down_time * 1000
+        in_sync = []
+        for slave in slaves:
+            if slave.get('master-link-status') != 'ok':
+                continue
+            if int(slave.get('master-link-down-time') or 0) > max_down_time:
+                continue
+            in_sync.append(slave)
+        return super(ShortLivedSentinel, self).filter_slaves(in_sync)
+
+
+class PersistentSentinel(ShortLivedSentinel):
+    """
+    Same as :class:`.ShortLivedSentinel` except sentinels are queried via
+    process-wide :class:`.PersistentStrictRedis` clients (see :func:`get_persistent_client`)
+    which keep connections to sentinels open so that master discovery
+    does not pay for TCP handshake every time.
+
+    Stale connections (e.g. dropped by firewall) are detected by TCP keepalive
+    and by ``PING`` sent after connection was idle for ``health_check_interval``
+    seconds (by default ``30``).
+    """
+
+    def __init__(self, sentinels, *args, **kwargs):
+        self.health_check_interval = kwargs.pop('health_check_interval', 30)
+        super(PersistentSentinel, self).__init__(sentinels, *args, **kwargs)
+
+    def sentinel_client(self, hostname, port):
+        """
+        Get client for querying sentinel at the given address
+
+        Returns
+        -------
+        PersistentStrictRedis
+            Process-wide client which keeps its connection open
+        """
+        return get_persistent_client(
+            hostname, port,
+            health_check_interval=self.health_check_interval,
+            **self.sentinel_kwargs
+        )
+
 
 def get_redis_via_sentinel(db,
                            sentinels,
@@ -170,6 +921,18 @@ def get_redis_via_sentinel(db,
                            redis_class=StrictRedis,
                            sentinel_class=ShortLivedSentinel,
                            connection_pool_class=SentinelConnectionPool,
+                           master_cache_ttl=None,
+                           parallel_discovery=False,
+                           discovery_quorum=1,
+                           replica=False,
+                           max_link_down_time=None,
+                           max_connections=None,
+                           pool_timeout=None,
+                           rank_sentinels=False,
+                           sentinel_cooldown=30,
+                           sentinel_health_check_interval=None,
+                           sentinel_socket_timeout=None,
+                           adaptive_timeout=None,
                            **kwargs):
     """
     Helper function for getting ``Redis`` instance via sentinel
@@ -186,7 +949,9 @@ def get_redis_via_sentinel(db,
     service_name : str
         Name of the sentinel service_name.
     socket_timeout : float, optional
-        Socket timeout value. By default ``0.1`` is used.
+        Socket timeout of redis commands. By default ``0.1`` is used.
+        Also used for sentinel queries unless ``sentinel_socket_timeout``
+        is provided.
     redis_class : type, optional
         Class to be used for the ``Redis`` being returned.
         By default ``StrictRedis`` is used.
@@ -199,20 +964,152 @@ def get_redis_via_sentinel(db,
     connection_pool_class : type, optional
         Class to be used for the connection pool.
         By default ``SentinelConnectionPool`` is used.
+    master_cache_ttl : float, optional
+        Number of seconds discovered master address should be cached
+        for in process-wide master address cache.
+        By default master address is not cached.
+    parallel_discovery : bool, optional
+        Whether to query all sentinels at once while discovering master.
+        By default sentinels are queried one by one.
+    discovery_quorum : int, optional
+        Number of sentinels which need to agree on master address
+        when ``parallel_discovery`` is used. By default ``1`` is used.
+    replica : bool, optional
+        Whether to return client connected to one of the replicas
+        (via ``Sentinel.slave_for``) instead of master.
+        When no replica is available, the client falls back to master.
+        By default master client is returned.
+    max_link_down_time : float, optional
+        Maximum number of seconds replica replication link to master
+        can be down in order for replica to be used.
+        This is not replication lag since replicas with healthy
+        link are used even when they are behind the master.
+        By default all replicas which are not down are used.
+    max_connections : int, optional
+        Maximum number of connections in the connection pool.
+        By default connection pool default is used.
+    pool_timeout : float, optional
+        Number of seconds to wait for a free connection when all
+        ``max_connections`` are in use. Only applicable for blocking
+        connection pools such as :class:`.BlockingSentinelConnectionPool`.
+    rank_sentinels : bool, optional
+        Whether to query sentinels ordered by their health instead of the
+        configured order while discovering master. By default ``False``.
+    sentinel_cooldown : float, optional
+        Number of seconds repeatedly failing sentinels are skipped for
+        when ``rank_sentinels`` is enabled. By default ``30``.
+    sentinel_health_check_interval : float, optional
+        Number of idle seconds after which sentinel connections are checked
+        before querying sentinel. Only applicable when ``sentinel_class``
+        keeps connections open such as :class:`.PersistentSentinel`.
+    sentinel_socket_timeout : float, optional
+        Socket timeout of sentinel queries while discovering master.
+        By default ``socket_timeout`` is used.
+    adaptive_timeout : AdaptiveTimeout, dict, bool, optional
+        When provided, timeouts of redis commands are derived from observed
+        command latencies with ``socket_timeout`` being the minimum timeout.
+        See :class:`AdaptiveTimeout <celery_redis_sentinel.timeouts.AdaptiveTimeout>`
+        for details. By default ``socket_timeout`` is used for all commands.
+    kwargs
+        Connection options listed in :data:`.CONNECTION_OPTIONS` such as
+        ``socket_connect_timeout`` are passed to redis connections.
+        Other keyword arguments are ignored
+        hence kombu connection parameters can be passed as-is.
 
     Returns
     -------
     Redis
         Connected ``Redis`` instance with sentinel connection pool
     """
+    sentinel_kwargs = {}
+    if master_cache_ttl:
+        sentinel_kwargs['master_cache_ttl'] = master_cache_ttl
+    if parallel_discovery:
+        sentinel_kwargs['parallel_discovery'] = parallel_discovery
+        sentinel_kwargs['discovery_quorum'] = discovery_quorum
+    if max_link_down_time is not None:
+        sentinel_kwargs['max_link_down_time'] = max_link_down_time
+    if rank_sentinels:
+        sentinel_kwargs['rank_sentinels'] = rank_sentinels
+        sentinel_kwargs['sentinel_cooldown'] = sentinel_cooldown
+    if sentinel_health_check_interval is not None:
+        sentinel_kwargs['health_check_interval'] = sentinel_health_check_interval
+
     sentinel = sentinel_class(
         sentinels,
-        socket_timeout=socket_timeout,
+        socket_timeout=sentinel_socket_timeout if sentinel_socket_timeout is not None else socket_timeout,
+        **sentinel_kwargs
+    )
+    pool_kwargs = dict(
+        (i, kwargs[i]) for i in CONNECTION_OPTIONS
+        if kwargs.get(i) is not None
     )
-    return sentinel.master_for(
+    if max_connections is not None:
+        pool_kwargs['max_connections'] = max_connections
+    if pool_timeout is not None:
+        pool_kwargs['timeout'] = pool_timeout
+    adaptive_timeout = AdaptiveTimeout.from_options(adaptive_timeout, socket_timeout)
+    if adaptive_timeout is not None:
+        pool_kwargs['connection_class'] = type(
+            str('SentinelManagedConnection'),
+            (AdaptiveTimeoutConnectionMixin, SentinelManagedConnection),
+            {'adaptive_timeout': adaptive_timeout},
+        )
+
+    client_for = sentinel.slave_for if replica else sentinel.master_for
+    return client_for(
         service_name,
         socket_timeout=socket_timeout,
         db=db,
         redis_class=redis_class,
         connection_pool_class=connection_pool_class,
+        **pool_kwargs
     )
+
+
+_shared_pools = {}
+_shared_pools_lock = threading.Lock()
+
+
+def get_shared_connection_pool(db, sentinels, service_name, **kwargs):
+    """
+    Get process-wide sentinel connection pool of the master
+    shared by the broker and results backend
+
+    Pools are keyed by sentinels, service name and db hence when both
+    the broker and results backend use the same master, they share a single
+    master discovery and a single set of connections.
+    The pool follows the master during failover.
+    Broker pins the master via :class:`.PinnedConnectionPool` view.
+
+    .. note::
+        Pool is created with the options of whichever uses it first
+        so the broker and results backend should have the same
+        connection options (e.g. ``socket_timeout``).
+
+    Parameters
+    ----------
+    db : int, str
+        Redis DB
+    sentinels : list
+        List of tuples of all sentinel nodes within the sentinel cluster.
+    service_name : str
+        Name of the sentinel service_name.
+    kwargs : dict
+        Any keyword arguments to be passed to :func:`.get_redis_via_sentinel`
+        when the pool is created.
+
+    Returns
+    -------
+    SentinelConnectionPool
+    """
+    # connections must not be shared with parent process after fork
+    key = (os.getpid(), master_cache_key(sentinels, service_name), int(db or 0))
+    with _shared_pools_lock:
+        pool = _shared_pools.get(key)
+        if pool is None:
+            kwargs.pop('redis_class', None)
+            pool = _shared_pools[key] = get_redis_via_sentinel(
+                db, sentinels, service_name, **kwargs
+            ).connection_pool
+    return pool
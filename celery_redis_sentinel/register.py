@@ -2,9 +2,11 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import celery
+from celery.signals import worker_init
 from kombu.transport import TRANSPORT_ALIASES
 
 from .backend import RedisSentinelBackend
+from .discovery import share_master_address_cache
 from .transport import SentinelTransport
 
 if celery.VERSION.major < 4:
@@ -37,6 +39,13 @@ def register(alias='redis-sentinel'):
     Function to register sentinel transport and results backend
     into Celery's registry
 
+    In addition, when ``shared_master_cache`` transport option is enabled,
+    :data:`master_address_cache <celery_redis_sentinel.discovery.master_address_cache>`
+    is shared with worker pool processes once the worker initializes
+    (see :func:`share_master_address_cache <celery_redis_sentinel.discovery.share_master_address_cache>`)
+    so that discovered master addresses (when ``master_cache_ttl`` is used)
+    are shared by all prefork children.
+
     .. note::
         This function should be used before configuring celery app
         (e.g. via ``app.config_from_object()`` method)
@@ -53,6 +62,8 @@ def register(alias='redis-sentinel'):
     TRANSPORT_ALIASES[alias] = get_class_path(SentinelTransport)
     # result backend
     BACKEND_ALIASES[alias] = get_class_path(RedisSentinelBackend)
+    # master address cache shared by all pool processes
+    worker_init.connect(share_master_address_cache)
 
 
 register()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import random
+
+import six
+from kombu.utils.imports import symbol_by_name
+from redis import ConnectionError, TimeoutError
+
+
+class RetryPolicy(object):
+    """
+    Policy of :func:`ensure_redis_call <celery_redis_sentinel.redis_sentinel.ensure_redis_call>`
+    retries during sentinel failover.
+
+    Waits grow exponentially (``base ** retry``) up to ``cap`` seconds
+    with up to ``jitter`` random seconds added. Retrying stops after
+    ``attempts`` retries or once ``deadline`` seconds passed since
+    the first attempt, whichever comes first.
+
+    Policy can be configured via ``retry_policy`` transport option
+    which accepts the same parameters as a ``dict``::
+
+        CELERY_RESULT_BACKEND_TRANSPORT_OPTIONS = {
+            ...
+            'retry_policy': {
+                'deadline': 10,
+                'base': 1.5,
+                'cap': 4,
+                'jitter': 0.5,
+            },
+        }
+
+    Parameters
+    ----------
+    attempts : int, optional
+        Maximum number of retries. By default ``5``.
+    deadline : float, optional
+        Maximum number of seconds to keep retrying for.
+        By default only ``attempts`` limit retries.
+    base : float, optional
+        Base of exponential ease-off. By default ``2``
+        which means waits of ``1, 2, 4, ...`` seconds.
+    cap : float, optional
+        Maximum number of seconds to wait between retries.
+        By default waits are not capped.
+    jitter : float, optional
+        Maximum number of random seconds added to each wait.
+        By default ``0``.
+    exceptions : tuple, optional
+        Exception classes (or their dot-notation paths) which are retried.
+        By default redis ``ConnectionError`` and ``TimeoutError``.
+    """
+
+    def __init__(self, attempts=5, deadline=None, base=2, cap=None, jitter=0,
+                 exceptions=(ConnectionError, TimeoutError)):
+        self.attempts = attempts
+        self.deadline = deadline
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+        self.exceptions = tuple(
+            symbol_by_name(i) if isinstance(i, six.string_types) else i
+            for i in exceptions
+        )
+
+    @classmethod
+    def from_options(cls, options):
+        """
+        Get policy from transport option value
+
+        Parameters
+        ----------
+        options : RetryPolicy, dict, None
+            Policy itself, keyword arguments for the policy or ``None``
+            for :data:`.DEFAULT_RETRY_POLICY`
+
+        Returns
+        -------
+        RetryPolicy
+        """
+        if options is None:
+            return DEFAULT_RETRY_POLICY
+        if isinstance(options, cls):
+            return options
+        return cls(**options)
+
+    def wait(self, retry):
+        """
+        Get number of seconds to wait before the given retry
+
+        Parameters
+        ----------
+        retry : int
+            Zero-based retry number
+        """
+        wait = self.base ** retry
+        if self.cap is not None:
+            wait = min(wait, self.cap)
+        if self.jitter:
+            wait += random.uniform(0, self.jitter)
+        return wait
+
+    def max_wait(self, attempts=None):
+        """
+        Get maximum number of seconds spent waiting between retries
+
+        Parameters
+        ----------
+        attempts : int, optional
+            Number of retries. By default ``attempts`` of the policy.
+        """
+        if attempts is None:
+            attempts = self.attempts
+        total = 0
+        for i in six.moves.range(attempts):
+            wait = self.base ** i
+            if self.cap is not None:
+                wait = min(wait, self.cap)
+            total += wait + self.jitter
+        if self.deadline is not None:
+            total = min(total, self.deadline)
+        return total
+
+
+#: Policy used when no policy is provided which retries 5 times
+#: with waits of 1, 2, 4, 8 and 16 seconds
+DEFAULT_RETRY_POLICY = RetryPolicy()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import bisect
+import hashlib
+
+import six
+
+
+def _hash(value):
+    if isinstance(value, six.text_type):
+        value = value.encode('utf-8')
+    return int(hashlib.md5(value).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hashing ring which maps keys to nodes.
+
+    Each node is placed on the ring ``replicas`` times so that keys
+    are spread evenly between nodes. Adding or removing a node only
+    remaps keys of that node hence when a sentinel service is added,
+    only about ``1 / len(nodes)`` of queues move to it.
+
+    Parameters
+    ----------
+    nodes : list
+        Nodes such as sentinel service names
+    replicas : int, optional
+        Number of points of each node on the ring. By default ``100``.
+
+    Examples
+    --------
+
+    ::
+
+        >>> ring = HashRing(['master-a', 'master-b'])
+        >>> ring.get_node('celery')
+        'master-b'
+    """
+
+    def __init__(self, nodes, replicas=100):
+        if not nodes:
+            raise ValueError('HashRing requires at least one node')
+        self.nodes = list(nodes)
+        self.replicas = replicas
+        self._ring = {}
+        for node in self.nodes:
+            for i in six.moves.range(replicas):
+                self._ring[_hash('{}-{}'.format(node, i))] = node
+        self._points = sorted(self._ring)
+
+    def get_node(self, key):
+        """
+        Get node the given key belongs to
+
+        Parameters
+        ----------
+        key : str
+            Key such as queue name
+
+        Returns
+        -------
+        object
+            First node clockwise from the hash of the key
+        """
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._ring[self._points[index]]
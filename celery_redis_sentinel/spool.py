@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import base64
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import deque
+
+from celery import Task
+from redis import ConnectionError, TimeoutError
+
+try:
+    from kombu.exceptions import OperationalError
+except ImportError:  # pragma: no cover
+    # kombu < 4 raises redis errors as they are
+    OperationalError = ConnectionError
+
+
+logger = logging.getLogger(__name__)
+
+#: Errors raised while publishing when master is not reachable.
+#: kombu 4+ raises redis connection errors as ``OperationalError``.
+PUBLISH_ERRORS = (ConnectionError, TimeoutError, OperationalError)
+
+
+class PublishSpool(object):
+    """
+    Bounded local spool of task messages which could not be published
+    because redis sentinel failover is in progress.
+
+    Spooled messages are replayed by a background drainer thread
+    in batches of ``batch_size`` messages once the master is reachable again.
+    When the broker channel supports :meth:`buffered_puts
+    <celery_redis_sentinel.transport.SentinelChannel.buffered_puts>`,
+    each batch is pushed to redis in a single pipeline.
+
+    Parameters
+    ----------
+    maxlen : int, optional
+        Maximum number of spooled messages. When the spool is full,
+        :meth:`put` refuses new messages. By default ``10000`` is used.
+    path : str, optional
+        Path of an append-only file where spooled messages are persisted
+        so that they survive process restarts. Messages in the file are
+        loaded when the spool is created.
+        By default messages are only kept in memory.
+    batch_size : int, optional
+        Number of messages replayed in a single pipeline.
+        By default ``100`` is used.
+    drain_interval : float, optional
+        Number of seconds the drainer waits between attempts to replay
+        messages while master is not reachable. By default ``1`` is used.
+    """
+
+    def __init__(self, maxlen=10000, path=None, batch_size=100, drain_interval=1):
+        self.maxlen = maxlen
+        self.path = path
+        self.batch_size = batch_size
+        self.drain_interval = drain_interval
+        self.messages = deque()
+        self._lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._drainer = None
+
+        if self.path and os.path.exists(self.path):
+            self._load()
+
+    def __len__(self):
+        return len(self.messages)
+
+    @staticmethod
+    def _dumps(message):
+        return base64.b64encode(pickle.dumps(message, protocol=2))
+
+    @staticmethod
+    def _loads(line):
+        return pickle.loads(base64.b64decode(line))
+
+    def _load(self):
+        with open(self.path, 'rb') as fid:
+            for line in fid:
+                line = line.strip()
+                if line:
+                    self.messages.append(self._loads(line))
+
+    def _persist(self):
+        if not self.path:
+            return
+        tmp = '{}.tmp'.format(self.path)
+        with open(tmp, 'wb') as fid:
+            for message in self.messages:
+                fid.write(self._dumps(message) + b'\n')
+        os.rename(tmp, self.path)
+
+    def put(self, task_name, args, kwargs, options):
+        """
+        Spool task message
+
+        Parameters
+        ----------
+        task_name : str
+            Name of the task
+        args : tuple
+            Task positional arguments
+        kwargs : dict
+            Task keyword arguments
+        options : dict
+            Any other ``apply_async`` options such as ``task_id``
+
+        Returns
+        -------
+        bool
+            ``True`` when message was spooled and ``False`` when the spool is full
+        """
+        message = (task_name, args, kwargs, options)
+        with self._lock:
+            if len(self.messages) >= self.maxlen:
+                return False
+            self.messages.append(message)
+            if self.path:
+                with open(self.path, 'ab') as fid:
+                    fid.write(self._dumps(message) + b'\n')
+        self._wakeup.set()
+        return True
+
+    def drain(self, app):
+        """
+        Replay single batch of spooled messages
+
+        Messages are removed from the spool only after they are successfully
+        published so connection errors in the middle of the batch
+        do not lose any messages. When the broker channel supports
+        :meth:`buffered_puts <celery_redis_sentinel.transport.SentinelChannel.buffered_puts>`,
+        the whole batch is published in a single pipeline hence it is
+        either published or kept in the spool as a whole.
+
+        Parameters
+        ----------
+        app : celery.Celery
+            Celery app used to publish messages
+
+        Returns
+        -------
+        int
+            Number of published messages
+        """
+        published = 0
+        with self._drain_lock:
+            if not self.messages:
+                return published
+            try:
+                with app.producer_or_acquire() as producer:
+                    if hasattr(producer.channel, 'buffered_puts'):
+                        published = self._drain_buffered(app, producer)
+                    else:
+                        while self.messages and published < self.batch_size:
+                            self._publish(app, producer, self.messages[0])
+                            with self._lock:
+                                self.messages.popleft()
+                            published += 1
+            finally:
+                if published:
+                    with self._lock:
+                        self._persist()
+        return published
+
+    def _drain_buffered(self, app, producer):
+        with self._lock:
+            batch = [self.messages[i] for i in range(min(len(self.messages), self.batch_size))]
+        with producer.channel.buffered_puts():
+            for message in batch:
+                self._publish(app, producer, message)
+        # other threads only append messages hence the batch is still at the front
+        with self._lock:
+            for _ in batch:
+                self.messages.popleft()
+        return len(batch)
+
+    @staticmethod
+    def _publish(app, producer, message):
+        task_name, args, kwargs, options = message
+        Task.apply_async(app.tasks[task_name], args, kwargs, producer=producer, **options)
+
+    def start(self, app):
+        """
+        Start background drainer thread unless it is already running
+
+        Parameters
+        ----------
+        app : celery.Celery
+            Celery app used to publish messages
+        """
+        with self._lock:
+            if self._drainer is not None and self._drainer.is_alive():
+                return
+            self._drainer = threading.Thread(
+                target=self.run, args=(app,), name='celery-publish-spool',
+            )
+            self._drainer.daemon = True
+            self._drainer.start()
+
+    def run(self, app):
+        """
+        Drainer thread main loop
+        """
+        while True:
+            if not self.messages:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            try:
+                self.drain(app)
+            except PUBLISH_ERRORS as e:
+                logger.warning(
+                    'Could not replay %s spooled messages due to exception %s: %s',
+                    len(self.messages), type(e).__name__, e,
+                )
+                time.sleep(self.drain_interval)
+            except Exception:
+                logger.exception('Error while replaying spooled messages')
+                time.sleep(self.drain_interval)
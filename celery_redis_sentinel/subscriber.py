@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+
+import six
+from redis import ConnectionError, TimeoutError
+
+from .discovery import get_switch_master_listener
+from .transport import shutdown_connection
+
+
+logger = logging.getLogger(__name__)
+
+CONTROL_CHANNEL = 'celery-redis-sentinel-results'
+
+
+class Waiter(object):
+    """
+    Single caller waiting for notifications on a channel
+
+    Notifications are queued payloads where ``None`` means that the
+    notification might have been missed and the value should be read directly.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.event = threading.Event()
+        self.notifications = deque()
+
+    def notify(self, payload=None):
+        self.notifications.append(payload)
+        self.event.set()
+
+
+class ResultSubscriber(object):
+    """
+    Single pub/sub subscription shared by all callers waiting for results
+    within the process.
+
+    The subscription is held by a background thread which reads all
+    messages while callers (see :meth:`wait`) only send ``SUBSCRIBE``
+    and ``UNSUBSCRIBE`` commands. Whenever a channel subscription is
+    confirmed, waiters of the channel are asked to read the value directly
+    since it might have been published before the subscription became active.
+
+    When the connection is lost or sentinel announces ``+switch-master``,
+    the thread connects to the (new) master again, resubscribes to all
+    channels and thanks to the confirmation logic above, waiters read values
+    directly so that no notification is lost during failover.
+
+    Parameters
+    ----------
+    client_factory : callable
+        Callable returning new redis client connected to master.
+        It is called every time the subscription is established.
+    sentinels : list, optional
+        Sentinel addresses. When provided together with ``service_name``,
+        the subscription is re-established as soon as sentinel
+        announces ``+switch-master``.
+    service_name : str, optional
+        Name of the sentinel service
+    socket_timeout : float, optional
+        Socket timeout used to listen for ``+switch-master``
+    retry_interval : float, optional
+        Number of seconds to wait before reconnecting after connection
+        failure. By default ``0.5``.
+    """
+
+    def __init__(self, client_factory, sentinels=None, service_name=None,
+                 socket_timeout=None, retry_interval=0.5):
+        self.client_factory = client_factory
+        self.sentinels = sentinels
+        self.service_name = service_name
+        self.socket_timeout = socket_timeout
+        self.retry_interval = retry_interval
+        self.waiters = defaultdict(set)
+        self.confirmed = set()
+        self.pubsub = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """
+        Start subscription thread unless it is already running
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self.run, name='celery-redis-sentinel-results')
+            self._thread.daemon = True
+            self._thread.start()
+
+        if self.sentinels and self.service_name:
+            listener = get_switch_master_listener(
+                self.sentinels, self.service_name,
+                socket_timeout=self.socket_timeout,
+            )
+            listener.add_callback(self.on_switch_master)
+
+    def on_switch_master(self, old_address, new_address):
+        """
+        Force the subscription thread to reconnect to new master
+        """
+        pubsub = self.pubsub
+        if pubsub is not None:
+            shutdown_connection(pubsub.connection)
+
+    def _send(self, command, channel):
+        # only sending commands so it is safe while subscription thread reads responses
+        pubsub = self.pubsub
+        if pubsub is None:
+            return
+        try:
+            getattr(pubsub, command)(channel)
+        except (ConnectionError, TimeoutError):
+            # subscription thread resubscribes once reconnected
+            pass
+
+    def add(self, channel):
+        """
+        Register waiter for the channel and subscribe to the channel
+        """
+        waiter = Waiter(channel)
+        with self._lock:
+            new = not self.waiters[channel]
+            self.waiters[channel].add(waiter)
+            if channel in self.confirmed:
+                waiter.notify()
+            elif new:
+                self._send('subscribe', channel)
+        return waiter
+
+    def remove(self, waiter):
+        """
+        Unregister waiter and unsubscribe when nobody else waits on the channel
+        """
+        channel = waiter.channel
+        with self._lock:
+            self.waiters[channel].discard(waiter)
+            if not self.waiters[channel]:
+                del self.waiters[channel]
+                self.confirmed.discard(channel)
+                self._send('unsubscribe', channel)
+
+    def handle_message(self, message):
+        """
+        Dispatch message received by the subscription to waiters
+        """
+        channel = message['channel']
+        if isinstance(channel, six.binary_type):
+            channel = channel.decode('utf-8')
+        if message['type'] == 'subscribe':
+            with self._lock:
+                waiters = self.waiters.get(channel)
+                if waiters:
+                    self.confirmed.add(channel)
+                    for waiter in waiters:
+                        waiter.notify()
+        elif message['type'] == 'message':
+            with self._lock:
+                waiters = list(self.waiters.get(channel, ()))
+            for waiter in waiters:
+                waiter.notify(message['data'])
+
+    def listen(self):
+        """
+        Establish subscription and read messages until connection is lost
+        """
+        pubsub = self.client_factory().pubsub()
+        try:
+            with self._lock:
+                self.confirmed.clear()
+                pubsub.subscribe(CONTROL_CHANNEL, *self.waiters)
+                self.pubsub = pubsub
+            while True:
+                message = pubsub.get_message(timeout=1)
+                if message:
+                    self.handle_message(message)
+        finally:
+            with self._lock:
+                self.pubsub = None
+                self.confirmed.clear()
+            pubsub.close()
+
+    def run(self):
+        """
+        Subscription thread main loop
+        """
+        while True:
+            try:
+                self.listen()
+            except (ConnectionError, TimeoutError, OSError) as e:
+                logger.debug('Lost results subscription: %s', e)
+            except Exception:
+                logger.exception('Error in results subscription')
+            time.sleep(self.retry_interval)
+
+    def wait(self, channel, check, timeout=None, interval=0.5, on_interval=None):
+        """
+        Wait until ``check`` returns a value for notification on the channel
+
+        Parameters
+        ----------
+        channel : str
+            Channel to wait on
+        check : callable
+            Called with each notification payload or with ``None`` when
+            the value should be read directly. Should return ``None`` until
+            the waited for value is available.
+        timeout : float, optional
+            Maximum number of seconds to wait
+        interval : float, optional
+            How often ``on_interval`` should be called while waiting
+        on_interval : callable, optional
+            Called periodically while waiting
+
+        Returns
+        -------
+        object
+            Value returned by ``check`` or ``None`` on timeout
+        """
+        self.start()
+        waiter = self.add(channel)
+        deadline = None if timeout is None else time.time() + timeout
+        try:
+            while True:
+                wait = interval
+                if deadline is not None:
+                    wait = min(wait, max(deadline - time.time(), 0))
+                if waiter.event.wait(wait):
+                    waiter.event.clear()
+                    while waiter.notifications:
+                        result = check(waiter.notifications.popleft())
+                        if result is not None:
+                            return result
+                if on_interval:
+                    on_interval()
+                if deadline is not None and time.time() >= deadline:
+                    return None
+        finally:
+            self.remove(waiter)
+
+
+_subscribers = {}
+_subscribers_lock = threading.Lock()
+
+
+def get_result_subscriber(key, client_factory, **kwargs):
+    """
+    Get process-wide :class:`.ResultSubscriber` for the given key
+
+    Parameters
+    ----------
+    key : object
+        Hashable key identifying redis server such as sentinel addresses,
+        service name and db
+    client_factory : callable
+        Passed to :class:`.ResultSubscriber` when it is created
+    kwargs : dict
+        Any keyword arguments to be passed to :class:`.ResultSubscriber`
+        when it is created
+
+    Returns
+    -------
+    ResultSubscriber
+    """
+    # subscription thread does not survive fork
+    key = (os.getpid(), key)
+    with _subscribers_lock:
+        subscriber = _subscribers.get(key)
+        if subscriber is None:
+            subscriber = _subscribers[key] = ResultSubscriber(client_factory, **kwargs)
+    return subscriber
@@ -2,8 +2,11 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 from celery import Task
+from kombu.utils import uuid
 
 from .redis_sentinel import ensure_redis_call
+from .retry import RetryPolicy
+from .spool import PUBLISH_ERRORS
 
 
 class EnsuredRedisTask(Task):
@@ -15,6 +18,19 @@ class EnsuredRedisTask(Task):
     This task subclass can be provided during task definition
     by using ``base`` parameter.
 
+    Alternatively, instead of blocking while failover is in progress,
+    messages which could not be published can be spooled into
+    :class:`PublishSpool <celery_redis_sentinel.spool.PublishSpool>`
+    by providing ``publish_spool``. In that case ``apply_async``
+    returns right away and spooled messages are published in the
+    background as soon as new master is elected. Messages persisted
+    by the spool before process restart are replayed as soon as
+    the task is published again.
+
+    Retries follow ``redis_retry_policy`` when provided or ``retry_policy``
+    broker transport option otherwise.
+    See :class:`RetryPolicy <celery_redis_sentinel.retry.RetryPolicy>` for details.
+
     Examples
     --------
 
@@ -23,9 +39,106 @@ class EnsuredRedisTask(Task):
         @app.task(base=EnsuredRedisTask)
         def add(a, b):
             return a + b
+
+        @app.task(base=EnsuredRedisTask, publish_spool=PublishSpool(path='/tmp/spool'))
+        def multiply(a, b):
+            return a * b
     """
     abstract = True
+    publish_spool = None
+    redis_retry_policy = None
+
+    def get_redis_retry_policy(self):
+        """
+        Get retry policy of ``apply_async`` calls
+
+        Returns
+        -------
+        RetryPolicy
+            ``redis_retry_policy`` of the task or ``retry_policy``
+            broker transport option
+        """
+        if self.redis_retry_policy is not None:
+            return RetryPolicy.from_options(self.redis_retry_policy)
+        transport_options = self.app.conf.get('BROKER_TRANSPORT_OPTIONS') or {}
+        return RetryPolicy.from_options(transport_options.get('retry_policy'))
 
     def apply_async(self, *args, **kwargs):
         _super = super(EnsuredRedisTask, self).apply_async
-        return ensure_redis_call(_super, *args, **kwargs)
+        if self.publish_spool is None:
+            kwargs.setdefault('redis_retry_policy', self.get_redis_retry_policy())
+            return ensure_redis_call(_super, *args, **kwargs)
+        return self._spooled_apply_async(*args, **kwargs)
+
+    def _spooled_apply_async(self, args=None, kwargs=None, task_id=None, **options):
+        task_id = task_id or uuid()
+        if len(self.publish_spool):
+            # messages loaded from persisted spool after restart
+            # are replayed even when nothing fails to publish anymore
+            self.publish_spool.start(self.app)
+        try:
+            return super(EnsuredRedisTask, self).apply_async(args, kwargs, task_id=task_id, **options)
+        except PUBLISH_ERRORS:
+            options.pop('producer', None)
+            if not self.publish_spool.put(self.name, args, kwargs, dict(options, task_id=task_id)):
+                raise
+            self.publish_spool.start(self.app)
+            return self.AsyncResult(task_id)
+
+
+def publish_many(task, iterable_of_args, chunk_size=1000, **options):
+    """
+    Publish the task once for each item of the given iterable
+    in pipelined chunks instead of one round trip per message.
+
+    Messages are serialized right away and buffered by the
+    :meth:`buffered_puts <celery_redis_sentinel.transport.SentinelChannel.buffered_puts>`
+    of the broker channel. Every ``chunk_size`` messages are pushed
+    to redis in a single ``MULTI``/``EXEC`` pipeline which is retried
+    as a whole during failover. Chunks which were already pushed
+    are not published again when later chunks are retried.
+
+    When broker channel does not support buffering
+    (e.g. broker is not :class:`SentinelTransport
+    <celery_redis_sentinel.transport.SentinelTransport>`),
+    messages are published one by one.
+
+    Parameters
+    ----------
+    task : celery.Task
+        Task to be published
+    iterable_of_args : iterable
+        Positional arguments of each task to be published
+    chunk_size : int, optional
+        Number of messages pushed to redis in a single pipeline.
+        By default ``1000``.
+    options
+        Additional options passed to ``apply_async`` of every task
+        such as ``kwargs`` or ``queue``.
+
+    Returns
+    -------
+    list
+        ``AsyncResult`` of every published task
+
+    Examples
+    --------
+
+    ::
+
+        results = publish_many(add, ((i, i) for i in range(50000)))
+    """
+    results = []
+    with task.app.producer_or_acquire() as producer:
+        channel = producer.channel
+        if not hasattr(channel, 'buffered_puts'):
+            for args in iterable_of_args:
+                results.append(task.apply_async(args, producer=producer, **options))
+            return results
+
+        with channel.buffered_puts():
+            for args in iterable_of_args:
+                results.append(task.apply_async(args, producer=producer, **options))
+                if channel.pending_puts >= chunk_size:
+                    channel.flush_puts()
+    return results
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import math
+import threading
+from collections import deque
+
+from redis import TimeoutError
+
+from .metrics import timer
+
+
+#: Commands which block server-side hence their latency
+#: says nothing about the health of the connection
+BLOCKING_COMMANDS = frozenset([
+    'BLPOP', 'BRPOP', 'BRPOPLPUSH', 'BLMOVE', 'BZPOPMIN', 'BZPOPMAX',
+    'XREAD', 'XREADGROUP', 'WAIT',
+    'SUBSCRIBE', 'PSUBSCRIBE', 'UNSUBSCRIBE', 'PUNSUBSCRIBE', 'MONITOR',
+])
+
+
+class AdaptiveTimeout(object):
+    """
+    Command timeout derived from observed command latencies.
+
+    Instead of a single ``socket_timeout`` which is either too short
+    while the master is busy (causing needless retries) or too long
+    to quickly detect failover, the timeout follows the ``percentile``
+    of recent command latencies multiplied by ``multiplier``
+    within ``[minimum, maximum]`` bounds.
+    Until ``min_samples`` latencies are observed, ``minimum`` is used.
+
+    Adaptive timeouts can be enabled via ``adaptive_timeout`` transport
+    option which accepts ``True`` or the parameters as a ``dict``::
+
+        CELERY_RESULT_BACKEND_TRANSPORT_OPTIONS = {
+            ...
+            'socket_timeout': 0.1,
+            'adaptive_timeout': {
+                'percentile': 99,
+                'multiplier': 3,
+                'maximum': 2,
+            },
+        }
+
+    Parameters
+    ----------
+    minimum : float, optional
+        Minimum timeout in seconds. By default ``0.1`` unless
+        configured via transport options in which case ``socket_timeout``.
+    maximum : float, optional
+        Maximum timeout in seconds. By default ``10 * minimum``.
+    percentile : float, optional
+        Percentile of observed latencies the timeout is derived from.
+        By default ``99``.
+    multiplier : float, optional
+        Multiplier of the latency percentile. By default ``3``.
+    window : int, optional
+        Number of most recent latencies the percentile is computed from.
+        By default ``1000``.
+    min_samples : int, optional
+        Number of latencies which need to be observed before
+        the timeout adapts. By default ``100``.
+    update_every : int, optional
+        Number of observed latencies after which the timeout
+        is computed again. By default ``50``.
+    """
+
+    def __init__(self, minimum=0.1, maximum=None, percentile=99, multiplier=3,
+                 window=1000, min_samples=100, update_every=50):
+        self.minimum = minimum
+        self.maximum = maximum if maximum is not None else 10 * minimum
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self.update_every = update_every
+        self.latencies = deque(maxlen=window)
+        self.timeout = minimum
+        self._observed = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_options(cls, options, socket_timeout):
+        """
+        Get adaptive timeout from transport option value
+
+        Parameters
+        ----------
+        options : AdaptiveTimeout, dict, bool, None
+            Adaptive timeout itself, keyword arguments for it,
+            ``True`` for defaults or ``None``/``False`` when disabled
+        socket_timeout : float, None
+            Default ``minimum`` of the timeout
+
+        Returns
+        -------
+        AdaptiveTimeout, None
+        """
+        if not options:
+            return None
+        if isinstance(options, cls):
+            return options
+        if options is True:
+            options = {}
+        options = dict(options)
+        if socket_timeout is not None:
+            options.setdefault('minimum', socket_timeout)
+        return cls(**options)
+
+    def observe(self, latency):
+        """
+        Record latency of a command and compute the timeout again
+        every ``update_every`` observations
+
+        Parameters
+        ----------
+        latency : float
+            Number of seconds it took to execute the command
+        """
+        self.latencies.append(latency)
+        with self._lock:
+            self._observed += 1
+            if self._observed % self.update_every:
+                return
+            latencies = sorted(self.latencies)
+        if len(latencies) < self.min_samples:
+            return
+        index = max(int(math.ceil(len(latencies) * self.percentile / 100.0)) - 1, 0)
+        timeout = latencies[index] * self.multiplier
+        self.timeout = min(max(timeout, self.minimum), self.maximum)
+
+
+class AdaptiveTimeoutConnectionMixin(object):
+    """
+    Mixin for redis ``Connection`` classes which reads replies
+    of single commands with :class:`.AdaptiveTimeout` of the connection
+    class and records their latency.
+
+    Commands which time out are recorded with the time waited for their
+    reply hence repeated timeouts (e.g. while the master is busy)
+    raise the timeout up to ``maximum`` of :class:`.AdaptiveTimeout`.
+
+    Replies of :data:`.BLOCKING_COMMANDS`, pipelines and pub/sub messages
+    are read with the regular ``socket_timeout``.
+    """
+    adaptive_timeout = None
+    _command_started = None
+
+    def send_command(self, *args, **kwargs):
+        name = args[0] if args else ''
+        if isinstance(name, bytes):
+            name = name.decode('utf-8')
+        self._command_started = None
+        super(AdaptiveTimeoutConnectionMixin, self).send_command(*args, **kwargs)
+        if self.adaptive_timeout is not None and name.upper() not in BLOCKING_COMMANDS:
+            self._command_started = timer()
+
+    def read_response(self, *args, **kwargs):
+        started = self._command_started
+        sock = getattr(self, '_sock', None)
+        if started is None or sock is None:
+            return super(AdaptiveTimeoutConnectionMixin, self).read_response(*args, **kwargs)
+
+        self._command_started = None
+        sock.settimeout(self.adaptive_timeout.timeout)
+        try:
+            response = super(AdaptiveTimeoutConnectionMixin, self).read_response(*args, **kwargs)
+        except TimeoutError:
+            self.adaptive_timeout.observe(timer() - started)
+            raise
+        finally:
+            # connection is disconnected when reading fails
+            if self._sock is sock:
+                sock.settimeout(self.socket_timeout)
+        self.adaptive_timeout.observe(timer() - started)
+        return response
@@ -1,10 +1,53 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
+import logging
+import socket
+from contextlib import contextmanager
 
-from kombu.transport.redis import Channel, Transport
-from kombu.utils import cached_property
+from kombu.transport.redis import Channel, MultiChannelPoller, Transport
+from redis import ConnectionError, TimeoutError
 
-from .redis_sentinel import CelerySentinelConnectionPool, get_redis_via_sentinel
+from .discovery import get_switch_master_listener
+from .metrics import timer
+from .retry import RetryPolicy
+from .sharding import HashRing
+from .redis_sentinel import (
+    TRANSACTION_RETRY,
+    CelerySentinelConnectionPool,
+    EnsuredRedisMixin,
+    PersistentSentinel,
+    PinnedConnectionPool,
+    get_redis_via_sentinel,
+    get_shared_connection_pool,
+    keepalive_options,
+)
+from .utils import fork_aware_cached_property
+
+
+logger = logging.getLogger(__name__)
+
+
+def shutdown_connection(connection):
+    """
+    Shutdown socket of the redis connection without closing it.
+
+    Unlike closing the socket, shutting it down keeps the file descriptor valid
+    hence the event loop polling the socket is notified that the socket
+    became readable. Subsequent read then fails with ``ConnectionError``
+    which kicks off kombu's reconnection logic.
+
+    Parameters
+    ----------
+    connection : redis.Connection
+        Redis connection whose socket should be shutdown
+    """
+    sock = getattr(connection, '_sock', None)
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except (OSError, socket.error):
+        pass
 
 
 class SentinelChannel(Channel):
@@ -24,55 +67,846 @@ class SentinelChannel(Channel):
                 'service_name': 'master',
                 'socket_timeout': 0.1,
             }
+
+        Optionally ``master_cache_ttl`` can be provided which enables caching
+        of discovered master address in the process-wide master address cache
+        for the given number of seconds. With ``shared_master_cache``
+        the cache is shared by all worker pool processes.
+        See :func:`share_master_address_cache
+        <celery_redis_sentinel.discovery.share_master_address_cache>`.
+        ``parallel_discovery`` can be set to ``True`` in order to query all
+        sentinels at once while discovering master in which case
+        ``discovery_quorum`` sentinels (by default ``1``) need to agree
+        on the master address.
+        When ``rank_sentinels`` is ``True``, sentinels are queried from the
+        healthiest one and repeatedly failing sentinels are skipped for
+        ``sentinel_cooldown`` seconds (by default ``30``).
+        When ``persistent_sentinels`` is ``True``, connections to sentinels
+        are kept open (see :class:`PersistentSentinel
+        <celery_redis_sentinel.redis_sentinel.PersistentSentinel>`) and checked
+        after being idle for ``sentinel_health_check_interval`` seconds
+        (by default ``30``).
+        When ``failover_detection`` is ``True``, the channel subscribes to
+        sentinel ``+switch-master`` notifications and as soon as the master
+        is switched, the channel fails with ``ConnectionError`` instead of
+        waiting for the connection to the old master to fail or timeout.
+        See :meth:`on_switch_master` for details.
+
+        Messages can be published in pipelined batches via :meth:`buffered_puts`.
+
+        Queues can be sharded across several sentinel services (masters)
+        by providing ``service_names``. See :meth:`shard_channel` for details.
+
+        Since the master is pinned, a connection to a master which silently
+        disappeared (e.g. network partition) would otherwise only fail after
+        TCP timeouts. TCP keepalive can be tuned via ``socket_keepalive_idle``,
+        ``socket_keepalive_interval`` and ``socket_keepalive_count``
+        (in seconds or number of probes) which also enable ``socket_keepalive``.
+        When ``master_health_check_interval`` is provided, the master is
+        checked via ``PING`` between ``BRPOP`` calls and ``BRPOP`` which
+        is not replied in time fails. See :meth:`check_master_health`
+        and :meth:`check_brpop_health` for details.
+
+        ``socket_timeout`` applies to redis commands and, unless
+        ``sentinel_socket_timeout`` is provided, to sentinel queries.
+        Connecting to the master is limited by ``socket_connect_timeout``.
+        When ``adaptive_timeout`` is provided, command timeouts follow
+        observed command latencies. See :class:`AdaptiveTimeout
+        <celery_redis_sentinel.timeouts.AdaptiveTimeout>` for details.
+
+        When ``shared_pool`` is ``True``, the channel uses the process-wide
+        connection pool which is also used by the results backend with the same
+        option hence the master is discovered once and connections are reused.
+        See :attr:`sentinel_pool` for details.
     """
     from_transport_options = Channel.from_transport_options + (
         'sentinels',
         'service_name',
+        'service_names',
         'socket_timeout',
+        'master_cache_ttl',
+        'parallel_discovery',
+        'discovery_quorum',
+        'failover_detection',
+        'rank_sentinels',
+        'sentinel_cooldown',
+        'persistent_sentinels',
+        'sentinel_health_check_interval',
+        'retry_policy',
+        'socket_keepalive_idle',
+        'socket_keepalive_interval',
+        'socket_keepalive_count',
+        'master_health_check_interval',
+        'master_health_check_timeout',
+        'sentinel_socket_timeout',
+        'adaptive_timeout',
+        'shared_pool',
     )
 
-    @cached_property
+    service_names = None
+    master_cache_ttl = None
+    parallel_discovery = False
+    discovery_quorum = 1
+    failover_detection = False
+    rank_sentinels = False
+    sentinel_cooldown = 30
+    persistent_sentinels = False
+    sentinel_health_check_interval = 30
+    retry_policy = None
+    socket_keepalive_idle = None
+    socket_keepalive_interval = None
+    socket_keepalive_count = None
+    master_health_check_interval = None
+    master_health_check_timeout = 1
+    sentinel_socket_timeout = None
+    adaptive_timeout = None
+    shared_pool = False
+
+    _master_address = None
+    _master_switched = False
+    _switch_master_listener = None
+    _put_pipeline = None
+    _buffering_put = False
+    _shard_channels = None
+    _brpop_sent_at = None
+    _health_checked_at = None
+
+    def _connparams(self, *args, **kwargs):
+        params = super(SentinelChannel, self)._connparams(*args, **kwargs)
+        keepalive = dict(
+            (i, int(getattr(self, 'socket_keepalive_{}'.format(i))))
+            for i in ('idle', 'interval', 'count')
+            if getattr(self, 'socket_keepalive_{}'.format(i)) is not None
+        )
+        if keepalive:
+            options = dict(params.get('socket_keepalive_options') or {})
+            options.update(keepalive_options(**keepalive))
+            params['socket_keepalive'] = True
+            params['socket_keepalive_options'] = options
+        return params
+
+    def _sentinel_params(self):
+        params = self._connparams()
+        params.update({
+            'sentinels': self.sentinels,
+            'service_name': self.service_name,
+            'socket_timeout': self.socket_timeout,
+            'master_cache_ttl': self.master_cache_ttl,
+            'parallel_discovery': self.parallel_discovery,
+            'discovery_quorum': self.discovery_quorum,
+            'sentinel_socket_timeout': self.sentinel_socket_timeout,
+            'adaptive_timeout': self.adaptive_timeout,
+        })
+        if self.rank_sentinels:
+            params.update({
+                'rank_sentinels': self.rank_sentinels,
+                'sentinel_cooldown': self.sentinel_cooldown,
+            })
+        if self.persistent_sentinels:
+            params.update({
+                'sentinel_class': PersistentSentinel,
+                'sentinel_health_check_interval': self.sentinel_health_check_interval,
+            })
+        return params
+
+    @fork_aware_cached_property
     def sentinel_pool(self):
         """
         Cached property for getting connection pool to redis sentinel.
+        The pool is created again after ``fork``.
 
         In addition to returning connection pool, this property
         changes the ``Transport`` connection details to match the
         connected master so that celery can correctly log to which
         node it is actually connected.
 
+        When ``shared_pool`` is enabled, returned pool is a
+        :class:`PinnedConnectionPool <celery_redis_sentinel.redis_sentinel.PinnedConnectionPool>`
+        view of the process-wide pool which pins the master the same way
+        :class:`CelerySentinelConnectionPool <celery_redis_sentinel.redis_sentinel.CelerySentinelConnectionPool>`
+        does while the shared pool itself keeps following the master.
+
         Returns
         -------
-        CelerySentinelConnectionPool
+        CelerySentinelConnectionPool, PinnedConnectionPool
             Connection pool instance connected to redis sentinel
         """
-        params = self._connparams()
-        params.update({
-            'sentinels': self.sentinels,
-            'service_name': self.service_name,
-            'socket_timeout': self.socket_timeout,
-        })
-        sentinel = get_redis_via_sentinel(
-            redis_class=self.Client,
-            connection_pool_class=CelerySentinelConnectionPool,
-            **params
-        )
-        pool = sentinel.connection_pool
+        if self.shared_pool:
+            pool = PinnedConnectionPool(get_shared_connection_pool(**self._sentinel_params()))
+        else:
+            pool = get_redis_via_sentinel(
+                redis_class=self.Client,
+                connection_pool_class=CelerySentinelConnectionPool,
+                **self._sentinel_params()
+            ).connection_pool
         hostname, port = pool.get_master_address()
+        self._update_connection_address(hostname, port)
+
+        self._master_address = (hostname, int(port))
+        if self.failover_detection:
+            self._switch_master_listener = get_switch_master_listener(
+                self.sentinels, self.service_name,
+                socket_timeout=self._sentinel_socket_timeout,
+            )
+            self._switch_master_listener.add_callback(self.on_switch_master)
+
+        return pool
 
+    def _update_connection_address(self, hostname, port):
         # update connection details so that celery correctly logs
         # where it connects
         self.connection.client.hostname = hostname
         self.connection.client.port = port
 
-        return pool
+    @property
+    def _sentinel_socket_timeout(self):
+        if self.sentinel_socket_timeout is not None:
+            return self.sentinel_socket_timeout
+        return self.socket_timeout
+
+    @fork_aware_cached_property
+    def publish_client(self):
+        """
+        Cached property for getting ``Redis`` client used to flush
+        messages buffered by :meth:`buffered_puts`.
+        The client is created again after ``fork``.
+
+        Unlike :attr:`sentinel_pool` which pins the master, this client
+        follows the master during failover and subclasses from
+        :class:`EnsuredRedisMixin <celery_redis_sentinel.redis_sentinel.EnsuredRedisMixin>`
+        hence each flushed chunk is retried until new master is elected
+        even though it is a ``MULTI``/``EXEC`` transaction.
+
+        Returns
+        -------
+        Redis
+            Redis client connected to Sentinel via Sentinel connection pool
+        """
+        redis_class = type(str('Redis'), (EnsuredRedisMixin, self.Client), {
+            'retry_policy': RetryPolicy.from_options(self.retry_policy),
+            # publishing is at-least-once anyway hence a chunk
+            # which the old master applied can be pushed again
+            'transaction_retry_policy': TRANSACTION_RETRY,
+        })
+        if self.shared_pool:
+            return redis_class(connection_pool=get_shared_connection_pool(**self._sentinel_params()))
+        return get_redis_via_sentinel(redis_class=redis_class, **self._sentinel_params())
+
+    @contextmanager
+    def buffered_puts(self):
+        """
+        Context manager which buffers published messages instead of
+        pushing them to redis one by one.
+
+        Messages are serialized right away but their ``LPUSH`` commands
+        are queued in a ``MULTI``/``EXEC`` pipeline of :attr:`publish_client`
+        which is sent with :meth:`flush_puts`. That allows to publish many
+        messages in a single round trip. Messages still buffered when
+        the context exits are flushed. When the context exits with
+        an exception, buffered messages are discarded.
+
+        .. note::
+            Only messages delivered to queues are buffered.
+            Fanout messages are published right away.
+
+        Examples
+        --------
+
+        ::
+
+            with channel.buffered_puts():
+                for body in bodies:
+                    producer.publish(body, routing_key='celery')
+                    if channel.pending_puts >= 1000:
+                        channel.flush_puts()
+        """
+        self._put_pipeline = self.publish_client.pipeline()
+        for channel in self.shard_channels.values():
+            channel._put_pipeline = channel.publish_client.pipeline()
+        try:
+            yield self
+            self.flush_puts()
+        finally:
+            self._put_pipeline = None
+            for channel in self.shard_channels.values():
+                channel._put_pipeline = None
+
+    @property
+    def pending_puts(self):
+        """
+        Number of messages buffered by :meth:`buffered_puts` which were not flushed yet
+        """
+        pending = 0
+        for channel in [self] + list(self.shard_channels.values()):
+            if channel._put_pipeline is not None:
+                pending += len(channel._put_pipeline)
+        return pending
+
+    def flush_puts(self):
+        """
+        Send messages buffered by :meth:`buffered_puts` in a single pipeline.
+
+        Since the pipeline is a ``MULTI``/``EXEC`` transaction, either all
+        messages of the chunk are pushed or none of them are.
+        During failover the whole chunk is retried according to the
+        ``retry_policy`` broker transport option. Once retries are exhausted,
+        the error is raised and messages of the chunk are discarded.
+
+        When queues are sharded, each shard is sent its own pipeline.
+        """
+        for channel in [self] + list(self.shard_channels.values()):
+            pipeline = channel._put_pipeline
+            if not pipeline:
+                continue
+            try:
+                pipeline.execute()
+            finally:
+                pipeline.reset()
+
+    @contextmanager
+    def conn_or_acquire(self, client=None):
+        if self._buffering_put and client is None:
+            yield self._put_pipeline
+        else:
+            with super(SentinelChannel, self).conn_or_acquire(client) as client:
+                yield client
+
+    @property
+    def shard_ring(self):
+        """
+        :class:`HashRing <celery_redis_sentinel.sharding.HashRing>` of ``service_names``
+        or ``None`` when queues are not sharded
+        """
+        if not self.service_names:
+            return None
+        if self.__dict__.get('_shard_ring') is None:
+            self.__dict__['_shard_ring'] = HashRing(self.service_names)
+        return self.__dict__['_shard_ring']
+
+    @property
+    def shard_channels(self):
+        """
+        Channels of other shards created so far keyed by their service name
+        """
+        if self._shard_channels is None:
+            self._shard_channels = {}
+        return self._shard_channels
+
+    def shard_channel(self, queue):
+        """
+        Get channel of the shard (sentinel service) the queue belongs to.
+
+        When ``service_names`` transport option is provided, queues are
+        spread across their masters with consistent hashing.
+        Queues of ``service_name`` (home shard) are served by this channel.
+        For other shards a :class:`.ShardChannel` is created on first use
+        which has its own master discovery, connection pool and
+        failover handling hence failover of one shard does not
+        affect publishing to other shards.
+        Messages of sharded queues are consumed via ``BRPOP``
+        of their shard channels which are polled together with this channel.
+
+        Exchange bindings, unacknowledged messages (``ack_emulation``)
+        and fanout messages are always stored in the home shard.
+
+        Parameters
+        ----------
+        queue : str
+            Queue name
+
+        Returns
+        -------
+        SentinelChannel
+            This channel or channel of the shard
+        """
+        ring = self.shard_ring
+        if ring is None:
+            return self
+        service_name = ring.get_node(queue)
+        if service_name == self.service_name:
+            return self
+        channel = self.shard_channels.get(service_name)
+        if channel is None:
+            channel = self.shard_channels[service_name] = ShardChannel(self, service_name)
+            if self._put_pipeline is not None:
+                channel._put_pipeline = channel.publish_client.pipeline()
+        return channel
+
+    def _shard_queues(self, service_name):
+        ring = self.shard_ring
+        return set(
+            queue for queue in super(SentinelChannel, self).active_queues
+            if ring.get_node(queue) == service_name
+        )
+
+    @property
+    def active_queues(self):
+        if self.shard_ring is None:
+            return super(SentinelChannel, self).active_queues
+        return self._shard_queues(self.service_name)
+
+    def _update_cycle(self):
+        # kombu < 4
+        super(SentinelChannel, self)._update_cycle()
+        for channel in self._consumed_shard_channels():
+            channel._update_cycle()
+
+    def _update_queue_cycle(self):
+        super(SentinelChannel, self)._update_queue_cycle()
+        for channel in self._consumed_shard_channels():
+            channel._update_queue_cycle()
+
+    def _consumed_shard_channels(self):
+        # creates channels of shards which started to be consumed from
+        # hence they are added to the poller
+        if self.shard_ring is None:
+            return []
+        for queue in super(SentinelChannel, self).active_queues:
+            self.shard_channel(queue)
+        return list(self.shard_channels.values())
+
+    def reset_shard_channel(self, channel):
+        """
+        Close channel of a shard which failed with connection error
+        without affecting this channel and channels of other shards.
+
+        The channel is recreated by :meth:`restore_shard_channels`
+        hence it discovers the master of its shard again.
+
+        Parameters
+        ----------
+        channel : ShardChannel
+            Failed channel of the shard
+        """
+        if self.shard_channels.get(channel.service_name) is channel:
+            del self.shard_channels[channel.service_name]
+        # BRPOP reply cannot be read anymore
+        channel._in_poll = None
+        try:
+            channel.close()
+        except (ConnectionError, TimeoutError):
+            pass
+
+    def restore_shard_channels(self):
+        """
+        Create channels of consumed shards which are missing
+        since they were reset by :meth:`reset_shard_channel`.
+
+        Raises
+        ------
+        ConnectionError
+            When the master of some shard is still not reachable
+        """
+        existing = set(self.shard_channels.values())
+        try:
+            self._consumed_shard_channels()
+        finally:
+            for channel in list(self.shard_channels.values()):
+                if channel in existing:
+                    continue
+                update = getattr(channel, '_update_queue_cycle', None)
+                if update is None:
+                    # kombu < 4
+                    update = channel._update_cycle
+                update()
+
+    def _do_restore_message(self, payload, exchange, routing_key, client=None, *args, **kwargs):
+        if self.shard_ring is not None:
+            client = ShardRouter(self, client)
+        return super(SentinelChannel, self)._do_restore_message(
+            payload, exchange, routing_key, client, *args, **kwargs
+        )
+
+    def _get(self, queue):
+        channel = self.shard_channel(queue)
+        if channel is not self:
+            return channel._get(queue)
+        return super(SentinelChannel, self)._get(queue)
+
+    def _size(self, queue):
+        channel = self.shard_channel(queue)
+        if channel is not self:
+            return channel._size(queue)
+        return super(SentinelChannel, self)._size(queue)
+
+    def _purge(self, queue):
+        channel = self.shard_channel(queue)
+        if channel is not self:
+            return channel._purge(queue)
+        return super(SentinelChannel, self)._purge(queue)
+
+    def _has_queue(self, queue, **kwargs):
+        channel = self.shard_channel(queue)
+        if channel is not self:
+            return channel._has_queue(queue, **kwargs)
+        return super(SentinelChannel, self)._has_queue(queue, **kwargs)
+
+    def _delete(self, queue, *args, **kwargs):
+        # bindings are stored in the home shard
+        super(SentinelChannel, self)._delete(queue, *args, **kwargs)
+        channel = self.shard_channel(queue)
+        if channel is not self:
+            channel._purge(queue)
+
+    def _put(self, queue, message, **kwargs):
+        channel = self.shard_channel(queue)
+        if channel is not self:
+            return channel._put(queue, message, **kwargs)
+        if self._put_pipeline is None:
+            return super(SentinelChannel, self)._put(queue, message, **kwargs)
+        self._buffering_put = True
+        try:
+            super(SentinelChannel, self)._put(queue, message, **kwargs)
+        finally:
+            self._buffering_put = False
+
+    def on_switch_master(self, old_address, new_address):
+        """
+        Callback for sentinel ``+switch-master`` notifications.
+
+        Since :class:`.CelerySentinelConnectionPool` pins the master,
+        the channel would otherwise only notice failover once reading
+        ``BRPOP`` response from the old master fails or times out.
+        Instead the channel is marked as switched so that next
+        :meth:`_brpop_start` raises ``ConnectionError`` and sockets of
+        the channel clients are shutdown so that the event loop
+        immediately wakes up and fails reading from them.
+        Either way kombu starts its reconnection logic right away.
+
+        .. note::
+            This is called from the sentinel listener thread.
+        """
+        if new_address == self._master_address:
+            return
+        self._master_switched = True
+        for attr in 'client', 'subclient':
+            client = self.__dict__.get(attr)
+            shutdown_connection(getattr(client, 'connection', None))
+
+    def _brpop_start(self, *args, **kwargs):
+        if self._master_switched:
+            raise ConnectionError(
+                'Sentinel switched master from {}:{}'.format(*self._master_address)
+            )
+        if self.master_health_check_interval:
+            checked_at = self._health_checked_at
+            if checked_at is None or timer() - checked_at >= self.master_health_check_interval:
+                self.check_master_health()
+        result = super(SentinelChannel, self)._brpop_start(*args, **kwargs)
+        if self._in_poll:
+            self._brpop_sent_at = timer()
+        return result
+
+    def _brpop_read(self, *args, **kwargs):
+        try:
+            return super(SentinelChannel, self)._brpop_read(*args, **kwargs)
+        finally:
+            self._brpop_sent_at = None
+
+    def check_master_health(self):
+        """
+        Check the master by sending ``PING`` over the ``BRPOP`` connection.
+
+        This is called before sending ``BRPOP`` when the master
+        was not checked for ``master_health_check_interval`` seconds.
+
+        Raises
+        ------
+        ConnectionError
+            When master does not reply within ``master_health_check_timeout``
+            seconds which kicks off kombu's reconnection logic
+        """
+        self._health_checked_at = timer()
+        connection = getattr(self.client, 'connection', None)
+        if connection is None or getattr(connection, '_sock', None) is None:
+            # new connection is checked while connecting
+            return
+        connection.send_command('PING')
+        if not connection.can_read(timeout=self.master_health_check_timeout):
+            raise ConnectionError('Master {}:{} did not reply to PING within {} seconds'.format(
+                self._master_address[0], self._master_address[1], self.master_health_check_timeout,
+            ))
+        connection.read_response()
+
+    def check_brpop_health(self):
+        """
+        Check that ``BRPOP`` sent to the master is replied in time.
+
+        Redis replies to ``BRPOP`` at the latest after its timeout
+        (``brpop_timeout``, by default ``1`` second) hence when
+        ``master_health_check_interval`` is provided and the reply
+        does not arrive within additional ``master_health_check_timeout``
+        seconds, the master is considered unreachable.
+
+        This is called by :class:`.SentinelMultiChannelPoller`
+        while the channel waits for ``BRPOP`` reply.
+
+        .. note::
+            Redis pops the message before replying to ``BRPOP`` hence
+            a message whose reply is lost (e.g. master became unreachable
+            right after popping it) is lost no matter how the dead
+            connection is detected. Ack emulation only protects messages
+            which were already received. However the reply might be
+            just overdue because the event loop was busy
+            in which case it is already received and is read
+            instead of aborting ``BRPOP``.
+
+        Raises
+        ------
+        ConnectionError
+            When ``BRPOP`` reply is overdue which kicks off
+            kombu's reconnection logic
+        """
+        sent_at = self._brpop_sent_at
+        if not self.master_health_check_interval or sent_at is None:
+            return
+        deadline = getattr(self, 'brpop_timeout', 1) + self.master_health_check_timeout
+        if timer() - sent_at > deadline:
+            connection = getattr(self.__dict__.get('client'), 'connection', None)
+            if getattr(connection, '_sock', None) is not None and connection.can_read(timeout=0):
+                # reply was received while event loop was busy
+                return
+            self._brpop_sent_at = None
+            # reply is not waited for anymore (e.g. while closing the channel)
+            self._in_poll = None
+            if connection is not None:
+                connection.disconnect()
+            raise ConnectionError('Master {}:{} did not reply to BRPOP within {} seconds'.format(
+                self._master_address[0], self._master_address[1], deadline,
+            ))
 
     def _get_pool(self, *args, **kwargs):
         return self.sentinel_pool
 
+    def _close_clients(self):
+        # unlike kombu, connections are released back to their pool
+        # since with shared_pool the pool outlives the channel
+        for attr in 'client', 'subclient':
+            client = self.__dict__.get(attr)
+            connection = getattr(client, 'connection', None)
+            if connection is None:
+                continue
+            client.connection = None
+            try:
+                connection.disconnect()
+            finally:
+                client.connection_pool.release(connection)
+
+    def close(self):
+        for channel in list(self.shard_channels.values()):
+            channel.close()
+        self.shard_channels.clear()
+        if self._switch_master_listener is not None:
+            self._switch_master_listener.remove_callback(self.on_switch_master)
+            self._switch_master_listener = None
+        super(SentinelChannel, self).close()
+
+
+class ShardChannel(SentinelChannel):
+    """
+    Channel of a single shard of :class:`.SentinelChannel`
+    when queues are sharded via ``service_names`` transport option.
+
+    Shard channel connects to the master of its own sentinel service
+    and consumes queues of the parent channel which belong to the shard.
+    Consumed messages are acknowledged via QoS of the parent channel.
+
+    Parameters
+    ----------
+    parent : SentinelChannel
+        Channel which routes queues to this shard
+    service_name : str
+        Sentinel service name of the shard
+    """
+    from_transport_options = tuple(
+        i for i in SentinelChannel.from_transport_options
+        if i not in ('service_name', 'service_names')
+    )
+
+    def __init__(self, parent, service_name, *args, **kwargs):
+        self.parent = parent
+        self.service_name = service_name
+        super(ShardChannel, self).__init__(parent.connection, *args, **kwargs)
+
+    def _update_connection_address(self, hostname, port):
+        # connection is shared with the parent channel
+        # hence it keeps the address of the parent master
+        pass
+
+    @property
+    def qos(self):
+        return self.parent.qos
+
+    @property
+    def active_queues(self):
+        return self.parent._shard_queues(self.service_name)
+
+
+class ShardRouter(object):
+    """
+    Client wrapper used while restoring unacknowledged messages of sharded
+    queues which pushes messages to the shard of their queue.
+
+    Messages of the home shard are pushed via the wrapped client (or pipeline)
+    hence within its transaction. Messages of other shards are pushed
+    right away via the shard channel.
+
+    Parameters
+    ----------
+    channel : SentinelChannel
+        Channel which routes queues to shards
+    client : Redis, Pipeline
+        Client or pipeline of the home shard
+    """
+
+    def __init__(self, channel, client):
+        self.channel = channel
+        self.client = client
+
+    def __bool__(self):
+        return True
+
+    __nonzero__ = __bool__
+
+    def _push(self, command, key, *values):
+        # priority queues are stored as "<queue><sep><priority>"
+        queue = key.rsplit(self.channel.sep, 1)[0]
+        channel = self.channel.shard_channel(queue)
+        if channel is self.channel:
+            return getattr(self.client, command)(key, *values)
+        with channel.conn_or_acquire() as client:
+            return getattr(client, command)(key, *values)
+
+    def lpush(self, key, *values):
+        return self._push('lpush', key, *values)
+
+    def rpush(self, key, *values):
+        return self._push('rpush', key, *values)
+
+
+class SentinelMultiChannelPoller(MultiChannelPoller):
+    """
+    Poller of :class:`.SentinelTransport` channels which checks
+    ``BRPOP`` of channels waiting for its reply
+    via :meth:`SentinelChannel.check_brpop_health`.
+
+    Connection errors of :class:`.ShardChannel` (e.g. failover
+    or partition of its shard) do not propagate to kombu which would
+    otherwise reconnect all shards. Instead only the failed shard channel
+    is reset via :meth:`SentinelChannel.reset_shard_channel` and the
+    remaining shards keep being consumed. The shard channel is then
+    recreated via :meth:`SentinelChannel.restore_shard_channels`
+    at most once per ``brpop_timeout``.
+    """
+    shard_errors = (ConnectionError, TimeoutError)
+
+    def __init__(self, *args, **kwargs):
+        super(SentinelMultiChannelPoller, self).__init__(*args, **kwargs)
+        # parent channel -> when its shard channels are restored next
+        self._failed_shards = {}
+
+    def _reset_shard(self, channel, error):
+        logger.warning(
+            'Shard %s failed, resetting its channel: %r',
+            channel.service_name, error,
+        )
+        for key in [i for i in self._chan_to_sock if i[0] is channel]:
+            sock = self._chan_to_sock.pop(key)
+            try:
+                self.poller.unregister(sock)
+            except (KeyError, ValueError, TypeError, OSError, socket.error):
+                pass
+        for fileno in [i for i, (chan, _) in self._fd_to_chan.items() if chan is channel]:
+            del self._fd_to_chan[fileno]
+        # channels might be being iterated hence the set is replaced
+        self._channels = self._channels - set([channel])
+        channel.parent.reset_shard_channel(channel)
+        self._failed_shards[channel.parent] = timer() + getattr(channel, 'brpop_timeout', 1)
+
+    def _restore_shards(self):
+        for parent, restore_at in list(self._failed_shards.items()):
+            if parent.closed:
+                del self._failed_shards[parent]
+                continue
+            if timer() < restore_at:
+                continue
+            try:
+                parent.restore_shard_channels()
+            except self.shard_errors as e:
+                logger.warning('Could not restore shard channels: %r', e)
+                self._failed_shards[parent] = timer() + getattr(parent, 'brpop_timeout', 1)
+            else:
+                del self._failed_shards[parent]
+
+    def _register_BRPOP(self, channel):
+        if channel not in self._channels:
+            # shard channel which was reset while iterating channels
+            return
+        try:
+            if channel._in_poll:
+                channel.check_brpop_health()
+            return super(SentinelMultiChannelPoller, self)._register_BRPOP(channel)
+        except self.shard_errors as e:
+            if not isinstance(channel, ShardChannel):
+                raise
+            self._reset_shard(channel, e)
+
+    def on_poll_start(self):
+        self._restore_shards()
+        return super(SentinelMultiChannelPoller, self).on_poll_start()
+
+    def get(self, *args, **kwargs):
+        self._restore_shards()
+        return super(SentinelMultiChannelPoller, self).get(*args, **kwargs)
+
+    def on_readable(self, fileno):
+        if fileno not in self._fd_to_chan:
+            # socket of shard channel which was reset
+            return
+        channel = self._fd_to_chan[fileno][0]
+        try:
+            return super(SentinelMultiChannelPoller, self).on_readable(fileno)
+        except self.shard_errors as e:
+            if not isinstance(channel, ShardChannel):
+                raise
+            self._reset_shard(channel, e)
+
+    def handle_event(self, fileno, event):
+        if fileno not in self._fd_to_chan:
+            # socket of shard channel which was reset
+            return
+        channel = self._fd_to_chan[fileno][0]
+        try:
+            return super(SentinelMultiChannelPoller, self).handle_event(fileno, event)
+        except self.shard_errors as e:
+            if not isinstance(channel, ShardChannel):
+                raise
+            self._reset_shard(channel, e)
+
 
 class SentinelTransport(Transport):
     """
     Redis transport with support for Redis Sentinel.
+
+    All channels within the process share a single sentinel
+    ``+switch-master`` subscription per sentinel service
+    when ``failover_detection`` transport option is enabled.
+    See :class:`.SentinelChannel` for details.
+
+    Queues can be sharded across several sentinel services via
+    ``service_names`` transport option::
+
+        BROKER_TRANSPORT_OPTIONS = {
+            'sentinels': [...],
+            'service_name': 'master-a',
+            'service_names': ['master-a', 'master-b', 'master-c'],
+        }
+
+    See :meth:`SentinelChannel.shard_channel` for details.
     """
     Channel = SentinelChannel
+
+    def __init__(self, *args, **kwargs):
+        super(SentinelTransport, self).__init__(*args, **kwargs)
+        # all channels share the same poller
+        self.cycle = SentinelMultiChannelPoller()
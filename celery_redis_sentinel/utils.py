@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import itertools
+import os
+
+import six
+
+
+class fork_aware_cached_property(object):
+    """
+    Same as ``cached_property`` except the cached value is only used
+    within the process which computed it. After ``fork``, the value
+    is computed again in the child process on first access.
+
+    Values inherited from the parent process are not released in the child
+    but kept referenced by the instance instead. Otherwise garbage collecting
+    them could close (or with some redis-py versions shutdown) sockets
+    which are still used by the parent process.
+
+    Examples
+    --------
+
+    ::
+
+        class Backend(object):
+            @fork_aware_cached_property
+            def client(self):
+                return StrictRedis()
+    """
+
+    def __init__(self, fget):
+        self.fget = fget
+        self.__doc__ = fget.__doc__
+        self.__name__ = fget.__name__
+        self.pid_key = '_{}_pid'.format(self.__name__)
+        self.inherited_key = '_{}_inherited'.format(self.__name__)
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            return self
+        data = obj.__dict__
+        pid = os.getpid()
+        if self.__name__ in data:
+            if data.get(self.pid_key) == pid:
+                return data[self.__name__]
+            data.setdefault(self.inherited_key, []).append(data.pop(self.__name__))
+        value = self.fget(obj)
+        self.__set__(obj, value)
+        return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.__name__] = value
+        obj.__dict__[self.pid_key] = os.getpid()
+
+    def __delete__(self, obj):
+        obj.__dict__.pop(self.__name__, None)
+        obj.__dict__.pop(self.pid_key, None)
+
+
+class truncated_repr(object):
+    """
+    Lazy ``repr`` of an object which is truncated to at most ``limit`` characters.
+
+    The ``repr`` is only computed when the object is formatted
+    hence it is cheap to pass to logging calls which might not be emitted.
+    Strings and bytes are sliced before computing their ``repr``
+    so large payloads are never fully formatted.
+
+    Examples
+    --------
+
+    ::
+
+        logger.warning('Failed to send %s', truncated_repr(payload))
+    """
+
+    def __init__(self, obj, limit=200):
+        self.obj = obj
+        self.limit = limit
+
+    def _repr(self, obj):
+        if isinstance(obj, (six.binary_type, six.text_type)) and len(obj) > self.limit:
+            return '{}...({} total)'.format(repr(obj[:self.limit]), len(obj))
+        if isinstance(obj, list):
+            return '[{}]'.format(', '.join(self._repr(i) for i in obj[:self.limit]))
+        if isinstance(obj, tuple):
+            items = ', '.join(self._repr(i) for i in obj[:self.limit])
+            return '({},)'.format(items) if len(obj) == 1 else '({})'.format(items)
+        if isinstance(obj, dict):
+            return '{{{}}}'.format(', '.join(
+                '{}: {}'.format(self._repr(k), self._repr(v))
+                for k, v in itertools.islice(obj.items(), self.limit)
+            ))
+        return repr(obj)
+
+    def __str__(self):
+        value = self._repr(self.obj)
+        if len(value) > self.limit:
+            value = value[:self.limit] + '...'
+        return value
+
+    __repr__ = __str__
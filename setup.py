@@ -60,7 +60,7 @@ setup(
     long_description=long_description,
     url='https://github.com/dealertrack/celery-redis-sentinel',
     license='MIT',
-    packages=find_packages(exclude=['tests', 'tests.*', 'test_tasks', 'test_tasks.*']),
+    packages=find_packages(exclude=['tests', 'tests.*', 'test_tasks', 'test_tasks.*', 'benchmarks', 'benchmarks.*']),
     install_requires=requirements,
     test_suite='tests',
     tests_require=test_requirements,
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+import pytest
+
+pytest.importorskip('redis.asyncio')
+
+import asyncio  # noqa
+
+import mock  # noqa
+from redis import ConnectionError  # noqa
+from redis.asyncio import StrictRedis  # noqa
+
+from celery_redis_sentinel.aio import (  # noqa
+    EnsuredRedisMixin,
+    ShortLivedSentinel,
+    ShortLivedStrictRedis,
+    apply_async,
+    ensure_redis_call,
+    get_redis_via_sentinel,
+)
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class Bar(object):
+    execute_command = mock.AsyncMock(return_value='foo')
+
+
+class Foo(EnsuredRedisMixin, Bar):
+    pass
+
+
+def test_get_redis_via_sentinel():
+    mock_sentinel = mock.Mock()
+
+    result = get_redis_via_sentinel(
+        db=0,
+        sentinels=['foo', 'bar'],
+        service_name='master',
+        sentinel_class=mock_sentinel,
+    )
+
+    assert result == mock_sentinel.return_value.master_for.return_value
+
+
+@mock.patch('asyncio.sleep', new_callable=mock.AsyncMock)
+def test_ensure_redis_call(mock_sleep):
+    m = mock.AsyncMock(side_effect=ConnectionError)
+
+    with pytest.raises(ConnectionError):
+        run(ensure_redis_call(m, 1, foo='bar', attempts=5))
+
+    mock_sleep.assert_has_calls([
+        mock.call(1),
+        mock.call(2),
+        mock.call(4),
+        mock.call(8),
+        mock.call(16),
+    ])
+    assert m.call_count == 6
+
+
+@mock.patch('asyncio.sleep', new_callable=mock.AsyncMock)
+def test_ensure_redis_call_sync(mock_sleep):
+    m = mock.Mock(side_effect=[ConnectionError, 'foo'])
+
+    assert run(ensure_redis_call(m, 1, foo='bar')) == 'foo'
+    m.assert_called_with(1, foo='bar')
+    mock_sleep.assert_called_once_with(1)
+
+
+@mock.patch('asyncio.sleep', new_callable=mock.AsyncMock)
+def test_ensure_redis_call_retry_policy(mock_sleep):
+    m = mock.Mock(side_effect=[ConnectionError, ConnectionError, ConnectionError, 'foo'])
+
+    assert run(ensure_redis_call(m, redis_retry_policy={'base': 3, 'cap': 5})) == 'foo'
+    mock_sleep.assert_has_calls([mock.call(1), mock.call(3), mock.call(5)])
+
+
+def test_apply_async():
+    task = mock.Mock()
+
+    actual = run(apply_async(task, 'foo', happy='rainbows'))
+
+    assert actual == task.apply_async.return_value
+    task.apply_async.assert_called_once_with('foo', happy='rainbows')
+
+
+class TestEnsuredRedisMixin(object):
+    @mock.patch('celery_redis_sentinel.aio.ensure_redis_call', new_callable=mock.AsyncMock)
+    def test_execute_command(self, mock_ensure_redis_call):
+        f = Foo()
+
+        actual = run(f.execute_command('lrange', 0, -1))
+
+        assert actual == mock_ensure_redis_call.return_value
+        mock_ensure_redis_call.assert_called_once_with(
+            mock.ANY, 'lrange', 0, -1, redis_retry_policy=None,
+        )
+
+
+class TestShortLivedStrictRedis(object):
+    @mock.patch.object(StrictRedis, 'execute_command', new_callable=mock.AsyncMock)
+    def test_execute_command(self, mock_execute_command):
+        r = ShortLivedStrictRedis()
+        r.connection_pool = mock.Mock(disconnect=mock.AsyncMock())
+
+        result = run(r.execute_command('get', 'foo'))
+
+        assert result == mock_execute_command.return_value
+        mock_execute_command.assert_called_once_with('get', 'foo')
+        r.connection_pool.disconnect.assert_called_once_with()
+
+
+class TestShortLivedSentinel(object):
+    def test_init(self):
+        sentinel = ShortLivedSentinel([('localhost', '1'), ('localhost', '2')])
+
+        for s in sentinel.sentinels:
+            assert isinstance(s, ShortLivedStrictRedis)
@@ -2,8 +2,13 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import mock
+import pytest
+from celery.exceptions import TimeoutError as CeleryTimeoutError
+from kombu.utils import symbol_by_name
+from redis import ConnectionError, Redis
 
-from celery_redis_sentinel.backend import RedisSentinelBackend
+from celery_redis_sentinel.backend import RedisSentinelBackend, ShardedResultConsumer
+from celery_redis_sentinel.redis_sentinel import BlockingSentinelConnectionPool, PersistentSentinel
 
 from test_tasks.celeryconfig import BROKER_TRANSPORT_OPTIONS
 from test_tasks.tasks import app
@@ -33,8 +38,452 @@ class TestRedisSentinelBackend(object):
                        ('192.168.1.3', 26379)],
             service_name='master',
             socket_timeout=1,
+            master_cache_ttl=None,
+            parallel_discovery=False,
+            discovery_quorum=1,
+            sentinel_socket_timeout=1,
+            adaptive_timeout=None,
             host=mock.ANY,
             max_connections=mock.ANY,
             password=mock.ANY,
             port=mock.ANY,
         )
+
+    @mock.patch('celery_redis_sentinel.backend.get_redis_via_sentinel')
+    def test_client_retry_policy(self, mock_get_redis_via_sentinel):
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS, retry_policy={'deadline': 5, 'cap': 2},
+        ), app=app)
+
+        backend.client
+
+        redis_class = mock_get_redis_via_sentinel.call_args[1]['redis_class']
+        assert redis_class.retry_policy.deadline == 5
+        assert redis_class.retry_policy.cap == 2
+        # chord counters must not be incremented twice
+        assert redis_class.transaction_retry_policy == 'idempotent'
+        # celery's own retry policy of ensure() is left intact
+        assert isinstance(backend.retry_policy, dict)
+
+    @mock.patch('celery_redis_sentinel.backend.get_redis_via_sentinel')
+    def test_client_timeouts(self, mock_get_redis_via_sentinel):
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS,
+            sentinel_socket_timeout=0.1,
+            socket_connect_timeout=0.2,
+            adaptive_timeout={'maximum': 2},
+        ), app=app)
+
+        backend.client
+
+        kwargs = mock_get_redis_via_sentinel.call_args[1]
+        assert kwargs['socket_timeout'] == BROKER_TRANSPORT_OPTIONS['socket_timeout']
+        assert kwargs['sentinel_socket_timeout'] == 0.1
+        assert kwargs['socket_connect_timeout'] == 0.2
+        assert kwargs['adaptive_timeout'] is backend.adaptive_timeout
+        assert backend.adaptive_timeout.minimum == BROKER_TRANSPORT_OPTIONS['socket_timeout']
+        assert backend.adaptive_timeout.maximum == 2
+
+    @mock.patch('celery_redis_sentinel.backend.get_shared_connection_pool')
+    @mock.patch('celery_redis_sentinel.backend.get_redis_via_sentinel')
+    def test_client_shared_pool(self, mock_get_redis_via_sentinel, mock_get_shared_connection_pool):
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS, shared_pool=True,
+        ), app=app)
+
+        client = backend.client
+
+        assert client.connection_pool is mock_get_shared_connection_pool.return_value
+        assert client.retry_policy is backend.redis_retry_policy
+        assert mock_get_shared_connection_pool.call_args[1]['service_name'] == 'master'
+        assert not mock_get_redis_via_sentinel.called
+
+    def test_mget(self):
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS, mget_chunk_size=2,
+        ), app=app)
+        backend.client = mock.Mock()
+        backend.client.mget.side_effect = lambda keys: [k.upper() for k in keys]
+
+        assert backend.mget(iter(['a', 'b', 'c'])) == ['A', 'B', 'C']
+        backend.client.mget.assert_has_calls([
+            mock.call(['a', 'b']),
+            mock.call(['c']),
+        ])
+
+    def test_mget_no_chunks(self):
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS, mget_chunk_size=None,
+        ), app=app)
+        backend.client = mock.Mock()
+
+        assert backend.mget(['a', 'b', 'c']) == backend.client.mget.return_value
+        backend.client.mget.assert_called_once_with(['a', 'b', 'c'])
+
+    @mock.patch('celery_redis_sentinel.backend.get_redis_via_sentinel')
+    def test_replica_client(self, mock_get_redis_via_sentinel):
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS, read_from_replicas=True, max_link_down_time=5,
+        ), app=app)
+
+        client = backend.replica_client
+
+        assert client == mock_get_redis_via_sentinel.return_value
+        assert mock_get_redis_via_sentinel.call_count == 1
+        kwargs = mock_get_redis_via_sentinel.call_args[1]
+        assert kwargs['replica'] is True
+        assert kwargs['max_link_down_time'] == 5
+        assert kwargs['service_name'] == 'master'
+        assert kwargs['redis_class'] is Redis
+
+    def test_get_from_replica(self):
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS, read_from_replicas=True,
+        ), app=app)
+        backend.client = mock.Mock()
+        backend.replica_client = mock.Mock()
+
+        assert backend.get('foo') == backend.replica_client.get.return_value
+        assert not backend.client.get.called
+
+    def test_get_from_replica_fallback(self):
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS, read_from_replicas=True,
+        ), app=app)
+        backend.client = mock.Mock()
+        backend.replica_client = mock.Mock()
+        backend.replica_client.get.side_effect = ConnectionError
+
+        assert backend.get('foo') == backend.client.get.return_value
+        backend.client.get.assert_called_once_with('foo')
+
+    def test_get_from_master(self):
+        backend = RedisSentinelBackend(transport_options=None, app=app)
+        backend.client = mock.Mock()
+        backend.replica_client = mock.Mock()
+
+        assert backend.get('foo') == backend.client.get.return_value
+        assert not backend.replica_client.get.called
+
+    @mock.patch('celery_redis_sentinel.backend.get_redis_via_sentinel')
+    def test_client_blocking_pool(self, mock_get_redis_via_sentinel):
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS, max_connections=5, blocking_pool=True, pool_timeout=2,
+        ), app=app)
+
+        backend.client
+
+        kwargs = mock_get_redis_via_sentinel.call_args[1]
+        assert kwargs['max_connections'] == 5
+        assert kwargs['connection_pool_class'] is BlockingSentinelConnectionPool
+        assert kwargs['pool_timeout'] == 2
+
+    @mock.patch('celery_redis_sentinel.backend.get_redis_via_sentinel')
+    def test_client_persistent_sentinels(self, mock_get_redis_via_sentinel):
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS, persistent_sentinels=True, sentinel_health_check_interval=5,
+        ), app=app)
+
+        backend.client
+
+        kwargs = mock_get_redis_via_sentinel.call_args[1]
+        assert kwargs['sentinel_class'] is PersistentSentinel
+        assert kwargs['sentinel_health_check_interval'] == 5
+
+    @mock.patch('celery_redis_sentinel.backend.prefill_connection_pool')
+    def test_prefill_pool(self, mock_prefill_connection_pool):
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS, prefill_connections=3,
+        ), app=app)
+        backend.client = mock.Mock()
+        mock_prefill_connection_pool.side_effect = ConnectionError
+
+        backend.prefill_pool().join()
+
+        mock_prefill_connection_pool.assert_called_once_with(backend.client.connection_pool, 3)
+
+    @mock.patch('celery_redis_sentinel.backend.get_switch_master_listener')
+    def test_on_worker_boot(self, mock_get_switch_master_listener):
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS, prefill_connections=3,
+        ), app=app)
+
+        with mock.patch.object(backend, 'prefill_pool') as mock_prefill_pool:
+            backend._on_worker_boot(sender=None)
+
+        mock_prefill_pool.assert_called_once_with()
+        mock_get_switch_master_listener.return_value.add_callback.assert_called_once_with(
+            backend._on_switch_master,
+        )
+
+    @pytest.mark.parametrize('pool_class, prefilled', [
+        ('celery.concurrency.prefork:TaskPool', False),
+        ('celery.concurrency.solo:TaskPool', True),
+        ('celery.concurrency.base:BasePool', True),
+    ])
+    def test_on_worker_ready(self, pool_class, prefilled):
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS, prefill_connections=3,
+        ), app=app)
+        consumer = mock.Mock()
+        consumer.pool = mock.Mock(spec=symbol_by_name(pool_class))
+
+        with mock.patch.object(backend, '_on_worker_boot') as mock_on_worker_boot:
+            backend._on_worker_ready(sender=consumer)
+
+        assert mock_on_worker_boot.called == prefilled
+
+    def test_on_switch_master(self):
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS, prefill_connections=3,
+        ), app=app)
+        backend.client = mock.Mock()
+
+        with mock.patch.object(backend, 'prefill_pool') as mock_prefill_pool:
+            backend._on_switch_master(('a', 1), ('b', 1))
+
+        backend.client.connection_pool.disconnect.assert_called_once_with()
+        mock_prefill_pool.assert_called_once_with()
+
+    def test_encode_decode_compression(self):
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS, compression='zlib', compression_threshold=100,
+        ), app=app, serializer='json')
+        meta = {'result': 'a' * 1000}
+
+        payload = backend.encode(meta)
+
+        assert payload[:1] == b'\x01'
+        assert backend.decode(payload) == meta
+        assert backend.encode({'a': 1}) == RedisSentinelBackend(
+            transport_options=None, app=app, serializer='json',
+        ).encode({'a': 1})
+
+    def test_decode_compressed_without_compression(self):
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS, compression='zlib', compression_threshold=0,
+        ), app=app, serializer='json')
+        meta = {'result': 'a' * 1000}
+
+        payload = backend.encode(meta)
+
+        assert RedisSentinelBackend(
+            transport_options=None, app=app, serializer='json',
+        ).decode(payload) == meta
+
+    @mock.patch('celery_redis_sentinel.backend.get_result_subscriber')
+    def test_wait_for_result_notifications(self, mock_get_result_subscriber):
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS, result_notifications=True,
+        ), app=app, serializer='json')
+        backend.client = mock.Mock()
+        backend.client.get.return_value = backend.encode({'status': 'STARTED', 'task_id': 'a'})
+        subscriber = mock_get_result_subscriber.return_value
+
+        def wait(channel, check, **kwargs):
+            assert check(None) is None
+            return check(backend.encode({'status': 'SUCCESS', 'result': 5, 'task_id': 'a'}))
+
+        subscriber.wait.side_effect = wait
+
+        meta = backend.wait_for('a', timeout=5)
+
+        assert meta['status'] == 'SUCCESS'
+        assert meta['result'] == 5
+        subscriber.wait.assert_called_once_with(
+            backend.get_key_for_task('a'), mock.ANY,
+            timeout=5, interval=0.5, on_interval=None,
+        )
+        assert mock_get_result_subscriber.call_args[0][0] == (
+            tuple(tuple(i) for i in BROKER_TRANSPORT_OPTIONS['sentinels']),
+            'master',
+            0,
+        )
+
+    @mock.patch('celery_redis_sentinel.backend.get_result_subscriber')
+    def test_wait_for_result_notifications_timeout(self, mock_get_result_subscriber):
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS, result_notifications=True,
+        ), app=app)
+        mock_get_result_subscriber.return_value.wait.return_value = None
+
+        with pytest.raises(CeleryTimeoutError):
+            backend.wait_for('a', timeout=1)
+
+    def get_sharded_backend(self):
+        # with service names "a" and "b", task "bar" belongs to the
+        # home shard "a" and task "foo" to shard "b"
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS, service_name='a', service_names=['a', 'b'],
+        ), app=app)
+        backend.client = mock.Mock()
+        backend.shard_backends['b'] = mock.Mock()
+        return backend
+
+    def test_init_sharded(self):
+        backend = RedisSentinelBackend(transport_options=dict(
+            BROKER_TRANSPORT_OPTIONS, service_name='a', service_names=['a', 'b'],
+        ), app=app)
+
+        assert list(backend.shard_backends) == ['b']
+        shard_backend = backend.shard_backends['b']
+        assert shard_backend.service_name == 'b'
+        assert shard_backend.shard_backends == {}
+        assert 'service_names' not in shard_backend.transport_options
+
+    def test_shard_backend(self):
+        backend = self.get_sharded_backend()
+
+        assert backend.shard_backend(backend.get_key_for_task('bar')) is backend
+        assert backend.shard_backend(backend.get_key_for_task('foo')) is backend.shard_backends['b']
+        assert backend.shard_backend(backend.get_key_for_group('foo')) is backend.shard_backends['b']
+
+    def test_shard_backend_not_sharded(self):
+        backend = RedisSentinelBackend(transport_options=None, app=app)
+
+        assert backend.shard_backend('bar') is backend
+
+    def test_get_sharded(self):
+        backend = self.get_sharded_backend()
+        shard_backend = backend.shard_backends['b']
+
+        assert backend.get(backend.get_key_for_task('bar')) == backend.client.get.return_value
+        assert backend.get(backend.get_key_for_task('foo')) == shard_backend.get.return_value
+        shard_backend.get.assert_called_once_with(backend.get_key_for_task('foo'))
+
+    def test_set_sharded(self):
+        backend = self.get_sharded_backend()
+        shard_backend = backend.shard_backends['b']
+
+        backend.set(backend.get_key_for_task('foo'), 'value')
+
+        shard_backend._set.assert_called_once_with(backend.get_key_for_task('foo'), 'value')
+        assert not backend.client.pipeline.called
+
+    def test_delete_sharded(self):
+        backend = self.get_sharded_backend()
+        shard_backend = backend.shard_backends['b']
+
+        backend.delete(backend.get_key_for_task('bar'))
+        backend.delete(backend.get_key_for_task('foo'))
+
+        backend.client.delete.assert_called_once_with(backend.get_key_for_task('bar'))
+        shard_backend.delete.assert_called_once_with(backend.get_key_for_task('foo'))
+
+    def test_mget_sharded(self):
+        backend = self.get_sharded_backend()
+        shard_backend = backend.shard_backends['b']
+        backend.client.mget.side_effect = lambda keys: [('a', k) for k in keys]
+        shard_backend._mget.side_effect = lambda keys: [('b', k) for k in keys]
+
+        keys = [backend.get_key_for_task(i) for i in ('foo', 'bar', 'foo')]
+
+        assert backend.mget(keys) == [('b', keys[0]), ('a', keys[1]), ('b', keys[2])]
+        shard_backend._mget.assert_called_once_with([keys[0], keys[2]])
+
+    def test_wait_for_sharded(self):
+        backend = self.get_sharded_backend()
+        shard_backend = backend.shard_backends['b']
+
+        actual = backend.wait_for('foo', timeout=5)
+
+        assert actual == shard_backend.wait_for.return_value
+        shard_backend.wait_for.assert_called_once_with(
+            'foo', timeout=5, interval=0.5, no_ack=True, on_interval=None,
+        )
+
+
+@pytest.mark.skipif(ShardedResultConsumer is None, reason='celery < 4 does not consume results')
+class TestShardedResultConsumer(object):
+    def get_consumer(self):
+        backend = TestRedisSentinelBackend().get_sharded_backend()
+        backend.shard_backends['b'].service_name = 'b'
+        backend.shard_backends['b'].get_key_for_task = backend.get_key_for_task
+        return backend.result_consumer
+
+    def test_consume_from(self):
+        consumer = self.get_consumer()
+        backend = consumer.backend
+        shard_backend = backend.shard_backends['b']
+
+        consumer.consume_from('bar')
+        consumer.consume_from('foo')
+
+        shard_consumer = consumer.shard_consumers['b']
+        assert isinstance(consumer, ShardedResultConsumer)
+        assert shard_consumer.backend is shard_backend
+        assert shard_consumer.home is consumer
+        assert shard_consumer._pending_results is consumer._pending_results
+        assert consumer.subscribed_to == {backend.get_key_for_task('bar')}
+        assert shard_consumer.subscribed_to == {backend.get_key_for_task('foo')}
+        backend.client.pubsub.return_value.subscribe.assert_called_once_with(
+            backend.get_key_for_task('bar'),
+        )
+        shard_backend.client.pubsub.return_value.subscribe.assert_called_once_with(
+            backend.get_key_for_task('foo'),
+        )
+
+    def test_on_state_change(self):
+        consumer = self.get_consumer()
+        consumer.consume_from('foo')
+        shard_consumer = consumer.shard_consumers['b']
+        consumer.on_message = mock.Mock()
+        meta = {'task_id': 'foo', 'status': 'SUCCESS'}
+
+        shard_consumer.on_state_change(meta, None)
+
+        consumer.on_message.assert_called_once_with(meta)
+        assert shard_consumer.subscribed_to == set()
+        shard_consumer._pubsub.unsubscribe.assert_called_once_with(
+            consumer.backend.get_key_for_task('foo'),
+        )
+
+    @mock.patch('celery_redis_sentinel.backend.select.select')
+    def test_drain_events(self, mock_select):
+        consumer = self.get_consumer()
+        consumer.consume_from('bar')
+        consumer.consume_from('foo')
+        shard_consumer = consumer.shard_consumers['b']
+        consumer._pubsub.connection.can_read.return_value = False
+        consumer._pubsub.get_message.return_value = None
+        shard_consumer._pubsub.connection.can_read.return_value = False
+        consumer.on_state_change = mock.Mock()
+        shard_consumer._pubsub.get_message.return_value = {
+            'type': 'message', 'data': 'payload',
+        }
+        shard_consumer._decode_result = mock.Mock()
+
+        consumer.drain_events(timeout=1)
+
+        mock_select.assert_called_once_with([
+            consumer._pubsub.connection._sock,
+            shard_consumer._pubsub.connection._sock,
+        ], [], [], 1)
+        consumer._pubsub.get_message.assert_called_once_with(timeout=0)
+        shard_consumer._pubsub.get_message.assert_called_once_with(timeout=0)
+        consumer.on_state_change.assert_called_once_with(
+            shard_consumer._decode_result.return_value,
+            shard_consumer._pubsub.get_message.return_value,
+        )
+
+    @mock.patch('celery_redis_sentinel.backend.select.select')
+    def test_drain_events_buffered(self, mock_select):
+        consumer = self.get_consumer()
+        consumer.consume_from('bar')
+        consumer.consume_from('foo')
+        consumer._pubsub.connection.can_read.return_value = True
+        consumer._pubsub.get_message.return_value = None
+        consumer.shard_consumers['b']._pubsub.get_message.return_value = None
+
+        consumer.drain_events(timeout=1)
+
+        assert not mock_select.called
+
+    def test_drain_events_not_sharded(self):
+        consumer = self.get_consumer()
+        consumer.consume_from('bar')
+        consumer._pubsub.get_message.return_value = None
+
+        consumer.drain_events(timeout=1)
+
+        consumer._pubsub.get_message.assert_called_once_with(timeout=1)
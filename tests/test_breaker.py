@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import threading
+
+import mock
+
+from celery_redis_sentinel.breaker import RecoveryBreaker, get_breaker_target
+from celery_redis_sentinel.metrics import timer
+
+
+class TestRecoveryBreaker(object):
+    def test_trip_release(self):
+        breaker = RecoveryBreaker()
+
+        token = breaker.trip()
+
+        assert token is not None
+        assert breaker.open
+        assert breaker.trip() is None
+        breaker.release(None)
+        breaker.release(object())
+        assert breaker.open
+        breaker.release(token)
+        assert not breaker.open
+
+    def test_blocked(self):
+        breaker = RecoveryBreaker()
+        assert not breaker.blocked()
+
+        token = breaker.trip()
+        # prober itself is never blocked
+        assert not breaker.blocked()
+
+        blocked = []
+        thread = threading.Thread(target=lambda: blocked.append(breaker.blocked()))
+        thread.start()
+        thread.join()
+        assert blocked == [True]
+        breaker.release(token)
+
+    def test_targets(self):
+        breaker = RecoveryBreaker()
+
+        token = breaker.trip('a')
+
+        assert breaker.is_open('a')
+        assert not breaker.is_open('b')
+        assert breaker.trip('a') is None
+        other = breaker.trip('b')
+        assert other is not None
+        breaker.release(token)
+        assert not breaker.is_open('a')
+        assert breaker.is_open('b')
+        breaker.release(other)
+        assert not breaker.open
+
+    def test_wait_other_target(self):
+        breaker = RecoveryBreaker()
+        waited = []
+        token = breaker.trip('a')
+
+        thread = threading.Thread(target=lambda: waited.append(breaker.wait(timer() + 10, 'b')))
+        thread.start()
+        thread.join(1)
+
+        assert waited == [False]
+        breaker.release(token)
+
+    def test_wait_not_blocked(self):
+        assert RecoveryBreaker().wait(timer() + 10) is False
+
+    def test_wait(self):
+        breaker = RecoveryBreaker()
+        waited = []
+        thread = threading.Thread(target=lambda: waited.append(breaker.wait(timer() + 10)))
+        token = breaker.trip()
+
+        thread.start()
+        thread.join(0.05)
+        assert thread.is_alive()
+        breaker.release(token)
+        thread.join(1)
+
+        assert waited == [True]
+
+    def test_wait_deadline(self):
+        breaker = RecoveryBreaker()
+        waited = []
+        thread = threading.Thread(target=lambda: waited.append(breaker.wait(timer() + 0.05)))
+        token = breaker.trip()
+
+        thread.start()
+        thread.join(1)
+
+        assert waited == [True]
+        assert breaker.open
+        breaker.release(token)
+
+    @mock.patch('random.uniform')
+    def test_backoff(self, mock_uniform):
+        breaker = RecoveryBreaker(jitter=2)
+        mock_uniform.return_value = 1.5
+
+        assert breaker.backoff(timer() + 10) == 1.5
+        mock_uniform.assert_called_with(0, 2)
+        assert 0 < breaker.backoff(timer() + 1) <= 1
+        assert breaker.backoff(timer() - 1) == 0
+
+
+def test_get_breaker_target():
+    pool = mock.Mock(spec=['connection_kwargs'])
+
+    assert get_breaker_target(None) is None
+    assert get_breaker_target(pool) is pool
+    assert get_breaker_target(mock.Mock(
+        service_name='master',
+        connection_kwargs={'db': 1},
+        sentinel_manager=mock.Mock(sentinel_addresses=[('localhost', 26379)]),
+    )) == ((('localhost', 26379),), 'master', 1)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import zlib
+
+import pytest
+
+from celery_redis_sentinel import compression
+from celery_redis_sentinel.compression import compress, decompress, register_compressor
+
+
+def test_compress():
+    payload = '{"result": "' + 'a' * 1000 + '"}'
+
+    compressed = compress(payload, 'zlib')
+
+    assert compressed[:1] == b'\x01'
+    assert len(compressed) < len(payload)
+    assert decompress(compressed) == payload.encode('utf-8')
+
+
+def test_compress_threshold():
+    payload = b'{"result": "' + b'a' * 1000 + b'"}'
+
+    assert compress(payload, 'zlib', threshold=2000) is payload
+
+
+def test_compress_not_smaller():
+    assert compress(b'{}', 'zlib') == b'{}'
+
+
+def test_compress_unknown():
+    with pytest.raises(ValueError):
+        compress(b'{}', 'foo')
+
+
+@pytest.mark.skipif(compression.lzma is None, reason='requires lzma')
+def test_compress_lzma():
+    payload = b'a' * 1000
+
+    compressed = compress(payload, 'lzma')
+
+    assert compressed[:1] == b'\x02'
+    assert decompress(compressed) == payload
+
+
+def test_decompress_uncompressed():
+    assert decompress(b'{"a": 1}') == b'{"a": 1}'
+    assert decompress(b'\x80\x02}q\x00.') == b'\x80\x02}q\x00.'
+    assert decompress('{"a": 1}') == '{"a": 1}'
+    assert decompress(b'') == b''
+    assert decompress(None) is None
+
+
+def test_register_compressor():
+    try:
+        register_compressor('foo', b'\x10', lambda d: zlib.compress(d), zlib.decompress)
+
+        assert decompress(compress(b'a' * 100, 'foo')) == b'a' * 100
+        with pytest.raises(ValueError):
+            register_compressor('bar', b'\x10', zlib.compress, zlib.decompress)
+        with pytest.raises(ValueError):
+            register_compressor('bar', b'\x10\x11', zlib.compress, zlib.decompress)
+    finally:
+        compression._compressors.pop('foo', None)
+        compression._decompressors.pop(b'\x10', None)
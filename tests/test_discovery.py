@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import os
+import time
+
+import mock
+import pytest
+from redis import ConnectionError
+
+from celery_redis_sentinel.discovery import (
+    MasterAddressCache,
+    SentinelHealth,
+    SharedMemoryStore,
+    SwitchMasterListener,
+    get_switch_master_listener,
+    master_cache_key,
+    share_master_address_cache,
+)
+from celery_redis_sentinel.metrics import MASTER_SWITCH
+
+
+def test_master_cache_key():
+    assert master_cache_key([['localhost', 26379]], 'master') == (
+        (('localhost', 26379),), 'master',
+    )
+
+
+class TestMasterAddressCache(object):
+    def test_get_missing(self):
+        assert MasterAddressCache().get('foo') is None
+
+    def test_set_get(self):
+        cache = MasterAddressCache()
+        cache.set('foo', ['localhost', 6379], 10)
+
+        assert cache.get('foo') == ('localhost', 6379)
+
+    @mock.patch('time.time')
+    def test_get_expired(self, mock_time):
+        cache = MasterAddressCache()
+        mock_time.return_value = 100
+        cache.set('foo', ('localhost', 6379), 10)
+        mock_time.return_value = 111
+
+        assert cache.get('foo') is None
+
+    def test_invalidate(self):
+        cache = MasterAddressCache()
+        cache.set('foo', ('localhost', 6379), 10)
+        cache.set('bar', ('localhost', 6379), 10)
+
+        cache.invalidate('foo')
+        assert cache.get('foo') is None
+        assert cache.get('bar') is not None
+
+        cache.invalidate()
+        assert cache.get('bar') is None
+
+    @mock.patch('celery_redis_sentinel.discovery.get_switch_master_listener')
+    def test_watch(self, mock_get_switch_master_listener):
+        cache = MasterAddressCache()
+        key = master_cache_key([('localhost', 26379)], 'master')
+        cache.set(key, ('localhost', 6379), 10)
+
+        cache.watch([('localhost', 26379)], 'master')
+        cache.watch([('localhost', 26379)], 'master')
+
+        listener = mock_get_switch_master_listener.return_value
+        listener.add_callback.assert_called_once_with(mock.ANY, on_disconnect=True)
+
+        callback = listener.add_callback.call_args[0][0]
+        callback(('localhost', 6379), ('localhost', 6380))
+        assert cache.get(key) is None
+
+    @mock.patch('os.getpid')
+    @mock.patch('celery_redis_sentinel.discovery.get_switch_master_listener')
+    def test_watch_after_fork(self, mock_get_switch_master_listener, mock_getpid):
+        cache = MasterAddressCache()
+        mock_getpid.return_value = 1
+        cache.watch([('localhost', 26379)], 'master')
+        mock_getpid.return_value = 2
+        cache.watch([('localhost', 26379)], 'master')
+        cache.watch([('localhost', 26379)], 'master')
+
+        listener = mock_get_switch_master_listener.return_value
+        assert listener.add_callback.call_count == 2
+
+    @pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+    def test_share(self):
+        cache = MasterAddressCache()
+        cache.set('foo', ('localhost', 6379), 10)
+        cache.share()
+        cache.share()
+
+        assert cache.shared
+        assert cache.get('foo') == ('localhost', 6379)
+
+        pid = os.fork()
+        if not pid:
+            try:
+                assert cache.get('foo') == ('localhost', 6379)
+                with cache.discovery_lock():
+                    cache.set('bar', ('localhost', 6380), 10)
+                cache.invalidate('foo')
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        assert cache.get('foo') is None
+        assert cache.get('bar') == ('localhost', 6380)
+
+
+@mock.patch('celery_redis_sentinel.discovery.master_address_cache')
+def test_share_master_address_cache(mock_cache):
+    worker = mock.Mock()
+    worker.app.conf = {'BROKER_TRANSPORT_OPTIONS': {'master_cache_ttl': 10}}
+
+    share_master_address_cache(sender=worker)
+    assert not mock_cache.share.called
+
+    worker.app.conf['result_backend_transport_options'] = {
+        'master_cache_ttl': 10, 'shared_master_cache': True,
+    }
+    share_master_address_cache(sender=worker)
+    mock_cache.share.assert_called_once_with()
+
+
+@mock.patch('celery_redis_sentinel.discovery.master_address_cache')
+def test_share_master_address_cache_without_ttl(mock_cache):
+    worker = mock.Mock()
+    worker.app.conf = {'BROKER_TRANSPORT_OPTIONS': {'shared_master_cache': True}}
+
+    share_master_address_cache(sender=worker)
+    share_master_address_cache()
+
+    assert not mock_cache.share.called
+
+
+class TestSharedMemoryStore(object):
+    def test_dump_load(self):
+        store = SharedMemoryStore(size=64)
+
+        with store.locked():
+            assert store.load() is None
+            store.dump({'foo': 'bar'})
+            assert store.load() == {'foo': 'bar'}
+
+    def test_dump_too_large(self):
+        store = SharedMemoryStore(size=64)
+
+        with pytest.raises(ValueError):
+            store.dump('a' * 100)
+
+    @pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+    def test_discovery_lock(self):
+        store = SharedMemoryStore()
+        read, write = os.pipe()
+
+        pid = os.fork()
+        if not pid:
+            try:
+                with store.discovery_lock():
+                    os.write(write, b'x')
+                    time.sleep(0.2)
+                    with store.locked():
+                        store.dump('child')
+            finally:
+                os._exit(0)
+
+        os.read(read, 1)
+        with store.discovery_lock():
+            with store.locked():
+                assert store.load() == 'child'
+        os.waitpid(pid, 0)
+
+
+class TestSentinelHealth(object):
+    def test_record_score(self):
+        health = SentinelHealth(alpha=0.5)
+
+        assert health.score(('a', 1)) == 0
+        health.record(('a', 1), 0.1, True)
+        assert health.score(('a', 1)) == pytest.approx(0.1)
+        health.record(('a', 1), 0.3, False)
+        assert health.score(('a', 1)) == pytest.approx(0.2 / 0.5)
+
+    def test_rank(self):
+        health = SentinelHealth()
+        health.record(('a', 1), 0.5, True)
+        health.record(('b', 1), 0.1, True)
+
+        assert health.rank([('a', 1), ('b', 1), ('c', 1)]) == (
+            [('c', 1), ('b', 1), ('a', 1)],
+            [],
+        )
+
+    @mock.patch('time.time')
+    def test_circuit_breaker(self, mock_time):
+        health = SentinelHealth(failure_threshold=2)
+        mock_time.return_value = 100
+        addresses = [('a', 1), ('b', 1)]
+
+        health.record(('a', 1), 1, False)
+        assert health.rank(addresses) == ([('b', 1), ('a', 1)], [])
+        health.record(('a', 1), 1, False)
+        assert health.rank(addresses, cooldown=30) == ([('b', 1)], [('a', 1)])
+
+        # half-open only for a single discovery per cooldown
+        # and ranked first so that it is actually probed
+        mock_time.return_value = 130
+        assert health.rank(addresses, cooldown=30) == ([('a', 1), ('b', 1)], [])
+        assert health.rank(addresses, cooldown=30) == ([('b', 1)], [('a', 1)])
+
+        health.record(('a', 1), 0.1, True)
+        assert health.rank(addresses, cooldown=30)[1] == []
+
+    @mock.patch('time.time')
+    def test_circuit_breaker_recovery(self, mock_time):
+        health = SentinelHealth(failure_threshold=2)
+        mock_time.return_value = 100
+        addresses = [('a', 1), ('b', 1)]
+        health.record(('b', 1), 0.5, True)
+        health.record(('a', 1), 1, False)
+        health.record(('a', 1), 1, False)
+
+        # probe after cooldown fails hence circuit stays open for another cooldown
+        mock_time.return_value = 130
+        assert health.rank(addresses, cooldown=30)[0][0] == ('a', 1)
+        health.record(('a', 1), 1, False)
+        assert health.rank(addresses, cooldown=30) == ([('b', 1)], [('a', 1)])
+
+        # recovered sentinel is probed first and after few successful
+        # queries it is preferred by its score again
+        mock_time.return_value = 160
+        assert health.rank(addresses, cooldown=30) == ([('a', 1), ('b', 1)], [])
+        health.record(('a', 1), 0.01, True)
+        assert health.rank(addresses, cooldown=30) == ([('b', 1), ('a', 1)], [])
+        for _ in range(3):
+            health.record(('a', 1), 0.01, True)
+        assert health.rank(addresses, cooldown=30) == ([('a', 1), ('b', 1)], [])
+
+    def test_reset(self):
+        health = SentinelHealth()
+        health.record(('a', 1), 1, True)
+
+        health.reset()
+
+        assert health.score(('a', 1)) == 0
+
+
+class TestSwitchMasterListener(object):
+    @mock.patch('celery_redis_sentinel.discovery.get_metrics')
+    def test_handle_message(self, mock_get_metrics):
+        listener = SwitchMasterListener([('localhost', 26379)], 'master')
+        callback = mock.Mock()
+        listener.add_callback(callback)
+
+        listener.handle_message({'data': b'other 1.1.1.1 6379 2.2.2.2 6379'})
+        listener.handle_message({'data': b'master 1.1.1.1 6379 2.2.2.2 6380'})
+        listener.handle_message({'data': b'garbage'})
+
+        callback.assert_called_once_with(('1.1.1.1', 6379), ('2.2.2.2', 6380))
+        mock_get_metrics.return_value.mark.assert_called_once_with(MASTER_SWITCH, service='master')
+
+    def test_notify_disconnect(self):
+        listener = SwitchMasterListener([('localhost', 26379)], 'master')
+        on_switch = mock.Mock()
+        on_disconnect = mock.Mock()
+        listener.add_callback(on_switch)
+        listener.add_callback(on_disconnect, on_disconnect=True)
+
+        listener.notify(None, None)
+
+        assert not on_switch.called
+        on_disconnect.assert_called_once_with(None, None)
+
+    def test_notify_error(self):
+        listener = SwitchMasterListener([('localhost', 26379)], 'master')
+        callback = mock.Mock()
+        listener.add_callback(mock.Mock(side_effect=ValueError))
+        listener.add_callback(callback)
+
+        listener.notify(('1.1.1.1', 6379), ('2.2.2.2', 6379))
+
+        assert callback.called
+
+    def test_remove_callback(self):
+        listener = SwitchMasterListener([('localhost', 26379)], 'master')
+        callback = mock.Mock()
+        listener.add_callback(callback)
+        listener.remove_callback(callback)
+
+        listener.notify(('1.1.1.1', 6379), ('2.2.2.2', 6379))
+
+        assert not callback.called
+
+    def test_run(self):
+        listener = SwitchMasterListener(
+            [('localhost', 26379), ('localhost', 26380)], 'master', retry_interval=0,
+        )
+        on_disconnect = mock.Mock()
+        listener.add_callback(on_disconnect, on_disconnect=True)
+
+        def listen(host, port):
+            if port == 26379:
+                raise ConnectionError
+            listener.stop()
+
+        with mock.patch.object(listener, 'listen', side_effect=listen) as mock_listen:
+            listener.run()
+
+        mock_listen.assert_has_calls([
+            mock.call('localhost', 26379),
+            mock.call('localhost', 26380),
+        ])
+        on_disconnect.assert_called_once_with(None, None)
+
+
+@mock.patch.object(SwitchMasterListener, 'start')
+def test_get_switch_master_listener(mock_start):
+    a = get_switch_master_listener([('localhost', 1)], 'test-listener')
+    b = get_switch_master_listener([('localhost', 1)], 'test-listener')
+
+    assert a is b
+    assert isinstance(a, SwitchMasterListener)
+    assert mock_start.call_count == 2
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+import mock
+from six.moves.urllib.request import urlopen
+
+from celery_redis_sentinel.metrics import (
+    COMMAND_LATENCY,
+    MASTER_SWITCH,
+    RETRIES,
+    Metrics,
+    PrometheusMetrics,
+    get_metrics,
+    set_metrics,
+)
+
+
+def test_set_metrics():
+    metrics = PrometheusMetrics()
+    default = get_metrics()
+    assert not default.enabled
+
+    try:
+        set_metrics(metrics)
+        assert get_metrics() is metrics
+    finally:
+        set_metrics(default)
+
+
+def test_metrics_noop():
+    metrics = Metrics()
+
+    metrics.increment(RETRIES)
+    metrics.observe(COMMAND_LATENCY, 1, command='GET')
+    metrics.mark(MASTER_SWITCH, service='master')
+
+
+class TestPrometheusMetrics(object):
+    def test_increment(self):
+        metrics = PrometheusMetrics()
+        metrics.increment(RETRIES)
+        metrics.increment(RETRIES, 2)
+
+        assert metrics.render() == (
+            '# HELP celery_redis_sentinel_retries_total '
+            'Number of retries made while redis sentinel failover is in progress\n'
+            '# TYPE celery_redis_sentinel_retries_total counter\n'
+            'celery_redis_sentinel_retries_total 3.0\n'
+        )
+
+    def test_observe(self):
+        metrics = PrometheusMetrics(buckets=(0.1, 1))
+        metrics.observe(COMMAND_LATENCY, 0.05, command='GET')
+        metrics.observe(COMMAND_LATENCY, 0.5, command='GET')
+        metrics.observe(COMMAND_LATENCY, 5, command='GET')
+
+        assert metrics.render().splitlines()[2:] == [
+            'celery_redis_sentinel_command_seconds_bucket{command="GET",le="0.1"} 1',
+            'celery_redis_sentinel_command_seconds_bucket{command="GET",le="1.0"} 2',
+            'celery_redis_sentinel_command_seconds_bucket{command="GET",le="+Inf"} 3',
+            'celery_redis_sentinel_command_seconds_sum{command="GET"} 5.55',
+            'celery_redis_sentinel_command_seconds_count{command="GET"} 3',
+        ]
+
+    @mock.patch('time.time')
+    def test_mark(self, mock_time):
+        metrics = PrometheusMetrics()
+        mock_time.return_value = 100
+        metrics.mark(MASTER_SWITCH, service='ma"ster')
+        mock_time.return_value = 105
+
+        assert metrics.render().splitlines()[1:] == [
+            '# TYPE celery_redis_sentinel_seconds_since_master_switch gauge',
+            'celery_redis_sentinel_seconds_since_master_switch{service="ma\\"ster"} 5.0',
+        ]
+
+    def test_serve(self):
+        metrics = PrometheusMetrics()
+        metrics.increment(RETRIES)
+        server = metrics.serve(0, host='127.0.0.1')
+
+        try:
+            response = urlopen('http://127.0.0.1:{}/metrics'.format(server.server_address[1]))
+            assert response.read().decode('utf-8') == metrics.render()
+        finally:
+            server.shutdown()
+            server.server_close()
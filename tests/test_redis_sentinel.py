@@ -1,26 +1,78 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
+import threading
 
 import mock
 import pytest
 from redis import ConnectionError
 from redis.client import StrictRedis
-from redis.sentinel import SentinelConnectionPool
+from redis.sentinel import (
+    MasterNotFoundError,
+    Sentinel,
+    SentinelConnectionPool,
+    SentinelManagedConnection,
+)
 
+from celery_redis_sentinel.breaker import recovery_breaker
+from celery_redis_sentinel.retry import RetryPolicy
+from celery_redis_sentinel.discovery import SentinelHealth
+from celery_redis_sentinel.metrics import (
+    COMMAND_LATENCY,
+    DISCOVERY_LATENCY,
+    MASTER_SWITCH,
+    RETRIES,
+    RETRIES_EXHAUSTED,
+)
 from celery_redis_sentinel.redis_sentinel import (
+    TRANSACTION_IDEMPOTENT,
+    TRANSACTION_RAISE,
+    TRANSACTION_RETRY,
+    BlockingSentinelConnectionPool,
     CelerySentinelConnectionPool,
+    EnsuredPipelineMixin,
     EnsuredRedisMixin,
+    PersistentSentinel,
+    PersistentStrictRedis,
+    PinnedConnectionPool,
     ShortLivedSentinel,
     ShortLivedStrictRedis,
     ensure_redis_call,
+    get_ensured_pipeline_class,
+    get_persistent_client,
     get_redis_via_sentinel,
+    get_shared_connection_pool,
+    keepalive_options,
+    prefill_connection_pool,
 )
+from celery_redis_sentinel.timeouts import AdaptiveTimeoutConnectionMixin
+
+
+class Pipeline(object):
+    def __init__(self, transaction=True, watching=False, results=None):
+        self.transaction = transaction
+        self.watching = watching
+        self.explicit_transaction = False
+        self.command_stack = []
+        self.executed = []
+        self.results = iter(results or [])
+
+    def execute(self, raise_on_error=True):
+        self.executed.append(list(self.command_stack))
+        self.command_stack = []
+        self.explicit_transaction = False
+        result = next(self.results)
+        if isinstance(result, Exception):
+            raise result
+        return result
 
 
 class Bar(object):
     def execute_command(self, *args, **kwargs):
         return 'foo'
 
+    def pipeline(self, transaction=True, shard_hint=None):
+        return Pipeline(transaction)
+
 
 class Foo(EnsuredRedisMixin, Bar):
     pass
@@ -37,6 +89,287 @@ def test_get_redis_via_sentinel():
     )
 
     assert result == mock_sentinel.return_value.master_for.return_value
+    mock_sentinel.assert_called_once_with(['foo', 'bar'], socket_timeout=0.1)
+
+
+def test_get_redis_via_sentinel_connection_options():
+    mock_sentinel = mock.Mock()
+
+    get_redis_via_sentinel(
+        db=0,
+        sentinels=['foo', 'bar'],
+        service_name='master',
+        sentinel_class=mock_sentinel,
+        socket_keepalive=True,
+        socket_keepalive_options={1: 10},
+        host='localhost',
+    )
+
+    mock_sentinel.return_value.master_for.assert_called_once_with(
+        'master',
+        socket_timeout=0.1,
+        db=0,
+        redis_class=StrictRedis,
+        connection_pool_class=SentinelConnectionPool,
+        socket_keepalive=True,
+        socket_keepalive_options={1: 10},
+    )
+
+
+def test_get_redis_via_sentinel_timeouts():
+    mock_sentinel = mock.Mock()
+
+    get_redis_via_sentinel(
+        db=0,
+        sentinels=['foo', 'bar'],
+        service_name='master',
+        sentinel_class=mock_sentinel,
+        socket_timeout=0.5,
+        sentinel_socket_timeout=0.1,
+        socket_connect_timeout=0.2,
+        adaptive_timeout={'maximum': 2},
+    )
+
+    mock_sentinel.assert_called_once_with(['foo', 'bar'], socket_timeout=0.1)
+    kwargs = mock_sentinel.return_value.master_for.call_args[1]
+    assert kwargs['socket_timeout'] == 0.5
+    assert kwargs['socket_connect_timeout'] == 0.2
+    connection_class = kwargs['connection_class']
+    assert issubclass(connection_class, AdaptiveTimeoutConnectionMixin)
+    assert issubclass(connection_class, SentinelManagedConnection)
+    assert connection_class.adaptive_timeout.minimum == 0.5
+    assert connection_class.adaptive_timeout.maximum == 2
+
+
+def test_get_redis_via_sentinel_master_cache_ttl():
+    mock_sentinel = mock.Mock()
+
+    get_redis_via_sentinel(
+        db=0,
+        sentinels=['foo', 'bar'],
+        service_name='master',
+        sentinel_class=mock_sentinel,
+        master_cache_ttl=5,
+    )
+
+    mock_sentinel.assert_called_once_with(
+        ['foo', 'bar'], socket_timeout=0.1, master_cache_ttl=5,
+    )
+
+
+def test_get_redis_via_sentinel_replica():
+    mock_sentinel = mock.Mock()
+
+    result = get_redis_via_sentinel(
+        db=0,
+        sentinels=['foo', 'bar'],
+        service_name='master',
+        sentinel_class=mock_sentinel,
+        replica=True,
+        max_link_down_time=5,
+    )
+
+    assert result == mock_sentinel.return_value.slave_for.return_value
+    assert not mock_sentinel.return_value.master_for.called
+    mock_sentinel.assert_called_once_with(
+        ['foo', 'bar'], socket_timeout=0.1, max_link_down_time=5,
+    )
+
+
+def test_get_redis_via_sentinel_parallel_discovery():
+    mock_sentinel = mock.Mock()
+
+    get_redis_via_sentinel(
+        db=0,
+        sentinels=['foo', 'bar'],
+        service_name='master',
+        sentinel_class=mock_sentinel,
+        parallel_discovery=True,
+        discovery_quorum=2,
+    )
+
+    mock_sentinel.assert_called_once_with(
+        ['foo', 'bar'], socket_timeout=0.1, parallel_discovery=True, discovery_quorum=2,
+    )
+
+
+def test_get_redis_via_sentinel_rank_sentinels():
+    mock_sentinel = mock.Mock()
+
+    get_redis_via_sentinel(
+        db=0,
+        sentinels=['foo', 'bar'],
+        service_name='master',
+        sentinel_class=mock_sentinel,
+        rank_sentinels=True,
+        sentinel_cooldown=10,
+    )
+
+    mock_sentinel.assert_called_once_with(
+        ['foo', 'bar'], socket_timeout=0.1, rank_sentinels=True, sentinel_cooldown=10,
+    )
+
+
+def test_get_redis_via_sentinel_sentinel_health_check_interval():
+    mock_sentinel = mock.Mock()
+
+    get_redis_via_sentinel(
+        db=0,
+        sentinels=['foo', 'bar'],
+        service_name='master',
+        sentinel_class=mock_sentinel,
+        sentinel_health_check_interval=5,
+    )
+
+    mock_sentinel.assert_called_once_with(
+        ['foo', 'bar'], socket_timeout=0.1, health_check_interval=5,
+    )
+
+
+def test_get_redis_via_sentinel_pool_size():
+    mock_sentinel = mock.Mock()
+
+    get_redis_via_sentinel(
+        db=0,
+        sentinels=['foo', 'bar'],
+        service_name='master',
+        sentinel_class=mock_sentinel,
+        connection_pool_class=BlockingSentinelConnectionPool,
+        max_connections=5,
+        pool_timeout=2,
+    )
+
+    mock_sentinel.return_value.master_for.assert_called_once_with(
+        'master',
+        socket_timeout=0.1,
+        db=0,
+        redis_class=StrictRedis,
+        connection_pool_class=BlockingSentinelConnectionPool,
+        max_connections=5,
+        timeout=2,
+    )
+
+
+@mock.patch('celery_redis_sentinel.redis_sentinel.get_redis_via_sentinel')
+def test_get_shared_connection_pool(mock_get_redis_via_sentinel):
+    mock_get_redis_via_sentinel.side_effect = lambda *args, **kwargs: mock.Mock()
+    sentinels = [('localhost', 26379)]
+
+    pool = get_shared_connection_pool(
+        db=0, sentinels=sentinels, service_name='shared', redis_class=StrictRedis, socket_timeout=1,
+    )
+
+    assert pool is get_shared_connection_pool(db=0, sentinels=list(sentinels), service_name='shared')
+    assert pool is not get_shared_connection_pool(db=1, sentinels=sentinels, service_name='shared')
+    assert pool is not get_shared_connection_pool(db=0, sentinels=sentinels, service_name='other')
+    mock_get_redis_via_sentinel.assert_any_call(0, sentinels, 'shared', socket_timeout=1)
+    assert mock_get_redis_via_sentinel.call_count == 3
+
+    with mock.patch('os.getpid', return_value=-1):
+        assert pool is not get_shared_connection_pool(db=0, sentinels=sentinels, service_name='shared')
+
+
+class TestPinnedConnectionPool(object):
+    def get_pool(self):
+        shared = mock.Mock()
+        shared.get_master_address.return_value = ('192.168.1.128', '6379')
+        return PinnedConnectionPool(shared)
+
+    def test_get_connection(self):
+        pool = self.get_pool()
+        connection = pool.pool.get_connection.return_value
+        connection.host, connection.port = '192.168.1.128', 6379
+
+        assert pool.get_master_address() == ('192.168.1.128', '6379')
+        assert pool.get_connection('_') is connection
+        connection.connect.assert_called_once_with()
+        assert pool.connection_kwargs is pool.pool.connection_kwargs
+
+        pool.release(connection)
+
+        pool.pool.release.assert_called_once_with(connection)
+        assert not pool.connections
+
+    def test_get_connection_master_switched(self):
+        pool = self.get_pool()
+        connection = pool.pool.get_connection.return_value
+        connection.host, connection.port = '192.168.1.129', 6379
+
+        with pytest.raises(ConnectionError):
+            pool.get_connection('_')
+
+        pool.pool.release.assert_called_once_with(connection)
+        assert not pool.connections
+
+    def test_get_connection_error(self):
+        pool = self.get_pool()
+        connection = pool.pool.get_connection.return_value
+        connection.connect.side_effect = ConnectionError
+
+        with pytest.raises(ConnectionError):
+            pool.get_connection('_')
+
+        pool.pool.release.assert_called_once_with(connection)
+
+    def test_disconnect(self):
+        pool = self.get_pool()
+        connection = pool.pool.get_connection.return_value
+        connection.host, connection.port = '192.168.1.128', 6379
+        pool.get_connection('_')
+
+        pool.disconnect()
+
+        connection.disconnect.assert_called_once_with()
+        pool.pool.release.assert_called_once_with(connection)
+        assert not pool.connections
+        assert not pool.pool.disconnect.called
+
+        # already released connection is not released again
+        pool.release(connection)
+        pool.pool.release.assert_called_once_with(connection)
+
+
+class TestBlockingSentinelConnectionPool(object):
+    def test_disconnect_idle(self):
+        pool = BlockingSentinelConnectionPool('master', mock.Mock(), max_connections=2)
+        idle, in_use = mock.Mock(), mock.Mock()
+        pool.pool.get_nowait()
+        pool.pool.put_nowait(idle)
+        pool._connections.extend([idle, in_use])
+
+        pool.disconnect(inuse_connections=False)
+
+        idle.disconnect.assert_called_once_with()
+        assert not in_use.disconnect.called
+
+        pool.disconnect()
+
+        in_use.disconnect.assert_called_once_with()
+
+
+def test_prefill_connection_pool():
+    pool = mock.Mock(max_connections=2)
+    connections = [mock.Mock(), mock.Mock()]
+    pool.get_connection.side_effect = connections
+
+    prefill_connection_pool(pool, 5)
+
+    assert pool.get_connection.call_count == 2
+    for connection in connections:
+        connection.connect.assert_called_once_with()
+    pool.release.assert_has_calls([mock.call(i) for i in connections])
+
+
+def test_prefill_connection_pool_error():
+    pool = mock.Mock(max_connections=None)
+    connection = mock.Mock()
+    connection.connect.side_effect = ConnectionError
+    pool.get_connection.return_value = connection
+
+    with pytest.raises(ConnectionError):
+        prefill_connection_pool(pool, 5)
+
+    pool.release.assert_called_once_with(connection)
 
 
 @mock.patch('time.sleep')
@@ -56,6 +389,109 @@ def test_ensure_redis_call(mock_sleep):
     ])
 
 
+@mock.patch('time.sleep')
+@mock.patch('celery_redis_sentinel.redis_sentinel.get_metrics')
+def test_ensure_redis_call_metrics(mock_get_metrics, mock_sleep):
+    m = mock.Mock(side_effect=ConnectionError)
+
+    with pytest.raises(ConnectionError):
+        ensure_redis_call(m, attempts=2)
+
+    mock_get_metrics.return_value.increment.assert_has_calls([
+        mock.call(RETRIES),
+        mock.call(RETRIES),
+        mock.call(RETRIES_EXHAUSTED),
+    ])
+
+
+@mock.patch('time.sleep')
+def test_ensure_redis_call_waits_for_recovery_probe(mock_sleep):
+    m = mock.Mock(return_value='foo')
+    token = []
+    thread = threading.Thread(target=lambda: token.append(recovery_breaker.trip()))
+    thread.start()
+    thread.join()
+    timer = threading.Timer(0.05, recovery_breaker.release, args=token)
+    timer.start()
+
+    def call():
+        # redis is not called until another call completes recovery probe
+        assert not recovery_breaker.open
+        return m()
+
+    assert ensure_redis_call(call, attempts=5) == 'foo'
+
+    assert not recovery_breaker.open
+    # released with jitter instead of exponential ease-off
+    assert all(i[0][0] <= recovery_breaker.jitter for i in mock_sleep.call_args_list)
+
+
+@mock.patch('time.sleep')
+def test_ensure_redis_call_other_target_not_blocked(mock_sleep):
+    token = []
+    thread = threading.Thread(target=lambda: token.append(recovery_breaker.trip(('a', 0))))
+    thread.start()
+    thread.join()
+
+    try:
+        # probe of another master does not delay the call
+        assert ensure_redis_call(lambda: 'foo', redis_target=('b', 0)) == 'foo'
+        assert not mock_sleep.called
+        assert recovery_breaker.blocked(('a', 0))
+    finally:
+        recovery_breaker.release(token[0])
+
+
+@mock.patch('time.sleep')
+def test_ensure_redis_call_releases_breaker(mock_sleep):
+    m = mock.Mock(side_effect=[ConnectionError(), ConnectionError(), 'foo'])
+
+    assert ensure_redis_call(m, attempts=5) == 'foo'
+
+    mock_sleep.assert_has_calls([mock.call(1), mock.call(2)])
+    assert not recovery_breaker.open
+
+
+@mock.patch('time.sleep')
+def test_ensure_redis_call_retry_policy(mock_sleep):
+    m = mock.Mock(side_effect=[ValueError(), ValueError(), ValueError(), 'foo'])
+
+    actual = ensure_redis_call(m, redis_retry_policy={
+        'base': 3, 'cap': 5, 'exceptions': ['builtins.ValueError'],
+    })
+
+    assert actual == 'foo'
+    mock_sleep.assert_has_calls([mock.call(1), mock.call(3), mock.call(5)])
+
+
+@mock.patch('celery_redis_sentinel.redis_sentinel.timer')
+@mock.patch('time.sleep')
+def test_ensure_redis_call_retry_policy_deadline(mock_sleep, mock_timer):
+    mock_timer.side_effect = [0, 0, 1.5, 3]
+    m = mock.Mock(side_effect=ConnectionError)
+
+    with pytest.raises(ConnectionError):
+        ensure_redis_call(m, redis_retry_policy=RetryPolicy(deadline=3))
+
+    # second wait is shortened to the deadline and nothing is retried after it
+    mock_sleep.assert_has_calls([mock.call(1), mock.call(1.5)])
+    assert m.call_count == 3
+
+
+@mock.patch('time.sleep')
+@mock.patch('celery_redis_sentinel.redis_sentinel.logger')
+def test_ensure_redis_call_logging(mock_logger, mock_sleep):
+    m = mock.Mock(side_effect=ConnectionError('down'))
+
+    with pytest.raises(ConnectionError):
+        ensure_redis_call(m, 'a' * 10000, attempts=1)
+
+    args = mock_logger.warning.call_args[0]
+    assert len(str(args[2])) < 300
+    assert args[3:] == (mock.ANY, 1, 'ConnectionError', mock.ANY)
+    assert mock_logger.error.called
+
+
 class TestEnsuredRedisMixin(object):
     @mock.patch('celery_redis_sentinel.redis_sentinel.ensure_redis_call')
     def test_execute_command(self, mock_ensure_redis_call):
@@ -65,9 +501,154 @@ class TestEnsuredRedisMixin(object):
 
         assert actual == mock_ensure_redis_call.return_value
         mock_ensure_redis_call.assert_called_once_with(
-            mock.ANY, 'lrange', 0, -1,
+            mock.ANY, 'lrange', 0, -1, redis_retry_policy=None, redis_target=None,
         )
 
+    @mock.patch('celery_redis_sentinel.redis_sentinel.ensure_redis_call')
+    def test_execute_command_target(self, mock_ensure_redis_call):
+        f = Foo()
+        f.connection_pool = mock.Mock(
+            service_name='master',
+            connection_kwargs={'db': 1},
+            sentinel_manager=mock.Mock(sentinel_addresses=[('localhost', 26379)]),
+        )
+
+        f.execute_command('lrange', 0, -1)
+
+        assert mock_ensure_redis_call.call_args[1]['redis_target'] == (
+            (('localhost', 26379),), 'master', 1,
+        )
+
+    @mock.patch('celery_redis_sentinel.redis_sentinel.get_metrics')
+    def test_execute_command_metrics(self, mock_get_metrics):
+        mock_get_metrics.return_value.enabled = True
+        f = Foo()
+
+        assert f.execute_command('GET', 'foo') == 'foo'
+
+        mock_get_metrics.return_value.observe.assert_called_once_with(
+            COMMAND_LATENCY, mock.ANY, command='GET',
+        )
+
+    @mock.patch('celery_redis_sentinel.redis_sentinel.ensure_redis_call')
+    def test_execute_command_retry_policy(self, mock_ensure_redis_call):
+        f = Foo()
+        f.retry_policy = RetryPolicy()
+
+        f.execute_command('lrange', 0, -1)
+
+        assert mock_ensure_redis_call.call_args[1]['redis_retry_policy'] is f.retry_policy
+
+    def test_pipeline(self):
+        f = Foo()
+        assert f.transaction_retry_policy == TRANSACTION_IDEMPOTENT
+        f.transaction_retry_policy = TRANSACTION_RETRY
+
+        pipe = f.pipeline(transaction=False)
+
+        assert isinstance(pipe, EnsuredPipelineMixin)
+        assert isinstance(pipe, Pipeline)
+        assert not pipe.transaction
+        assert pipe.transaction_retry_policy == TRANSACTION_RETRY
+
+    @mock.patch('time.sleep')
+    def test_pipeline_default_failover(self, mock_sleep):
+        pipe = Foo().pipeline()
+        assert pipe.transaction
+        pipe.results = iter([ConnectionError(), ['OK', True]])
+        pipe.command_stack = [(('SET', 'foo', 'bar'), {}), (('expire', 'foo', 10), {})]
+
+        assert pipe.execute() == ['OK', True]
+        assert len(pipe.executed) == 2
+        mock_sleep.assert_called_once_with(1)
+
+    @mock.patch('time.sleep')
+    def test_pipeline_default_failover_non_idempotent(self, mock_sleep):
+        pipe = Foo().pipeline()
+        pipe.results = iter([ConnectionError(), [1, 1]])
+        # celery chord counter
+        pipe.command_stack = [(('RPUSH', 'foo', 'bar'), {}), (('LLEN', 'foo'), {})]
+
+        with pytest.raises(ConnectionError):
+            pipe.execute()
+        assert len(pipe.executed) == 1
+        assert not mock_sleep.called
+
+    @pytest.mark.parametrize('commands, retried', [
+        # celery storing result
+        (['SETEX', 'PUBLISH'], True),
+        (['GET', 'TTL'], True),
+        # celery chord callback reading and deleting the counter
+        (['LRANGE', 'DEL'], False),
+        (['INCR', 'EXPIRE'], False),
+    ])
+    @mock.patch('time.sleep')
+    def test_pipeline_idempotent_commands(self, mock_sleep, commands, retried):
+        pipe = Foo().pipeline()
+        pipe.results = iter([ConnectionError(), ['OK']])
+        pipe.command_stack = [((i, 'foo'), {}) for i in commands]
+
+        if retried:
+            assert pipe.execute() == ['OK']
+        else:
+            with pytest.raises(ConnectionError):
+                pipe.execute()
+        assert mock_sleep.called == retried
+
+
+def test_get_ensured_pipeline_class():
+    cls = get_ensured_pipeline_class(Pipeline)
+
+    assert cls is get_ensured_pipeline_class(Pipeline)
+    assert issubclass(cls, EnsuredPipelineMixin)
+    assert issubclass(cls, Pipeline)
+    assert cls.__name__ == 'EnsuredPipeline'
+
+
+class TestEnsuredPipelineMixin(object):
+    @mock.patch('time.sleep')
+    def test_execute_retries_whole_stack(self, mock_sleep):
+        pipe = get_ensured_pipeline_class(Pipeline)(results=[ConnectionError(), ['OK', 1]])
+        pipe.transaction_retry_policy = TRANSACTION_RETRY
+        pipe.command_stack = [('SET', 'foo', 'bar'), ('INCR', 'baz')]
+        pipe.explicit_transaction = True
+
+        assert pipe.execute() == ['OK', 1]
+        assert pipe.executed == [
+            [('SET', 'foo', 'bar'), ('INCR', 'baz')],
+            [('SET', 'foo', 'bar'), ('INCR', 'baz')],
+        ]
+        mock_sleep.assert_called_once_with(1)
+
+    @mock.patch('time.sleep')
+    def test_execute_transaction_raise_policy(self, mock_sleep):
+        pipe = get_ensured_pipeline_class(Pipeline)(results=[ConnectionError(), ['OK']])
+        pipe.transaction_retry_policy = TRANSACTION_RAISE
+        pipe.command_stack = [(('SET', 'foo', 'bar'), {})]
+
+        with pytest.raises(ConnectionError):
+            pipe.execute()
+        assert not mock_sleep.called
+
+    @mock.patch('time.sleep')
+    def test_execute_non_transaction_raise_policy(self, mock_sleep):
+        pipe = get_ensured_pipeline_class(Pipeline)(
+            transaction=False, results=[ConnectionError(), ['OK']],
+        )
+        pipe.transaction_retry_policy = TRANSACTION_RAISE
+        pipe.command_stack = [('SET', 'foo', 'bar')]
+
+        assert pipe.execute() == ['OK']
+        assert mock_sleep.called
+
+    @mock.patch('time.sleep')
+    def test_execute_watching(self, mock_sleep):
+        pipe = get_ensured_pipeline_class(Pipeline)(watching=True, results=[ConnectionError()])
+
+        with pytest.raises(ConnectionError):
+            pipe.execute()
+        assert not mock_sleep.called
+
 
 class TestCelerySentinelConnectionPool(object):
     @mock.patch.object(SentinelConnectionPool, 'get_master_address')
@@ -98,9 +679,279 @@ class TestShortLivedStrictRedis(object):
         r.connection_pool.disconnect.assert_called_once_with()
 
 
+@mock.patch('socket.TCP_KEEPIDLE', 4, create=True)
+def test_keepalive_options():
+    options = keepalive_options(idle=30)
+
+    assert options[4] == 30
+
+
+class TestPersistentStrictRedis(object):
+    def test_init(self):
+        r = PersistentStrictRedis(health_check_interval=5)
+
+        assert r.health_check_interval == 5
+        assert r.connection_pool.connection_kwargs['socket_keepalive'] is True
+        assert r.connection_pool.connection_kwargs['socket_keepalive_options'] == keepalive_options()
+
+    @mock.patch.object(StrictRedis, 'execute_command')
+    def test_execute_command(self, mock_execute_command):
+        r = PersistentStrictRedis()
+
+        result = r.execute_command('get', 'foo')
+
+        assert result == mock_execute_command.return_value
+        mock_execute_command.assert_called_once_with('get', 'foo')
+
+    @mock.patch.object(StrictRedis, 'execute_command')
+    def test_execute_command_health_check(self, mock_execute_command):
+        r = PersistentStrictRedis(health_check_interval=5)
+        r.last_used -= 10
+        mock_execute_command.side_effect = [ConnectionError(), 'bar']
+
+        assert r.execute_command('get', 'foo') == 'bar'
+
+        mock_execute_command.assert_has_calls([mock.call('PING'), mock.call('get', 'foo')])
+
+        # recently used so not checked
+        mock_execute_command.reset_mock(side_effect=True)
+        r.execute_command('get', 'foo')
+        mock_execute_command.assert_called_once_with('get', 'foo')
+
+
+def test_get_persistent_client():
+    client = get_persistent_client('localhost', 26379, socket_timeout=1)
+
+    assert isinstance(client, PersistentStrictRedis)
+    assert get_persistent_client('localhost', 26379, socket_timeout=1) is client
+    assert get_persistent_client('localhost', 26379, socket_timeout=2) is not client
+    with mock.patch('os.getpid', return_value=-1):
+        assert get_persistent_client('localhost', 26379, socket_timeout=1) is not client
+
+
+class TestPersistentSentinel(object):
+    def test_init(self):
+        sentinel = PersistentSentinel([('localhost', 26379)], socket_timeout=1, health_check_interval=5)
+        other = PersistentSentinel([('localhost', 26379)], socket_timeout=1, health_check_interval=5)
+
+        assert isinstance(sentinel.sentinels[0], PersistentStrictRedis)
+        assert sentinel.sentinels[0].health_check_interval == 5
+        assert sentinel.sentinels[0] is other.sentinels[0]
+
+
 class TestShortLivedSentinel(object):
     def test_init(self):
         sentinel = ShortLivedSentinel([('localhost', '1'), ('localhost', '2')])
 
         for s in sentinel.sentinels:
             assert isinstance(s, ShortLivedStrictRedis)
+
+    @mock.patch.object(Sentinel, 'discover_master')
+    def test_discover_master_no_cache(self, mock_discover_master):
+        sentinel = ShortLivedSentinel([('localhost', '1')])
+
+        assert sentinel.discover_master('master') == mock_discover_master.return_value
+        assert sentinel.discover_master('master') == mock_discover_master.return_value
+        assert mock_discover_master.call_count == 2
+
+    @mock.patch('celery_redis_sentinel.redis_sentinel.master_address_cache')
+    @mock.patch.object(Sentinel, 'discover_master')
+    def test_discover_master_cached_while_waiting(self, mock_discover_master, mock_cache):
+        mock_cache.get.side_effect = [None, ('localhost', 6379)]
+        sentinel = ShortLivedSentinel([('localhost', '1')], master_cache_ttl=5)
+
+        assert sentinel.discover_master('master') == ('localhost', 6379)
+
+        assert not mock_discover_master.called
+        assert not mock_cache.set.called
+
+    @mock.patch('celery_redis_sentinel.redis_sentinel.get_metrics')
+    @mock.patch.object(Sentinel, 'discover_master')
+    def test_discover_master_metrics(self, mock_discover_master, mock_get_metrics):
+        metrics = mock_get_metrics.return_value
+        mock_discover_master.side_effect = [
+            ('localhost', 6379), ('localhost', 6379), ('localhost', 6380),
+        ]
+        sentinel = ShortLivedSentinel([('localhost', '1')])
+
+        sentinel.discover_master('master')
+        sentinel.discover_master('master')
+        assert not metrics.mark.called
+        sentinel.discover_master('master')
+
+        metrics.mark.assert_called_once_with(MASTER_SWITCH, service='master')
+        metrics.observe.assert_called_with(DISCOVERY_LATENCY, mock.ANY, service='master')
+        assert metrics.observe.call_count == 3
+
+    @mock.patch('celery_redis_sentinel.redis_sentinel.master_address_cache')
+    @mock.patch.object(Sentinel, 'discover_master')
+    def test_discover_master_cached(self, mock_discover_master, mock_cache):
+        mock_discover_master.return_value = ('localhost', 6379)
+        mock_cache.get.side_effect = [None, None, ('localhost', 6379)]
+        sentinel = ShortLivedSentinel([('localhost', '1')], master_cache_ttl=5)
+
+        assert sentinel.discover_master('master') == ('localhost', 6379)
+        assert sentinel.discover_master('master') == ('localhost', 6379)
+
+        mock_discover_master.assert_called_once_with('master')
+        mock_cache.discovery_lock.assert_called_once_with()
+        mock_cache.set.assert_called_once_with(
+            ((('localhost', '1'),), 'master'), ('localhost', 6379), 5,
+        )
+        # cache hits watch as well since shared cache might be populated by other processes
+        assert mock_cache.watch.call_args_list == [
+            mock.call([('localhost', '1')], 'master', socket_timeout=None),
+        ] * 2
+
+    def test_query_master(self):
+        sentinel = ShortLivedSentinel([('localhost', '1')])
+        s = mock.Mock()
+        s.sentinel_masters.return_value = {
+            'master': {
+                'ip': 'localhost', 'port': 6379,
+                'is_master': True, 'is_sdown': False, 'is_odown': False,
+                'num-other-sentinels': 2,
+            },
+        }
+
+        assert sentinel.query_master(s, 'master') == ('localhost', 6379)
+        assert sentinel.query_master(s, 'other') is None
+
+    def test_discover_master_parallel(self):
+        sentinel = ShortLivedSentinel(
+            [('localhost', '1'), ('localhost', '2'), ('localhost', '3')],
+            parallel_discovery=True,
+            discovery_quorum=2,
+        )
+        addresses = {
+            '1': ConnectionError(),
+            '2': ('localhost', 6379),
+            '3': ('localhost', 6379),
+        }
+
+        def query_master(s, service_name):
+            address = addresses[s.connection_pool.connection_kwargs['port']]
+            if isinstance(address, Exception):
+                raise address
+            return address
+
+        with mock.patch.object(sentinel, 'query_master', side_effect=query_master):
+            assert sentinel.discover_master('master') == ('localhost', 6379)
+
+    def test_discover_master_parallel_no_quorum(self):
+        sentinel = ShortLivedSentinel(
+            [('localhost', '1'), ('localhost', '2')],
+            parallel_discovery=True,
+            discovery_quorum=2,
+        )
+        addresses = iter([('localhost', 6379), ('localhost', 6380)])
+
+        with mock.patch.object(sentinel, 'query_master', side_effect=lambda *a: next(addresses)):
+            with pytest.raises(MasterNotFoundError):
+                sentinel.discover_master('master')
+
+    @mock.patch('celery_redis_sentinel.redis_sentinel.logger')
+    def test_discover_master_parallel_query_error(self, mock_logger):
+        sentinel = ShortLivedSentinel(
+            [('localhost', '1'), ('localhost', '2')],
+            parallel_discovery=True,
+        )
+        addresses = {'1': ValueError(), '2': None}
+
+        def query_master(s, service_name):
+            address = addresses[s.connection_pool.connection_kwargs['port']]
+            if isinstance(address, Exception):
+                raise address
+            return address
+
+        with mock.patch.object(sentinel, 'query_master', side_effect=query_master):
+            with pytest.raises(MasterNotFoundError):
+                sentinel.discover_master('master')
+
+        mock_logger.exception.assert_called_once_with(mock.ANY, 'localhost', '1', 'master')
+
+    @mock.patch('celery_redis_sentinel.redis_sentinel.sentinel_health', new_callable=SentinelHealth)
+    def test_discover_master_ranked(self, mock_health):
+        sentinel = ShortLivedSentinel(
+            [('localhost', '1'), ('localhost', '2'), ('localhost', '3')],
+            rank_sentinels=True,
+        )
+        mock_health.record(('localhost', '1'), 1, False)
+        mock_health.record(('localhost', '2'), 0.5, True)
+        mock_health.record(('localhost', '3'), 0.1, True)
+        queried = []
+
+        def query_master(s, service_name):
+            queried.append(s.connection_pool.connection_kwargs['port'])
+            if queried[-1] == '3':
+                raise ConnectionError()
+            return 'localhost', 6379
+
+        with mock.patch.object(sentinel, 'query_master', side_effect=query_master):
+            assert sentinel.discover_master('master') == ('localhost', 6379)
+
+        assert queried == ['3', '2']
+        # failure was recorded hence another one opens the circuit
+        mock_health.record(('localhost', '3'), 0.1, False)
+        assert mock_health.rank(sentinel.sentinel_addresses)[1] == [('localhost', '3')]
+
+    @mock.patch('celery_redis_sentinel.redis_sentinel.sentinel_health', new_callable=SentinelHealth)
+    def test_discover_master_ranked_circuit_open(self, mock_health):
+        sentinel = ShortLivedSentinel(
+            [('localhost', '1'), ('localhost', '2')],
+            rank_sentinels=True,
+        )
+        queried = []
+
+        def query_master(s, service_name):
+            queried.append(s.connection_pool.connection_kwargs['port'])
+            if queried[-1] == '1':
+                raise ConnectionError()
+            return None
+
+        with mock.patch.object(sentinel, 'query_master', side_effect=query_master):
+            for _ in range(3):
+                with pytest.raises(MasterNotFoundError):
+                    sentinel.discover_master('master')
+
+        # open circuit is still queried as a last resort
+        assert queried == ['1', '2', '2', '1', '2', '1']
+        assert mock_health.rank(sentinel.sentinel_addresses)[1] == [('localhost', '1')]
+
+    @mock.patch('celery_redis_sentinel.redis_sentinel.sentinel_health', new_callable=SentinelHealth)
+    def test_discover_master_parallel_ranked(self, mock_health):
+        sentinel = ShortLivedSentinel(
+            [('localhost', '1'), ('localhost', '2')],
+            parallel_discovery=True,
+            rank_sentinels=True,
+        )
+        for _ in range(2):
+            mock_health.record(('localhost', '1'), 1, False)
+        queried = []
+
+        def query_master(s, service_name):
+            queried.append(s.connection_pool.connection_kwargs['port'])
+            return 'localhost', 6379
+
+        with mock.patch.object(sentinel, 'query_master', side_effect=query_master):
+            assert sentinel.discover_master('master') == ('localhost', 6379)
+
+        assert queried == ['2']
+
+    def test_filter_slaves(self):
+        slaves = [
+            {'ip': 'a', 'port': 1, 'is_odown': False, 'is_sdown': False,
+             'master-link-status': 'ok', 'master-link-down-time': 0},
+            {'ip': 'b', 'port': 1, 'is_odown': False, 'is_sdown': False,
+             'master-link-status': 'err', 'master-link-down-time': 1000},
+            {'ip': 'c', 'port': 1, 'is_odown': False, 'is_sdown': False,
+             'master-link-status': 'ok', 'master-link-down-time': 10000},
+            {'ip': 'd', 'port': 1, 'is_odown': True, 'is_sdown': False,
+             'master-link-status': 'ok', 'master-link-down-time': 0},
+        ]
+
+        sentinel = ShortLivedSentinel([('localhost', '1')])
+        assert sentinel.filter_slaves(slaves) == [('a', 1), ('b', 1), ('c', 1)]
+
+        sentinel = ShortLivedSentinel([('localhost', '1')], max_link_down_time=5)
+        assert sentinel.filter_slaves(slaves) == [('a', 1)]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+import mock
+from redis import ConnectionError, TimeoutError
+
+from celery_redis_sentinel.retry import DEFAULT_RETRY_POLICY, RetryPolicy
+
+
+class TestRetryPolicy(object):
+    def test_defaults(self):
+        policy = RetryPolicy()
+
+        assert [policy.wait(i) for i in range(5)] == [1, 2, 4, 8, 16]
+        assert policy.max_wait() == 31
+        assert policy.exceptions == (ConnectionError, TimeoutError)
+
+    def test_exceptions_by_name(self):
+        policy = RetryPolicy(exceptions=['redis.exceptions.ConnectionError', ValueError])
+
+        assert policy.exceptions == (ConnectionError, ValueError)
+
+    def test_cap(self):
+        policy = RetryPolicy(base=3, cap=5)
+
+        assert [policy.wait(i) for i in range(3)] == [1, 3, 5]
+        assert policy.max_wait(3) == 9
+
+    @mock.patch('random.uniform')
+    def test_jitter(self, mock_uniform):
+        mock_uniform.return_value = 0.25
+        policy = RetryPolicy(jitter=0.5)
+
+        assert policy.wait(1) == 2.25
+        mock_uniform.assert_called_once_with(0, 0.5)
+        assert policy.max_wait(2) == 4
+
+    def test_max_wait_deadline(self):
+        assert RetryPolicy(deadline=10).max_wait() == 10
+
+    def test_from_options(self):
+        policy = RetryPolicy()
+
+        assert RetryPolicy.from_options(None) is DEFAULT_RETRY_POLICY
+        assert RetryPolicy.from_options(policy) is policy
+        assert RetryPolicy.from_options({'attempts': 2}).attempts == 2
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+from collections import Counter
+
+import pytest
+
+from celery_redis_sentinel.sharding import HashRing
+
+
+class TestHashRing(object):
+    def test_init_no_nodes(self):
+        with pytest.raises(ValueError):
+            HashRing([])
+
+    def test_get_node(self):
+        ring = HashRing(['a', 'b'])
+
+        assert ring.get_node('foo') == 'b'
+        assert ring.get_node('bar') == 'a'
+        assert ring.get_node('foo') == HashRing(['b', 'a']).get_node('foo')
+
+    def test_get_node_distribution(self):
+        ring = HashRing(['a', 'b', 'c'])
+
+        counts = Counter(ring.get_node('queue{}'.format(i)) for i in range(3000))
+
+        assert set(counts) == {'a', 'b', 'c'}
+        assert all(600 < i < 1400 for i in counts.values())
+
+    def test_get_node_consistent(self):
+        ring = HashRing(['a', 'b'])
+        bigger_ring = HashRing(['a', 'b', 'c'])
+
+        keys = ['queue{}'.format(i) for i in range(3000)]
+        moved = [i for i in keys if ring.get_node(i) != bigger_ring.get_node(i)]
+
+        assert all(bigger_ring.get_node(i) == 'c' for i in moved)
+        assert len(moved) < 1500
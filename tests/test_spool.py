@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import os
+import shutil
+import tempfile
+
+import mock
+import pytest
+from redis import ConnectionError
+
+from celery_redis_sentinel.spool import PublishSpool
+
+
+class TestPublishSpool(object):
+    def setup_method(self, method):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'spool')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmp)
+
+    def test_put(self):
+        spool = PublishSpool(maxlen=2)
+
+        assert spool.put('foo', (1,), {}, {'task_id': 'a'})
+        assert spool.put('foo', (2,), {}, {'task_id': 'b'})
+        assert not spool.put('foo', (3,), {}, {'task_id': 'c'})
+        assert len(spool) == 2
+
+    def test_put_persisted(self):
+        spool = PublishSpool(path=self.path)
+        spool.put('foo', (1,), {'a': 'b'}, {'task_id': 'a'})
+
+        assert list(PublishSpool(path=self.path).messages) == [
+            ('foo', (1,), {'a': 'b'}, {'task_id': 'a'}),
+        ]
+
+    def get_app(self, buffered=False):
+        app = mock.MagicMock()
+        producer = app.producer_or_acquire.return_value.__enter__.return_value
+        if not buffered:
+            producer.channel = mock.Mock(spec=[])
+        return app
+
+    @mock.patch('celery_redis_sentinel.spool.Task')
+    def test_drain(self, mock_task):
+        app = self.get_app()
+        spool = PublishSpool(path=self.path, batch_size=2)
+        spool.put('foo', (1,), {}, {'task_id': 'a'})
+        spool.put('foo', (2,), {}, {'task_id': 'b'})
+        spool.put('foo', (3,), {}, {'task_id': 'c'})
+
+        assert spool.drain(app) == 2
+
+        producer = app.producer_or_acquire.return_value.__enter__.return_value
+        mock_task.apply_async.assert_has_calls([
+            mock.call(app.tasks['foo'], (1,), {}, producer=producer, task_id='a'),
+            mock.call(app.tasks['foo'], (2,), {}, producer=producer, task_id='b'),
+        ])
+        assert list(spool.messages) == [('foo', (3,), {}, {'task_id': 'c'})]
+        assert list(PublishSpool(path=self.path).messages) == list(spool.messages)
+
+    @mock.patch('celery_redis_sentinel.spool.Task')
+    def test_drain_failure(self, mock_task):
+        mock_task.apply_async.side_effect = [None, ConnectionError]
+        app = self.get_app()
+        spool = PublishSpool(path=self.path)
+        spool.put('foo', (1,), {}, {'task_id': 'a'})
+        spool.put('foo', (2,), {}, {'task_id': 'b'})
+
+        with pytest.raises(ConnectionError):
+            spool.drain(app)
+
+        assert list(spool.messages) == [('foo', (2,), {}, {'task_id': 'b'})]
+        assert list(PublishSpool(path=self.path).messages) == list(spool.messages)
+
+    @mock.patch('celery_redis_sentinel.spool.Task')
+    def test_drain_buffered(self, mock_task):
+        app = self.get_app(buffered=True)
+        producer = app.producer_or_acquire.return_value.__enter__.return_value
+        buffered_puts = producer.channel.buffered_puts.return_value
+        spool = PublishSpool(path=self.path, batch_size=2)
+        spool.put('foo', (1,), {}, {'task_id': 'a'})
+        spool.put('foo', (2,), {}, {'task_id': 'b'})
+        spool.put('foo', (3,), {}, {'task_id': 'c'})
+
+        def apply_async(*args, **kwargs):
+            # messages are buffered and flushed once the context exits
+            assert buffered_puts.__enter__.called
+            assert not buffered_puts.__exit__.called
+
+        mock_task.apply_async.side_effect = apply_async
+
+        assert spool.drain(app) == 2
+
+        assert mock_task.apply_async.call_count == 2
+        buffered_puts.__exit__.assert_called_once_with(None, None, None)
+        assert list(spool.messages) == [('foo', (3,), {}, {'task_id': 'c'})]
+        assert list(PublishSpool(path=self.path).messages) == list(spool.messages)
+
+    @mock.patch('celery_redis_sentinel.spool.Task')
+    def test_drain_buffered_failure(self, mock_task):
+        app = self.get_app(buffered=True)
+        producer = app.producer_or_acquire.return_value.__enter__.return_value
+        producer.channel.buffered_puts.return_value.__exit__.side_effect = ConnectionError
+        spool = PublishSpool(path=self.path)
+        spool.put('foo', (1,), {}, {'task_id': 'a'})
+        spool.put('foo', (2,), {}, {'task_id': 'b'})
+
+        with pytest.raises(ConnectionError):
+            spool.drain(app)
+
+        # flush of the whole batch failed hence none is removed
+        assert len(spool) == 2
+
+    def test_drain_empty(self):
+        app = mock.MagicMock()
+
+        assert PublishSpool().drain(app) == 0
+        assert not app.producer_or_acquire.called
+
+    @mock.patch('threading.Thread')
+    def test_start(self, mock_thread):
+        spool = PublishSpool()
+        mock_thread.return_value.is_alive.return_value = True
+
+        spool.start(mock.sentinel.app)
+        spool.start(mock.sentinel.app)
+
+        mock_thread.assert_called_once_with(
+            target=spool.run, args=(mock.sentinel.app,), name='celery-publish-spool',
+        )
+        mock_thread.return_value.start.assert_called_once_with()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+import threading
+
+import mock
+from redis import ConnectionError
+
+from celery_redis_sentinel.subscriber import (
+    CONTROL_CHANNEL,
+    ResultSubscriber,
+    Waiter,
+    get_result_subscriber,
+)
+
+
+def test_waiter_notify():
+    waiter = Waiter('foo')
+
+    waiter.notify()
+    waiter.notify(b'data')
+
+    assert waiter.event.is_set()
+    assert list(waiter.notifications) == [None, b'data']
+
+
+class TestResultSubscriber(object):
+    def setup_method(self, method):
+        self.subscriber = ResultSubscriber(mock.Mock())
+        self.subscriber.pubsub = mock.Mock()
+
+    def test_add_subscribes(self):
+        waiter = self.subscriber.add('foo')
+
+        assert self.subscriber.waiters['foo'] == {waiter}
+        self.subscriber.pubsub.subscribe.assert_called_once_with('foo')
+        assert not waiter.event.is_set()
+
+    def test_add_already_confirmed(self):
+        self.subscriber.add('foo')
+        self.subscriber.confirmed.add('foo')
+
+        waiter = self.subscriber.add('foo')
+
+        self.subscriber.pubsub.subscribe.assert_called_once_with('foo')
+        assert list(waiter.notifications) == [None]
+
+    def test_add_not_connected(self):
+        self.subscriber.pubsub.subscribe.side_effect = ConnectionError
+
+        waiter = self.subscriber.add('foo')
+
+        assert self.subscriber.waiters['foo'] == {waiter}
+
+    def test_remove(self):
+        waiter = self.subscriber.add('foo')
+        other = self.subscriber.add('foo')
+        self.subscriber.confirmed.add('foo')
+
+        self.subscriber.remove(waiter)
+        assert not self.subscriber.pubsub.unsubscribe.called
+
+        self.subscriber.remove(other)
+        assert 'foo' not in self.subscriber.waiters
+        assert 'foo' not in self.subscriber.confirmed
+        self.subscriber.pubsub.unsubscribe.assert_called_once_with('foo')
+
+    def test_handle_message_subscribe(self):
+        waiter = self.subscriber.add('foo')
+
+        self.subscriber.handle_message({'type': 'subscribe', 'channel': b'foo', 'data': 1})
+        self.subscriber.handle_message({'type': 'subscribe', 'channel': b'bar', 'data': 2})
+
+        assert self.subscriber.confirmed == {'foo'}
+        assert list(waiter.notifications) == [None]
+
+    def test_handle_message(self):
+        waiter = self.subscriber.add('foo')
+
+        self.subscriber.handle_message({'type': 'message', 'channel': b'foo', 'data': b'data'})
+
+        assert list(waiter.notifications) == [b'data']
+
+    def test_listen(self):
+        self.subscriber.pubsub = None
+        self.subscriber.waiters['foo'].add(Waiter('foo'))
+        self.subscriber.confirmed.add('foo')
+        pubsub = self.subscriber.client_factory.return_value.pubsub.return_value
+        pubsub.get_message.side_effect = [
+            None,
+            {'type': 'subscribe', 'channel': b'foo', 'data': 1},
+            ConnectionError,
+        ]
+
+        try:
+            self.subscriber.listen()
+        except ConnectionError:
+            pass
+        else:
+            assert False, 'ConnectionError should be raised'
+
+        pubsub.subscribe.assert_called_once_with(CONTROL_CHANNEL, 'foo')
+        pubsub.close.assert_called_once_with()
+        assert self.subscriber.pubsub is None
+        assert self.subscriber.confirmed == set()
+        assert list(next(iter(self.subscriber.waiters['foo'])).notifications) == [None]
+
+    @mock.patch('celery_redis_sentinel.subscriber.shutdown_connection')
+    def test_on_switch_master(self, mock_shutdown_connection):
+        self.subscriber.on_switch_master(('a', 1), ('b', 1))
+
+        mock_shutdown_connection.assert_called_once_with(self.subscriber.pubsub.connection)
+
+    @mock.patch('celery_redis_sentinel.subscriber.get_switch_master_listener')
+    def test_start(self, mock_get_switch_master_listener):
+        subscriber = ResultSubscriber(mock.Mock(), sentinels=[('a', 1)], service_name='master')
+
+        with mock.patch.object(subscriber, 'run', side_effect=threading.Event().wait):
+            subscriber.start()
+            thread = subscriber._thread
+            subscriber.start()
+
+        assert subscriber._thread is thread
+        assert thread.daemon
+        mock_get_switch_master_listener.return_value.add_callback.assert_called_with(
+            subscriber.on_switch_master,
+        )
+
+    @mock.patch.object(ResultSubscriber, 'start')
+    def test_wait(self, mock_start):
+        def publish():
+            self.subscriber.handle_message({'type': 'subscribe', 'channel': b'foo', 'data': 1})
+            self.subscriber.handle_message({'type': 'message', 'channel': b'foo', 'data': b'done'})
+
+        # published from another thread once subscribed as the subscription thread would
+        self.subscriber.pubsub.subscribe.side_effect = lambda channel: threading.Timer(0.01, publish).start()
+        check = mock.Mock(side_effect=[None, 'result'])
+
+        assert self.subscriber.wait('foo', check, timeout=1) == 'result'
+
+        check.assert_has_calls([mock.call(None), mock.call(b'done')])
+        assert 'foo' not in self.subscriber.waiters
+
+    @mock.patch.object(ResultSubscriber, 'start')
+    def test_wait_timeout(self, mock_start):
+        on_interval = mock.Mock()
+
+        assert self.subscriber.wait('foo', mock.Mock(), timeout=0.05, interval=0.01, on_interval=on_interval) is None
+
+        assert on_interval.called
+        assert 'foo' not in self.subscriber.waiters
+
+
+def test_get_result_subscriber():
+    factory = mock.Mock()
+
+    subscriber = get_result_subscriber('key', factory, service_name='master')
+
+    assert isinstance(subscriber, ResultSubscriber)
+    assert subscriber.client_factory is factory
+    assert subscriber.service_name == 'master'
+    assert get_result_subscriber('key', mock.Mock()) is subscriber
+    assert get_result_subscriber('other', factory) is not subscriber
@@ -1,9 +1,20 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 
+import os
+import shutil
+import tempfile
+import time
+
 import mock
+import pytest
+from celery import Task
+from kombu.exceptions import OperationalError
+from redis import ConnectionError
 
-from celery_redis_sentinel.task import EnsuredRedisTask
+from celery_redis_sentinel.retry import DEFAULT_RETRY_POLICY
+from celery_redis_sentinel.spool import PublishSpool
+from celery_redis_sentinel.task import EnsuredRedisTask, publish_many
 
 
 @mock.patch('celery_redis_sentinel.task.ensure_redis_call')
@@ -13,4 +24,160 @@ def test_apply_async(mock_ensure_redis_call):
     actual = task.apply_async('foo', happy='rainbows')
 
     assert actual == mock_ensure_redis_call.return_value
-    mock_ensure_redis_call.assert_called_once_with(mock.ANY, 'foo', happy='rainbows')
+    mock_ensure_redis_call.assert_called_once_with(
+        mock.ANY, 'foo', happy='rainbows', redis_retry_policy=DEFAULT_RETRY_POLICY,
+    )
+
+
+@mock.patch('celery_redis_sentinel.task.ensure_redis_call')
+def test_apply_async_retry_policy(mock_ensure_redis_call):
+    task = EnsuredRedisTask()
+    task.redis_retry_policy = {'attempts': 2}
+
+    task.apply_async('foo', retry_policy={'max_retries': 1})
+
+    kwargs = mock_ensure_redis_call.call_args[1]
+    assert kwargs['redis_retry_policy'].attempts == 2
+    # celery publish retry policy is passed to apply_async as is
+    assert kwargs['retry_policy'] == {'max_retries': 1}
+
+
+def test_get_redis_retry_policy_transport_options():
+    app = mock.Mock()
+    app.conf.get.return_value = {'retry_policy': {'cap': 3}}
+
+    with mock.patch.object(EnsuredRedisTask, 'app', app):
+        assert EnsuredRedisTask().get_redis_retry_policy().cap == 3
+
+    app.conf.get.assert_called_once_with('BROKER_TRANSPORT_OPTIONS')
+
+
+@mock.patch.object(Task, 'apply_async')
+def test_apply_async_spooled(mock_apply_async):
+    task = EnsuredRedisTask()
+    task.publish_spool = mock.MagicMock()
+    task.publish_spool.__len__.return_value = 0
+
+    actual = task.apply_async(('foo',), {'happy': 'rainbows'})
+
+    assert actual == mock_apply_async.return_value
+    mock_apply_async.assert_called_once_with(('foo',), {'happy': 'rainbows'}, task_id=mock.ANY)
+    assert not task.publish_spool.put.called
+    assert not task.publish_spool.start.called
+
+
+@mock.patch.object(Task, 'apply_async')
+def test_apply_async_spooled_replays_persisted(mock_apply_async):
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'spool')
+    try:
+        PublishSpool(path=path).put('foo', (1,), {}, {'task_id': 'a'})
+
+        app = mock.MagicMock()
+        producer = app.producer_or_acquire.return_value.__enter__.return_value
+        producer.channel = mock.Mock(spec=[])
+        task = EnsuredRedisTask()
+        # spool reloaded from path after process restart
+        task.publish_spool = PublishSpool(path=path)
+
+        with mock.patch.object(EnsuredRedisTask, 'app', app):
+            task.apply_async((2,), task_id='b')
+
+            for _ in range(100):
+                if not len(task.publish_spool):
+                    break
+                time.sleep(0.01)
+
+        assert not len(task.publish_spool)
+        mock_apply_async.assert_has_calls([
+            mock.call((2,), None, task_id='b'),
+            mock.call(app.tasks['foo'], (1,), {}, producer=producer, task_id='a'),
+        ], any_order=True)
+        assert not PublishSpool(path=path).messages
+    finally:
+        shutil.rmtree(tmp)
+
+
+@mock.patch.object(Task, 'AsyncResult')
+@mock.patch.object(Task, 'apply_async')
+def test_apply_async_spooled_failure(mock_apply_async, mock_async_result):
+    mock_apply_async.side_effect = ConnectionError
+    task = EnsuredRedisTask()
+    task.name = 'foo'
+    task.publish_spool = mock.MagicMock()
+    task.publish_spool.__len__.return_value = 0
+    task.publish_spool.put.return_value = True
+
+    actual = task.apply_async(('foo',), task_id='bar', producer=mock.sentinel.producer, queue='q')
+
+    assert actual == mock_async_result.return_value
+    mock_async_result.assert_called_once_with('bar')
+    task.publish_spool.put.assert_called_once_with(
+        'foo', ('foo',), None, {'task_id': 'bar', 'queue': 'q'},
+    )
+    task.publish_spool.start.assert_called_once_with(task.app)
+
+
+@mock.patch.object(Task, 'AsyncResult')
+@mock.patch.object(Task, 'apply_async')
+def test_apply_async_spooled_operational_error(mock_apply_async, mock_async_result):
+    # kombu 4+ raises redis connection errors as OperationalError
+    mock_apply_async.side_effect = OperationalError
+    task = EnsuredRedisTask()
+    task.name = 'foo'
+    task.publish_spool = mock.MagicMock()
+    task.publish_spool.__len__.return_value = 0
+    task.publish_spool.put.return_value = True
+
+    assert task.apply_async(('foo',), task_id='bar') == mock_async_result.return_value
+    task.publish_spool.put.assert_called_once_with('foo', ('foo',), None, {'task_id': 'bar'})
+
+
+@mock.patch.object(Task, 'apply_async')
+def test_apply_async_spool_full(mock_apply_async):
+    mock_apply_async.side_effect = ConnectionError
+    task = EnsuredRedisTask()
+    task.publish_spool = mock.MagicMock()
+    task.publish_spool.__len__.return_value = 0
+    task.publish_spool.put.return_value = False
+
+    with pytest.raises(ConnectionError):
+        task.apply_async(('foo',))
+    assert not task.publish_spool.start.called
+
+
+def test_publish_many():
+    task = mock.MagicMock()
+    producer = task.app.producer_or_acquire.return_value.__enter__.return_value
+    channel = producer.channel
+    pending = []
+    channel.pending_puts = 0
+
+    def apply_async(args, **kwargs):
+        channel.pending_puts += 1
+        return args
+
+    def flush_puts():
+        pending.append(channel.pending_puts)
+        channel.pending_puts = 0
+
+    task.apply_async.side_effect = apply_async
+    channel.flush_puts.side_effect = flush_puts
+
+    actual = publish_many(task, ((i,) for i in range(5)), chunk_size=2, queue='foo')
+
+    assert actual == [(0,), (1,), (2,), (3,), (4,)]
+    task.apply_async.assert_called_with((4,), producer=producer, queue='foo')
+    assert pending == [2, 2]
+    channel.buffered_puts.return_value.__exit__.assert_called_once_with(None, None, None)
+
+
+def test_publish_many_not_buffered():
+    task = mock.MagicMock()
+    producer = task.app.producer_or_acquire.return_value.__enter__.return_value
+    producer.channel = object()
+
+    actual = publish_many(task, [(1,), (2,)])
+
+    assert actual == [task.apply_async.return_value] * 2
+    task.apply_async.assert_called_with((2,), producer=producer)
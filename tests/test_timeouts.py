@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+import mock
+import pytest
+from redis import TimeoutError
+
+from celery_redis_sentinel.timeouts import (
+    AdaptiveTimeout,
+    AdaptiveTimeoutConnectionMixin,
+)
+
+
+class Connection(object):
+    socket_timeout = 0.1
+
+    def __init__(self):
+        self._sock = mock.Mock()
+        self.sent = []
+        self.response = 'OK'
+
+    def send_command(self, *args, **kwargs):
+        self.sent.append(args)
+
+    def read_response(self, *args, **kwargs):
+        if isinstance(self.response, Exception):
+            self._sock = None
+            raise self.response
+        return self.response
+
+
+class AdaptiveConnection(AdaptiveTimeoutConnectionMixin, Connection):
+    pass
+
+
+class TestAdaptiveTimeout(object):
+    def test_defaults(self):
+        timeout = AdaptiveTimeout(0.1)
+
+        assert timeout.timeout == 0.1
+        assert timeout.maximum == 1
+
+    def test_observe(self):
+        timeout = AdaptiveTimeout(0.1, min_samples=10, update_every=10)
+
+        for _ in range(9):
+            timeout.observe(0.2)
+        assert timeout.timeout == 0.1
+
+        timeout.observe(0.2)
+        assert timeout.timeout == pytest.approx(0.6)
+
+    def test_observe_percentile(self):
+        timeout = AdaptiveTimeout(0.01, maximum=1, percentile=90, multiplier=2, min_samples=10, update_every=10)
+
+        for i in range(1, 11):
+            timeout.observe(i / 100.0)
+
+        assert timeout.timeout == pytest.approx(0.18)
+
+    def test_observe_bounds(self):
+        timeout = AdaptiveTimeout(0.1, maximum=0.5, min_samples=10, update_every=10)
+
+        for _ in range(10):
+            timeout.observe(0.001)
+        assert timeout.timeout == 0.1
+
+        for _ in range(1000):
+            timeout.observe(1)
+        assert timeout.timeout == 0.5
+
+    def test_from_options(self):
+        timeout = AdaptiveTimeout(0.1)
+
+        assert AdaptiveTimeout.from_options(None, 0.1) is None
+        assert AdaptiveTimeout.from_options(False, 0.1) is None
+        assert AdaptiveTimeout.from_options(timeout, 0.1) is timeout
+        assert AdaptiveTimeout.from_options(True, 0.2).minimum == 0.2
+        assert AdaptiveTimeout.from_options(True, None).minimum == 0.1
+        assert AdaptiveTimeout.from_options({'maximum': 5}, 0.2).maximum == 5
+        assert AdaptiveTimeout.from_options({'minimum': 0.5}, 0.2).minimum == 0.5
+
+
+class TestAdaptiveTimeoutConnectionMixin(object):
+    def get_connection(self):
+        connection = AdaptiveConnection()
+        connection.adaptive_timeout = mock.Mock(timeout=0.5)
+        return connection
+
+    def test_command(self):
+        connection = self.get_connection()
+        sock = connection._sock
+
+        connection.send_command('GET', 'foo')
+        assert connection.read_response() == 'OK'
+
+        assert sock.settimeout.call_args_list == [mock.call(0.5), mock.call(0.1)]
+        connection.adaptive_timeout.observe.assert_called_once_with(mock.ANY)
+
+    def test_blocking_command(self):
+        connection = self.get_connection()
+
+        connection.send_command(b'BRPOP', 'foo', 1)
+        connection.read_response()
+
+        assert not connection._sock.settimeout.called
+        assert not connection.adaptive_timeout.observe.called
+
+    def test_without_command(self):
+        connection = self.get_connection()
+
+        # e.g. pipeline or pub/sub message
+        connection.read_response()
+
+        assert not connection._sock.settimeout.called
+        assert not connection.adaptive_timeout.observe.called
+
+    def test_disabled(self):
+        connection = AdaptiveConnection()
+
+        connection.send_command('GET', 'foo')
+        connection.read_response()
+
+        assert not connection._sock.settimeout.called
+
+    def test_timeout(self):
+        connection = self.get_connection()
+        sock = connection._sock
+        connection.response = TimeoutError()
+
+        connection.send_command('GET', 'foo')
+        with pytest.raises(TimeoutError):
+            connection.read_response()
+
+        # timeout of disconnected socket is not restored
+        sock.settimeout.assert_called_once_with(0.5)
+        connection.adaptive_timeout.observe.assert_called_once_with(mock.ANY)
+
+    def test_error(self):
+        connection = self.get_connection()
+        connection.response = ValueError()
+
+        connection.send_command('GET', 'foo')
+        with pytest.raises(ValueError):
+            connection.read_response()
+
+        assert not connection.adaptive_timeout.observe.called
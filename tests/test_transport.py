@@ -1,12 +1,27 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 
+import socket
+
 import mock
+import pytest
 from kombu import Connection
-from redis import StrictRedis
+from kombu.transport.redis import Channel
+from redis import Connection as RedisConnection, ConnectionError, ConnectionPool, StrictRedis
 
-from celery_redis_sentinel.redis_sentinel import CelerySentinelConnectionPool
-from celery_redis_sentinel.transport import SentinelChannel, SentinelTransport
+from celery_redis_sentinel.redis_sentinel import (
+    TRANSACTION_RETRY,
+    CelerySentinelConnectionPool,
+    PinnedConnectionPool,
+)
+from celery_redis_sentinel.transport import (
+    SentinelChannel,
+    SentinelMultiChannelPoller,
+    SentinelTransport,
+    ShardChannel,
+    ShardRouter,
+    shutdown_connection,
+)
 
 from test_tasks.celeryconfig import BROKER_TRANSPORT_OPTIONS
 from test_tasks.tasks import app
@@ -48,12 +63,527 @@ class TestSentinelChannel(object):
                        ('192.168.1.3', 26379)],
             service_name='master',
             socket_timeout=1,
+            master_cache_ttl=None,
+            parallel_discovery=False,
+            discovery_quorum=1,
+            sentinel_socket_timeout=None,
+            adaptive_timeout=None,
             socket_connect_timeout=mock.ANY,
             socket_keepalive=mock.ANY,
             socket_keepalive_options=mock.ANY,
         )
 
+    @mock.patch.object(StrictRedis, 'execute_command')
+    @mock.patch('celery_redis_sentinel.transport.get_shared_connection_pool')
+    def test_sentinel_pool_shared(self, mock_get_shared_connection_pool, mock_execute_command):
+        connection = Connection()
+        connection.transport_options = dict(BROKER_TRANSPORT_OPTIONS, shared_pool=True)
+        transport = SentinelTransport(app=app, client=connection)
+
+        shared = mock_get_shared_connection_pool.return_value
+        shared.get_master_address.return_value = ('192.168.1.128', '6379')
+
+        channel = SentinelChannel(connection=transport)
+        pool = channel.sentinel_pool
+
+        assert isinstance(pool, PinnedConnectionPool)
+        assert pool.pool is shared
+        assert channel._master_address == ('192.168.1.128', 6379)
+        assert mock_get_shared_connection_pool.call_args[1]['service_name'] == 'master'
+
+        client = channel.publish_client
+
+        assert client.connection_pool is shared
+        assert client.transaction_retry_policy == TRANSACTION_RETRY
+
+    @mock.patch.object(StrictRedis, 'execute_command')
+    @mock.patch('celery_redis_sentinel.transport.get_switch_master_listener')
+    @mock.patch('celery_redis_sentinel.transport.get_redis_via_sentinel')
+    def test_sentinel_pool_failover_detection(self,
+                                              mock_get_redis_via_sentinel,
+                                              mock_get_switch_master_listener,
+                                              mock_execute_command):
+        connection = Connection()
+        connection.transport_options = dict(BROKER_TRANSPORT_OPTIONS, failover_detection=True)
+        transport = SentinelTransport(app=app, client=connection)
+
+        mock_get_redis_via_sentinel.return_value.connection_pool.get_master_address.return_value = (
+            '192.168.1.128', '6379',
+        )
+
+        channel = SentinelChannel(connection=transport)
+
+        listener = mock_get_switch_master_listener.return_value
+        mock_get_switch_master_listener.assert_called_once_with(
+            BROKER_TRANSPORT_OPTIONS['sentinels'], 'master', socket_timeout=1,
+        )
+        listener.add_callback.assert_called_once_with(channel.on_switch_master)
+
+        channel.close()
+
+        listener.remove_callback.assert_called_once_with(channel.on_switch_master)
+
+    def test_on_switch_master(self):
+        channel = SentinelChannel.__new__(SentinelChannel)
+        channel._master_address = ('192.168.1.128', 6379)
+        channel.__dict__['client'] = mock.Mock()
+
+        channel.on_switch_master(('192.168.1.127', 6379), ('192.168.1.128', 6379))
+        assert not channel._master_switched
+
+        channel.on_switch_master(('192.168.1.128', 6379), ('192.168.1.129', 6379))
+        assert channel._master_switched
+        channel.client.connection._sock.shutdown.assert_called_once_with(socket.SHUT_RDWR)
+
+        with pytest.raises(ConnectionError):
+            channel._brpop_start()
+
+    @mock.patch.object(Channel, '_connparams')
+    def test_connparams_keepalive(self, mock_connparams):
+        mock_connparams.return_value = {'host': 'localhost'}
+        channel = SentinelChannel.__new__(SentinelChannel)
+
+        assert channel._connparams() == {'host': 'localhost'}
+
+        channel.socket_keepalive_idle = 10
+        channel.socket_keepalive_count = 3
+        params = channel._connparams()
+
+        assert params['socket_keepalive'] is True
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            assert params['socket_keepalive_options'][socket.TCP_KEEPIDLE] == 10
+        if hasattr(socket, 'TCP_KEEPCNT'):
+            assert params['socket_keepalive_options'][socket.TCP_KEEPCNT] == 3
+
+    @mock.patch.object(Channel, '_brpop_start')
+    def test_brpop_start_health_check(self, mock_brpop_start):
+        channel = SentinelChannel.__new__(SentinelChannel)
+        channel.check_master_health = mock.Mock()
+
+        channel._brpop_start()
+        assert not channel.check_master_health.called
+        assert channel._brpop_sent_at is None
+
+        channel.master_health_check_interval = 10
+        channel._in_poll = True
+        channel._brpop_start()
+        channel._health_checked_at = channel._brpop_sent_at
+        channel._brpop_start()
+
+        channel.check_master_health.assert_called_once_with()
+        assert channel._brpop_sent_at is not None
+
+    def test_check_master_health(self):
+        channel = SentinelChannel.__new__(SentinelChannel)
+        channel._master_address = ('192.168.1.128', 6379)
+        channel.__dict__['client'] = mock.Mock()
+        connection = channel.client.connection
+
+        channel.check_master_health()
+
+        connection.send_command.assert_called_once_with('PING')
+        connection.can_read.assert_called_once_with(timeout=1)
+        connection.read_response.assert_called_once_with()
+        assert channel._health_checked_at is not None
+
+        connection.can_read.return_value = False
+        with pytest.raises(ConnectionError):
+            channel.check_master_health()
+
+    def test_check_master_health_not_connected(self):
+        channel = SentinelChannel.__new__(SentinelChannel)
+        channel.__dict__['client'] = mock.Mock()
+        channel.client.connection._sock = None
+
+        channel.check_master_health()
+
+        assert not channel.client.connection.send_command.called
+
+    def test_check_brpop_health(self):
+        channel = SentinelChannel.__new__(SentinelChannel)
+        channel._master_address = ('192.168.1.128', 6379)
+        channel._brpop_sent_at = 0
+
+        # health checks are disabled by default
+        channel.check_brpop_health()
+
+        channel.master_health_check_interval = 10
+        with pytest.raises(ConnectionError):
+            channel.check_brpop_health()
+        assert channel._brpop_sent_at is None
+
+        channel.check_brpop_health()
+
+    def test_check_brpop_health_replied(self):
+        channel = SentinelChannel.__new__(SentinelChannel)
+        channel._master_address = ('192.168.1.128', 6379)
+        channel._brpop_sent_at = 0
+        channel.master_health_check_interval = 10
+        channel.client = mock.Mock()
+        channel.client.connection.can_read.return_value = True
+
+        # overdue reply which was already received is not aborted
+        channel.check_brpop_health()
+        assert channel._brpop_sent_at == 0
+        channel.client.connection.can_read.assert_called_once_with(timeout=0)
+
+        channel.client.connection.can_read.return_value = False
+        channel._in_poll = channel.client.connection
+        with pytest.raises(ConnectionError):
+            channel.check_brpop_health()
+        assert channel._in_poll is None
+        channel.client.connection.disconnect.assert_called_once_with()
+
+    @mock.patch.object(Channel, '_brpop_read')
+    def test_brpop_read(self, mock_brpop_read):
+        channel = SentinelChannel.__new__(SentinelChannel)
+        channel._brpop_sent_at = 0
+
+        assert channel._brpop_read() == mock_brpop_read.return_value
+        assert channel._brpop_sent_at is None
+
+    def test_buffered_puts(self):
+        channel = SentinelChannel.__new__(SentinelChannel)
+        channel.publish_client = mock.Mock()
+        pipeline = channel.publish_client.pipeline.return_value
+        pipeline.__len__ = mock.Mock(side_effect=lambda: pipeline.lpush.call_count)
+
+        assert channel.pending_puts == 0
+        with channel.buffered_puts():
+            channel._put('foo', {'properties': {}})
+            channel._put('foo', {'properties': {}})
+
+            assert channel.pending_puts == 2
+            pipeline.lpush.assert_called_with('foo', mock.ANY)
+            assert not pipeline.execute.called
+
+        pipeline.execute.assert_called_once_with()
+        assert channel.pending_puts == 0
+        assert not channel._buffering_put
+
+    def test_buffered_puts_exception(self):
+        channel = SentinelChannel.__new__(SentinelChannel)
+        channel.publish_client = mock.Mock()
+        pipeline = channel.publish_client.pipeline.return_value
+
+        with pytest.raises(ValueError):
+            with channel.buffered_puts():
+                channel._put('foo', {'properties': {}})
+                raise ValueError
+
+        assert not pipeline.execute.called
+        assert channel._put_pipeline is None
+
+    def test_flush_puts(self):
+        channel = SentinelChannel.__new__(SentinelChannel)
+        channel.flush_puts()
+
+        channel._put_pipeline = mock.MagicMock()
+        channel._put_pipeline.__len__.return_value = 1
+        channel._put_pipeline.execute.side_effect = ConnectionError
+
+        with pytest.raises(ConnectionError):
+            channel.flush_puts()
+
+        channel._put_pipeline.reset.assert_called_once_with()
+
+    @mock.patch.object(Channel, '_put')
+    def test_put_not_buffered(self, mock_put):
+        channel = SentinelChannel.__new__(SentinelChannel)
+
+        channel._put('foo', {'properties': {}}, bar='baz')
+
+        mock_put.assert_called_once_with('foo', {'properties': {}}, bar='baz')
+
+    def get_sharded_channel(self):
+        # with service names "a" and "b", queue "bar" belongs
+        # to the home shard "a" and queue "foo" to shard "b"
+        channel = SentinelChannel.__new__(SentinelChannel)
+        channel.service_name = 'a'
+        channel.service_names = ['a', 'b']
+        channel._shard_channels = {'b': mock.MagicMock()}
+        return channel
+
+    def test_shard_channel(self):
+        channel = self.get_sharded_channel()
+
+        assert channel.shard_channel('foo') is channel.shard_channels['b']
+        assert channel.shard_channel('bar') is channel
+
+    def test_shard_channel_not_sharded(self):
+        channel = SentinelChannel.__new__(SentinelChannel)
+
+        assert channel.shard_ring is None
+        assert channel.shard_channel('foo') is channel
+
+    @mock.patch('celery_redis_sentinel.transport.ShardChannel')
+    def test_shard_channel_created(self, mock_shard_channel):
+        channel = self.get_sharded_channel()
+        channel._shard_channels = None
+
+        assert channel.shard_channel('foo') is mock_shard_channel.return_value
+        assert channel.shard_channel('foo') is mock_shard_channel.return_value
+
+        mock_shard_channel.assert_called_once_with(channel, 'b')
+
+    def test_active_queues_sharded(self):
+        channel = self.get_sharded_channel()
+        channel._active_queues = ['foo', 'bar', 'baz']
+        channel.active_fanout_queues = {'baz'}
+
+        assert channel.active_queues == {'bar'}
+        assert channel._shard_queues('b') == {'foo'}
+
+    def test_put_sharded(self):
+        channel = self.get_sharded_channel()
+
+        channel._put('foo', {'properties': {}})
+
+        channel.shard_channels['b']._put.assert_called_once_with('foo', {'properties': {}})
+
+    def test_size_sharded(self):
+        channel = self.get_sharded_channel()
+
+        assert channel._size('foo') == channel.shard_channels['b']._size.return_value
+
+    def test_shard_router(self):
+        channel = self.get_sharded_channel()
+        channel.sep = '\x06\x16'
+        shard_client = channel.shard_channels['b'].conn_or_acquire.return_value.__enter__.return_value
+        pipe = mock.Mock()
+        router = ShardRouter(channel, pipe)
+
+        router.rpush('bar', 'message')
+        router.lpush('foo\x06\x163', 'message')
+
+        assert router
+        pipe.rpush.assert_called_once_with('bar', 'message')
+        shard_client.lpush.assert_called_once_with('foo\x06\x163', 'message')
+
+    def test_close_clients_shared_pool(self):
+        class FakeConnection(RedisConnection):
+            def connect(self):
+                pass
+
+        shared = ConnectionPool(connection_class=FakeConnection, max_connections=3)
+        shared.get_master_address = lambda: ('localhost', 6379)
+
+        # more channels than the shared pool has connections
+        for _ in range(10):
+            channel = SentinelChannel.__new__(SentinelChannel)
+            channel._pool = channel._async_pool = PinnedConnectionPool(shared)
+            channel.client = StrictRedis(connection_pool=channel._pool)
+            channel.subclient = channel.client.pubsub()
+            channel.client.connection = channel._pool.get_connection('_')
+            channel.subclient.connection = channel._pool.get_connection('_')
+
+            # same order as Channel.close()
+            channel._disconnect_pools()
+            channel._close_clients()
+
+            assert channel.client.connection is None
+            assert channel.subclient.connection is None
+            assert len(shared._in_use_connections) == 0
+
+        assert len(shared._available_connections) == 2
+
+    def test_close_clients(self):
+        channel = SentinelChannel.__new__(SentinelChannel)
+        channel.client = mock.Mock()
+        connection = channel.client.connection
+
+        channel._close_clients()
+
+        connection.disconnect.assert_called_once_with()
+        channel.client.connection_pool.release.assert_called_once_with(connection)
+        assert channel.client.connection is None
+
+    def test_close_shard_channels(self):
+        channel = self.get_sharded_channel()
+        shard_channel = channel.shard_channels['b']
+
+        with mock.patch.object(Channel, 'close'):
+            channel.close()
+
+        shard_channel.close.assert_called_once_with()
+        assert channel.shard_channels == {}
+
+    def test_reset_shard_channel(self):
+        channel = self.get_sharded_channel()
+        shard_channel = channel.shard_channels['b']
+        shard_channel.service_name = 'b'
+        shard_channel.close.side_effect = ConnectionError()
+
+        channel.reset_shard_channel(shard_channel)
+
+        shard_channel.close.assert_called_once_with()
+        assert shard_channel._in_poll is None
+        assert channel.shard_channels == {}
+
+    @mock.patch('celery_redis_sentinel.transport.ShardChannel')
+    def test_restore_shard_channels(self, mock_shard_channel):
+        channel = self.get_sharded_channel()
+        channel._active_queues = ['foo', 'bar']
+        channel.active_fanout_queues = set()
+        existing = channel.shard_channels['b']
+        channel.restore_shard_channels()
+        assert not existing._update_queue_cycle.called
+
+        channel._shard_channels = {}
+        channel.restore_shard_channels()
+
+        assert channel.shard_channels == {'b': mock_shard_channel.return_value}
+        mock_shard_channel.return_value._update_queue_cycle.assert_called_once_with()
+
+
+class TestShardChannel(object):
+    @mock.patch.object(SentinelChannel, '__init__', return_value=None)
+    def test_init(self, mock_init):
+        parent = mock.Mock()
+
+        channel = ShardChannel(parent, 'b')
+
+        mock_init.assert_called_once_with(parent.connection)
+        assert channel.service_name == 'b'
+        assert channel.qos is parent.qos
+        assert channel.active_queues == parent._shard_queues.return_value
+        parent._shard_queues.assert_called_once_with('b')
+        assert 'service_name' not in ShardChannel.from_transport_options
+
+    @mock.patch.object(SentinelChannel, '__init__', return_value=None)
+    @mock.patch('celery_redis_sentinel.transport.get_redis_via_sentinel')
+    def test_sentinel_pool(self, mock_get_redis_via_sentinel, mock_init):
+        parent = mock.Mock()
+        parent.connection.client.hostname = '192.168.1.128'
+        parent.connection.client.port = 6379
+        pool = mock_get_redis_via_sentinel.return_value.connection_pool
+        pool.get_master_address.return_value = ('192.168.1.129', '6380')
+        channel = ShardChannel(parent, 'b')
+        channel.connection = parent.connection
+        channel.shared_pool = False
+        channel.failover_detection = False
+        channel.Client = StrictRedis
+
+        with mock.patch.object(ShardChannel, '_sentinel_params', return_value={}):
+            assert channel.sentinel_pool is pool
+
+        assert channel._master_address == ('192.168.1.129', 6380)
+        # parent connection keeps the address of the parent master
+        assert parent.connection.client.hostname == '192.168.1.128'
+        assert parent.connection.client.port == 6379
+
+
+def test_shutdown_connection():
+    connection = mock.Mock()
+
+    shutdown_connection(connection)
+    shutdown_connection(None)
+
+    connection._sock.shutdown.assert_called_once_with(socket.SHUT_RDWR)
+
+
+class TestSentinelMultiChannelPoller(object):
+    @mock.patch('kombu.transport.redis.MultiChannelPoller._register_BRPOP')
+    def test_register_brpop(self, mock_register_brpop):
+        poller = SentinelMultiChannelPoller()
+        channel = mock.Mock(_in_poll=False)
+        poller.add(channel)
+
+        poller._register_BRPOP(channel)
+        assert not channel.check_brpop_health.called
+
+        channel._in_poll = True
+        poller._register_BRPOP(channel)
+        channel.check_brpop_health.assert_called_once_with()
+
+        assert mock_register_brpop.call_count == 2
+
+    def get_sharded_poller(self):
+        poller = SentinelMultiChannelPoller()
+        poller.poller = mock.Mock()
+        parent = mock.Mock(closed=False, brpop_timeout=1)
+        shard = mock.Mock(spec=ShardChannel, service_name='b', _in_poll=None)
+        shard.parent = parent
+        shard.handlers = {'BRPOP': mock.Mock(side_effect=ConnectionError())}
+        parent.handlers = {'BRPOP': mock.Mock()}
+        for fileno, channel in enumerate([parent, shard]):
+            poller.add(channel)
+            poller._fd_to_chan[fileno] = (channel, 'BRPOP')
+            poller._chan_to_sock[(channel, channel.client, 'BRPOP')] = fileno
+        return poller, parent, shard
+
+    def test_on_readable_shard_error(self):
+        poller, parent, shard = self.get_sharded_poller()
+
+        poller.on_readable(1)
+        # other shards keep being consumed
+        poller.on_readable(0)
+        poller.on_readable(1)
+
+        parent.handlers['BRPOP'].assert_called_once_with()
+        parent.reset_shard_channel.assert_called_once_with(shard)
+        poller.poller.unregister.assert_called_once_with(1)
+        assert poller._channels == {parent}
+        assert poller._fd_to_chan == {0: (parent, 'BRPOP')}
+        assert list(poller._failed_shards) == [parent]
+
+    def test_on_readable_error(self):
+        poller, parent, shard = self.get_sharded_poller()
+        parent.handlers['BRPOP'].side_effect = ConnectionError()
+
+        with pytest.raises(ConnectionError):
+            poller.on_readable(0)
+
+        assert not parent.reset_shard_channel.called
+
+    def test_handle_event_shard_error(self):
+        poller, parent, shard = self.get_sharded_poller()
+        shard._poll_error.side_effect = ConnectionError()
+
+        poller.handle_event(1, 8)  # ERR
+
+        parent.reset_shard_channel.assert_called_once_with(shard)
+
+    @mock.patch('kombu.transport.redis.MultiChannelPoller._register_BRPOP')
+    def test_register_brpop_shard_error(self, mock_register_brpop):
+        poller, parent, shard = self.get_sharded_poller()
+        mock_register_brpop.side_effect = ConnectionError()
+
+        poller._register_BRPOP(shard)
+        # reset shard channel is not registered anymore
+        poller._register_BRPOP(shard)
+
+        parent.reset_shard_channel.assert_called_once_with(shard)
+        assert mock_register_brpop.call_count == 1
+        with pytest.raises(ConnectionError):
+            poller._register_BRPOP(parent)
+
+    @mock.patch('celery_redis_sentinel.transport.timer')
+    def test_restore_shards(self, mock_timer):
+        poller, parent, shard = self.get_sharded_poller()
+        mock_timer.return_value = 10
+        poller.on_readable(1)
+        parent.restore_shard_channels.side_effect = ConnectionError()
+
+        poller._restore_shards()
+        assert not parent.restore_shard_channels.called
+
+        mock_timer.return_value = 11
+        poller._restore_shards()
+        assert poller._failed_shards == {parent: 12}
+
+        parent.restore_shard_channels.side_effect = None
+        mock_timer.return_value = 12
+        poller._restore_shards()
+        assert parent.restore_shard_channels.call_count == 2
+        assert poller._failed_shards == {}
+
 
 class TestSentinelTransport(object):
     def test_channel(self):
         assert SentinelTransport.Channel is SentinelChannel
+
+    def test_cycle(self):
+        transport = SentinelTransport(client=Connection())
+
+        assert isinstance(transport.cycle, SentinelMultiChannelPoller)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+import mock
+
+from celery_redis_sentinel.utils import fork_aware_cached_property, truncated_repr
+
+
+class Foo(object):
+    calls = 0
+
+    @fork_aware_cached_property
+    def bar(self):
+        """bar docs"""
+        self.calls += 1
+        return object()
+
+
+class TestForkAwareCachedProperty(object):
+    def test_class_access(self):
+        assert isinstance(Foo.bar, fork_aware_cached_property)
+        assert Foo.bar.__doc__ == 'bar docs'
+
+    @mock.patch('os.getpid')
+    def test_get(self, mock_getpid):
+        mock_getpid.return_value = 1
+        foo = Foo()
+
+        bar = foo.bar
+        assert foo.bar is bar
+        assert foo.calls == 1
+
+        mock_getpid.return_value = 2
+        assert foo.bar is not bar
+        assert foo.calls == 2
+        assert foo._bar_inherited == [bar]
+
+    def test_set_delete(self):
+        foo = Foo()
+
+        foo.bar = 'bar'
+        assert foo.bar == 'bar'
+
+        del foo.bar
+        assert foo.bar != 'bar'
+        assert foo.calls == 1
+
+
+class TestTruncatedRepr(object):
+    def test_short(self):
+        assert str(truncated_repr(('foo', {'a': [1, 2]}, (1,)))) == repr(('foo', {'a': [1, 2]}, (1,)))
+
+    def test_truncated(self):
+        value = str(truncated_repr(('a' * 10000, {'b': b'c' * 10000}), limit=50))
+
+        assert len(value) == 53
+        assert value.startswith("('aaa")
+        assert value.endswith('...')
+
+    def test_lazy(self):
+        calls = []
+
+        class Foo(object):
+            def __repr__(self):
+                calls.append(1)
+                return 'foo'
+
+        value = truncated_repr(Foo())
+
+        assert not calls
+        assert str(value) == 'foo'